@@ -0,0 +1,360 @@
+"""Columnar archive of closed trading days in a Parquet dataset.
+
+    <root>/ticker=AAPL/date=2024-05-01/part-0.parquet     one closed day
+    <root>/ticker=AAPL/date=2024-04/part-0.parquet        a compacted month
+
+Closed (UTC) days are exported from market_data as one file per ticker-day, sorted by
+timestamp. Once a month has closed, compaction merges its days into a single file, so a
+year is twelve files per ticker instead of ~250 small ones. Reads go through
+pyarrow.dataset: ticker and date partitions are pruned by directory name, the timestamp
+range is pushed down to the row-group statistics and the files are memory mapped, so years
+of bars load as NumPy columns without touching the database:
+
+    python archive.py export [--root bar_archive] [--since 2024-01-01]
+    python archive.py compact
+    python archive.py read --tickers AAPL MSFT --start 2024-01-01 --end 2024-07-01
+
+    bars = read_bars("bar_archive", ["AAPL"], start, end)        # {ticker: BarStore}
+    frame = read_frame("bar_archive", start=start, columns=["close", "volume"])
+
+pyarrow is optional; it is only imported when the archive is used.
+"""
+import argparse
+import os
+import shutil
+from datetime import date, datetime, time, timedelta
+import numpy as np
+import pandas as pd
+from bar_store import FIELDS, BarStore
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+DEFAULT_ROOT = "bar_archive"
+JOB_NAME = "archive_export"
+INDICATOR_COLUMNS = ("rsi", "macd", "macd_signal", "ema_12", "ema_26")
+COLUMNS = ("timestamp", "retrieved_at", *FIELDS, *INDICATOR_COLUMNS)
+PART_NAME = "part-0.parquet"
+
+
+def _pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.dataset
+        import pyarrow.fs
+        import pyarrow.parquet
+    except ImportError as e:
+        raise ImportError("The bar archive needs pyarrow: pip install pyarrow") from e
+    return pyarrow
+
+
+def _schema(pa):
+    timestamp = pa.timestamp("ns", tz="UTC")
+    return pa.schema(
+        [("timestamp", timestamp), ("retrieved_at", timestamp)]
+        + [(column, pa.float64()) for column in (*FIELDS, *INDICATOR_COLUMNS)]
+    )
+
+
+def _utc(value) -> pd.Timestamp:
+    # Naive datetimes are UTC, as everywhere in the database
+    value = pd.Timestamp(value)
+    return value.tz_localize("UTC") if value.tz is None else value.tz_convert("UTC")
+
+
+def partition_path(root: str, ticker: str, key: str) -> str:
+    """Path of a partition; key is a day (2024-05-01) or a compacted month (2024-05)."""
+    return os.path.join(root, f"ticker={ticker}", f"date={key}", PART_NAME)
+
+
+def archived_tickers(root: str) -> list[str]:
+    if not os.path.isdir(root):
+        return []
+    return sorted(
+        name.removeprefix("ticker=") for name in os.listdir(root) if name.startswith("ticker=")
+    )
+
+
+def partitions(root: str, ticker: str) -> list[str]:
+    """Partition keys of a ticker in time order (a month sorts before its own days)."""
+    directory = os.path.join(root, f"ticker={ticker}")
+    if not os.path.isdir(directory):
+        return []
+    return sorted(
+        name.removeprefix("date=")
+        for name in os.listdir(directory)
+        if name.startswith("date=") and os.path.exists(os.path.join(directory, name, PART_NAME))
+    )
+
+
+def _to_table(pa, frame: pd.DataFrame):
+    frame = frame.sort_values("timestamp", kind="stable")
+    columns = {}
+    for column in COLUMNS:
+        if column not in frame:
+            columns[column] = np.full(len(frame), np.nan)
+        elif column in ("timestamp", "retrieved_at"):
+            columns[column] = pd.to_datetime(frame[column], utc=True).to_numpy()
+        else:
+            columns[column] = frame[column].to_numpy(dtype=np.float64)
+    return pa.Table.from_pandas(pd.DataFrame(columns), schema=_schema(pa), preserve_index=False)
+
+
+def write_partition(root: str, ticker: str, key: str, frame: pd.DataFrame) -> str:
+    """Write (or replace) one partition; frame holds COLUMNS with naive-UTC timestamps."""
+    pa = _pyarrow()
+    path = partition_path(root, ticker, key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Readers never see a half-written file (dot files are skipped by the dataset scan)
+    tmp = os.path.join(os.path.dirname(path), f".{PART_NAME}.{os.getpid()}.tmp")
+    # One row group per file: a month is ~8k rows, and every extra row group costs more to
+    # decode than the pushdown saves. Prices are nearly unique, so dictionaries only add size.
+    pa.parquet.write_table(_to_table(pa, frame), tmp, compression="zstd", use_dictionary=False)
+    os.replace(tmp, path)
+    return path
+
+
+def read_partition(root: str, ticker: str, key: str) -> pd.DataFrame:
+    """One partition as a frame with naive-UTC timestamps."""
+    pa = _pyarrow()
+    path = partition_path(root, ticker, key)
+    frame = pa.parquet.read_table(path, memory_map=True).to_pandas()
+    for column in ("timestamp", "retrieved_at"):
+        frame[column] = frame[column].dt.tz_localize(None)
+    return frame
+
+
+def write_day(root: str, ticker: str, day: date, frame: pd.DataFrame) -> str:
+    """Archive one ticker-day, replacing that day inside the month if it was compacted."""
+    month = day.strftime("%Y-%m")
+    if not os.path.exists(partition_path(root, ticker, month)):
+        return write_partition(root, ticker, day.isoformat(), frame)
+    existing = read_partition(root, ticker, month)
+    other_days = existing[existing["timestamp"].dt.date != day]
+    combined = pd.concat([other_days, frame], ignore_index=True)
+    return write_partition(root, ticker, month, combined)
+
+
+def compact(root: str = DEFAULT_ROOT, before: date | None = None) -> int:
+    """Merge the days of every closed month into one file per ticker; returns files merged.
+
+    `before` (default: the first of the current month, UTC) bounds the months compacted.
+    """
+    before = before or datetime.utcnow().date().replace(day=1)
+    merged = 0
+    for ticker in archived_tickers(root):
+        by_month: dict[str, list[str]] = {}
+        for key in partitions(root, ticker):
+            if len(key) == 10 and date.fromisoformat(key) < before:
+                by_month.setdefault(key[:7], []).append(key)
+        for month, days in by_month.items():
+            frames = [read_partition(root, ticker, key) for key in days]
+            if os.path.exists(partition_path(root, ticker, month)):
+                frames.insert(0, read_partition(root, ticker, month))
+            combined = pd.concat(frames, ignore_index=True)
+            # A day exported again after an earlier compaction replaces the old copy
+            combined = combined.drop_duplicates("timestamp", keep="last")
+            write_partition(root, ticker, month, combined)
+            # Until the days are removed a scan can see them twice; compact outside trading
+            # hours, or while nothing reads the archive
+            for key in days:
+                shutil.rmtree(os.path.dirname(partition_path(root, ticker, key)))
+            merged += len(days)
+    logger.info(f"Compacted {merged} ticker-days in {root}.")
+    return merged
+
+
+def dataset(root: str = DEFAULT_ROOT):
+    pa = _pyarrow()
+    partitioning = pa.dataset.partitioning(
+        pa.schema([("ticker", pa.string()), ("date", pa.string())]), flavor="hive"
+    )
+    return pa.dataset.dataset(
+        root,
+        format="parquet",
+        partitioning=partitioning,
+        filesystem=pa.fs.LocalFileSystem(use_mmap=True),
+    )
+
+
+def _filter(tickers: list[str] | None, start, end):
+    pa = _pyarrow()
+    field = pa.dataset.field
+    timestamp = pa.timestamp("ns", tz="UTC")
+    conditions = []
+    if tickers:
+        conditions.append(field("ticker").isin(list(tickers)))
+    if start is not None:
+        start = _utc(start)
+        # Compared as strings; the month key ("2024-05") keeps compacted months in range
+        conditions.append(field("date") >= start.strftime("%Y-%m"))
+        conditions.append(field("timestamp") >= pa.scalar(start, timestamp))
+    if end is not None:
+        end = _utc(end)
+        conditions.append(field("date") <= end.date().isoformat())
+        conditions.append(field("timestamp") < pa.scalar(end, timestamp))
+    expression = None
+    for condition in conditions:
+        expression = condition if expression is None else expression & condition
+    return expression
+
+
+def _ticker_codes(table) -> tuple[np.ndarray, list[str]]:
+    # Codes are numbered in order of first appearance
+    encoded = table.column("ticker").combine_chunks().dictionary_encode()
+    return encoded.indices.to_numpy(), encoded.dictionary.to_pylist()
+
+
+def _in_order(pa, table) -> bool:
+    """Whether every ticker is one contiguous run of increasing timestamps."""
+    codes, _ = _ticker_codes(table)
+    steps = np.diff(codes)
+    timestamps = table.column("timestamp").cast(pa.int64()).to_numpy()
+    return bool(np.all(steps >= 0) and np.all((np.diff(timestamps) > 0) | (steps > 0)))
+
+
+def read_table(
+    root: str = DEFAULT_ROOT,
+    tickers: list[str] | None = None,
+    start: datetime | None = None,
+    end: datetime | None = None,
+    columns: list[str] | None = None,
+):
+    """Bars in [start, end) as a pyarrow Table, grouped by ticker in timestamp order."""
+    if not os.path.isdir(root):
+        raise FileNotFoundError(f"No bar archive at {root}")
+    pa = _pyarrow()
+    wanted = ["ticker", "timestamp", *(c for c in (columns or COLUMNS) if c != "timestamp")]
+    table = dataset(root).to_table(columns=wanted, filter=_filter(tickers, start, end))
+    # Fragments are scanned in path order, which already is ticker/time order; the check is
+    # far cheaper than the sort
+    if not _in_order(pa, table):
+        table = table.sort_by([("ticker", "ascending"), ("timestamp", "ascending")])
+    return table
+
+
+def read_frame(
+    root: str = DEFAULT_ROOT,
+    tickers: list[str] | None = None,
+    start: datetime | None = None,
+    end: datetime | None = None,
+    columns: list[str] | None = None,
+) -> pd.DataFrame:
+    """Like read_table, as a pandas frame (tz-aware UTC timestamps)."""
+    return read_table(root, tickers, start, end, columns).to_pandas()
+
+
+def read_bars(
+    root: str = DEFAULT_ROOT,
+    tickers: list[str] | None = None,
+    start: datetime | None = None,
+    end: datetime | None = None,
+) -> dict[str, BarStore]:
+    """Bars per ticker in [start, end), in the shape backtest.load_bars returns."""
+    pa = _pyarrow()
+    table = read_table(root, tickers, start, end, ["timestamp", "retrieved_at", *FIELDS])
+    codes, names = _ticker_codes(table)
+    timestamps = table.column("timestamp").cast(pa.int64()).to_numpy()
+    retrieved_at = table.column("retrieved_at").cast(pa.int64()).to_numpy()
+    columns = {field: table.column(field).to_numpy() for field in FIELDS}
+
+    bars = {}
+    bounds = [0, *(np.flatnonzero(np.diff(codes)) + 1), len(codes)]
+    for lo, hi in zip(bounds[:-1], bounds[1:]):
+        if lo == hi:
+            continue
+        bars[names[codes[lo]]] = BarStore(
+            timestamps[lo:hi],
+            {field: values[lo:hi] for field, values in columns.items()},
+            retrieved_at[lo:hi],
+        )
+    logger.info(f"Read {len(codes):,} archived bars for {len(bars)} tickers.")
+    return bars
+
+
+def _day_frame(session, day: date) -> pd.DataFrame:
+    from sqlalchemy import select
+    from db_models import MarketData, Stock
+
+    day_start = datetime.combine(day, time())
+    statement = (
+        select(Stock.ticker, *(getattr(MarketData, column) for column in COLUMNS))
+        .join(MarketData, MarketData.stock_id == Stock.id)
+        .where(MarketData.timestamp >= day_start)
+        .where(MarketData.timestamp < day_start + timedelta(days=1))
+    )
+    return pd.DataFrame(session.execute(statement).all(), columns=["ticker", *COLUMNS])
+
+
+def export_closed_days(
+    root: str = DEFAULT_ROOT, since: date | None = None, until: date | None = None
+) -> int:
+    """Archive every closed day from `since` (default: after the last export) up to `until`.
+
+    `until` is exclusive and defaults to today (UTC), which is still open. Progress is saved
+    per day in job_checkpoints, so an interrupted export resumes; pass `since` to rewrite
+    days that were corrected after they were archived. Returns the number of ticker-days
+    written.
+    """
+    _pyarrow()
+    from sqlalchemy import func
+    from db_models import JobCheckpoint, MarketData
+    from db_setup import SessionLocal
+
+    until = until or datetime.utcnow().date()
+    session = SessionLocal()
+    written = 0
+    try:
+        if since is None:
+            checkpoint = session.get(JobCheckpoint, JOB_NAME)
+            if checkpoint is not None:
+                since = checkpoint.timestamp.date()
+            else:
+                first = session.query(func.min(MarketData.timestamp)).scalar()
+                if first is None:
+                    logger.info("No bars to archive.")
+                    return 0
+                since = pd.Timestamp(first).date()
+
+        day = since
+        while day < until:
+            frame = _day_frame(session, day)
+            for ticker, bars in frame.groupby("ticker", sort=False):
+                write_day(root, ticker, day, bars)
+                written += 1
+            session.merge(
+                JobCheckpoint(
+                    name=JOB_NAME,
+                    timestamp=datetime.combine(day + timedelta(days=1), time()),
+                    updated_at=datetime.utcnow(),
+                )
+            )
+            session.commit()
+            if len(frame):
+                tickers = frame["ticker"].nunique()
+                logger.info(f"Archived {len(frame)} bars of {day} for {tickers} tickers.")
+            day += timedelta(days=1)
+    finally:
+        session.close()
+    logger.info(f"Archive export complete: {written} ticker-days written to {root}.")
+    return written
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Parquet archive of closed trading days.")
+    parser.add_argument("command", choices=["export", "compact", "read"])
+    parser.add_argument("--root", default=DEFAULT_ROOT)
+    parser.add_argument("--since", type=date.fromisoformat, help="export from this day on")
+    parser.add_argument("--tickers", nargs="*")
+    parser.add_argument("--start", type=datetime.fromisoformat)
+    parser.add_argument("--end", type=datetime.fromisoformat)
+    args = parser.parse_args()
+
+    if args.command == "export":
+        export_closed_days(args.root, args.since)
+        compact(args.root)
+    elif args.command == "compact":
+        compact(args.root)
+    else:
+        frame = read_frame(args.root, args.tickers, args.start, args.end)
+        print(frame.groupby("ticker")["timestamp"].agg(["count", "min", "max"]).to_string())
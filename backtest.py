@@ -0,0 +1,469 @@
+"""Replay stored 1-minute bars through the monitor's buy rule and the wallet's trailing stop.
+
+Signals are computed for every bar of every ticker at once with array operations. The wallet
+is then simulated by walking only the signal bars in time order: each buy looks up its exit
+with a vectorised running-maximum scan over the following bars, and exits free up cash
+before later buys, so the shared balance, the 15% position sizing and the sell cooldown
+behave as in the live loop. Equity is marked to market on the union of bar timestamps.
+
+    python backtest.py --start 2024-01-01 --end 2025-01-01      # bars from market_data
+    python backtest.py --npz bars.npz                             # columnar export
+    python backtest.py --synthetic 75 --days 252                  # random-walk benchmark
+
+Rule differences with the live loop: the buy rule compares consecutive bars (live compares
+the two most recently retrieved bars, which is the same bar pair once the updater keeps up),
+and every bar is evaluated (live evaluates every ~15 seconds).
+"""
+import argparse
+import heapq
+import time
+from datetime import datetime
+import numpy as np
+import pandas as pd
+from bar_store import BarStore, FIELDS
+from logger import get_logger
+from trading_rules import (
+    COOLDOWN_PERIOD,
+    INITIAL_STOP,
+    MIN_SPEND,
+    PRICE_THRESHOLD,
+    SPEND_FRACTION,
+    TRAILING_STOP,
+    VOLUME_THRESHOLD,
+)
+
+logger = get_logger(__name__)
+
+NANOSECONDS_PER_SECOND = 1_000_000_000
+
+
+class BacktestConfig:
+    """Parameters of the rules being replayed; the defaults are the live values."""
+
+    def __init__(
+        self,
+        initial_balance: float = 10000.0,
+        price_threshold: float = PRICE_THRESHOLD,
+        volume_threshold: float = VOLUME_THRESHOLD,
+        cooldown: float = COOLDOWN_PERIOD,
+        spend_fraction: float = SPEND_FRACTION,
+        min_spend: float = MIN_SPEND,
+        initial_stop: float = INITIAL_STOP,
+        trailing_stop: float = TRAILING_STOP,
+    ):
+        self.initial_balance = initial_balance
+        self.price_threshold = price_threshold
+        self.volume_threshold = volume_threshold
+        self.cooldown = cooldown
+        self.spend_fraction = spend_fraction
+        self.min_spend = min_spend
+        self.initial_stop = initial_stop
+        self.trailing_stop = trailing_stop
+
+    def as_dict(self) -> dict:
+        return dict(vars(self))
+
+    def __repr__(self):
+        return f"BacktestConfig({', '.join(f'{k}={v}' for k, v in vars(self).items())})"
+
+
+class BacktestResult:
+    def __init__(
+        self, trades: pd.DataFrame, equity: pd.Series, config: BacktestConfig, seconds: float
+    ):
+        self.trades = trades
+        self.equity = equity
+        self.config = config
+        self.seconds = seconds
+
+    def drawdown(self) -> pd.Series:
+        return 1.0 - self.equity / self.equity.cummax()
+
+    def summary(self) -> dict:
+        trades = self.trades
+        closed = trades[~trades["open"]] if len(trades) else trades
+        final = float(self.equity.iloc[-1]) if len(self.equity) else self.config.initial_balance
+        return {
+            "trades": int(len(trades)),
+            "open_positions": int(trades["open"].sum()) if len(trades) else 0,
+            "final_equity": final,
+            "total_return": final / self.config.initial_balance - 1.0,
+            "realized_pnl": float(closed["pnl"].sum()) if len(closed) else 0.0,
+            "win_rate": float((closed["pnl"] > 0).mean()) if len(closed) else float("nan"),
+            "avg_return": float(closed["return"].mean()) if len(closed) else float("nan"),
+            "avg_bars_held": float(closed["bars_held"].mean()) if len(closed) else float("nan"),
+            "max_drawdown": float(self.drawdown().max()) if len(self.equity) else 0.0,
+            "seconds": self.seconds,
+        }
+
+
+def load_bars(
+    tickers: list[str] | None = None,
+    start: datetime | None = None,
+    end: datetime | None = None,
+) -> dict[str, BarStore]:
+    """Load bars per ticker from market_data with one ordered query."""
+    from db_models import MarketData, Stock
+    from db_setup import SessionLocal
+    from stock_db import BAR_COLUMNS
+
+    session = SessionLocal()
+    try:
+        query = session.query(Stock.ticker, *BAR_COLUMNS).join(
+            MarketData, MarketData.stock_id == Stock.id
+        )
+        if tickers:
+            query = query.filter(Stock.ticker.in_(tickers))
+        if start is not None:
+            query = query.filter(MarketData.timestamp >= start)
+        if end is not None:
+            query = query.filter(MarketData.timestamp < end)
+        rows = query.order_by(Stock.ticker, MarketData.timestamp).all()
+    finally:
+        session.close()
+
+    grouped: dict[str, list] = {}
+    for ticker, *bar in rows:
+        grouped.setdefault(ticker, []).append(bar)
+    logger.info(f"Loaded {len(rows)} bars for {len(grouped)} tickers.")
+    return {ticker: BarStore.from_rows(bars, retrieved=False) for ticker, bars in grouped.items()}
+
+
+def save_npz(bars_by_ticker: dict[str, BarStore], path: str):
+    """Columnar export: one timestamp and one array per field per ticker."""
+    arrays = {}
+    for ticker, bars in bars_by_ticker.items():
+        arrays[f"{ticker}/timestamp"] = bars.timestamps
+        for field in FIELDS:
+            arrays[f"{ticker}/{field}"] = bars.column(field)
+    np.savez(path, **arrays)
+
+
+def load_npz(path: str) -> dict[str, BarStore]:
+    with np.load(path) as data:
+        tickers = sorted({key.rsplit("/", 1)[0] for key in data.files})
+        return {
+            ticker: BarStore(
+                data[f"{ticker}/timestamp"],
+                {field: data[f"{ticker}/{field}"] for field in FIELDS},
+            )
+            for ticker in tickers
+        }
+
+
+def _changes(close: np.ndarray, volume: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """|Δclose| and |Δvolume| versus the previous bar, rounded like the live rule.
+
+    The first bar and changes the live rule ignores (a zero on either side) are NaN, which
+    never passes a threshold.
+    """
+    price_change = np.full(len(close), np.nan)
+    volume_change = np.full(len(close), np.nan)
+    if len(close) >= 2:
+        prev_close, prev_volume = close[:-1], volume[:-1]
+        valid = (prev_close != 0) & (close[1:] != 0) & (prev_volume != 0) & (volume[1:] != 0)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            price = np.abs(np.round((close[1:] - prev_close) / prev_close, 6))
+            vol = np.abs(np.round((volume[1:] - prev_volume) / prev_volume, 6))
+        price_change[1:] = np.where(valid, price, np.nan)
+        volume_change[1:] = np.where(valid, vol, np.nan)
+    return price_change, volume_change
+
+
+def _signal_mask(price_change: np.ndarray, volume_change: np.ndarray, config: BacktestConfig):
+    return (price_change > config.price_threshold) & (volume_change > config.volume_threshold)
+
+
+def buy_signals(bars: BarStore, config: BacktestConfig) -> np.ndarray:
+    """Bar indices where |Δclose| and |Δvolume| versus the previous bar exceed the thresholds."""
+    return np.flatnonzero(_signal_mask(*_changes(bars.close, bars.volume), config))
+
+
+class ReplayData:
+    """A universe of bars prepared once for any number of backtests.
+
+    Every per-ticker array is a slice of one flat array (ticker i spans offsets[i] to
+    offsets[i + 1]), so the whole set can live in shared memory and be sliced without
+    copying. Besides the bars it keeps the rounded bar-to-bar changes the buy rule looks at,
+    the union of all timestamps (the equity grid) and each bar's position on that grid.
+    """
+
+    ARRAYS = ("timestamps", "close", "price_change", "volume_change", "grid_pos")
+
+    def __init__(
+        self,
+        tickers: list[str],
+        offsets: np.ndarray,
+        arrays: dict[str, np.ndarray],
+        grid: np.ndarray,
+    ):
+        self.tickers = tickers
+        self.offsets = offsets
+        self.arrays = arrays
+        self.grid = grid
+
+    @classmethod
+    def from_bars(cls, bars_by_ticker: dict[str, BarStore]) -> "ReplayData":
+        tickers = [ticker for ticker, bars in bars_by_ticker.items() if len(bars) >= 2]
+        stores = [bars_by_ticker[ticker] for ticker in tickers]
+        offsets = np.concatenate(([0], np.cumsum([len(bars) for bars in stores]))).astype(np.int64)
+        changes = [_changes(bars.close, bars.volume) for bars in stores]
+
+        def flat(parts, dtype):
+            return np.concatenate(parts).astype(dtype, copy=False) if parts else np.empty(0, dtype)
+
+        timestamps = flat([bars.timestamps for bars in stores], np.int64)
+        grid = np.unique(timestamps)
+        arrays = {
+            "timestamps": timestamps,
+            "close": flat([bars.close for bars in stores], np.float64),
+            "price_change": flat([price for price, _ in changes], np.float64),
+            "volume_change": flat([volume for _, volume in changes], np.float64),
+            "grid_pos": np.searchsorted(grid, timestamps).astype(np.int64),
+        }
+        return cls(tickers, offsets, arrays, grid)
+
+    def __len__(self) -> int:
+        return len(self.tickers)
+
+    def slice(self, name: str, i: int) -> np.ndarray:
+        return self.arrays[name][self.offsets[i] : self.offsets[i + 1]]
+
+    @property
+    def bars(self) -> int:
+        return int(self.offsets[-1])
+
+
+def find_exit(
+    close: np.ndarray, entry: int, entry_price: float, config: BacktestConfig, chunk: int = 1024
+) -> int | None:
+    """Index of the bar where the trailing stop sells a position bought at `entry`, or None.
+
+    The wallet raises the stop to 97% of each close before checking it, so a bar sells when
+    its close is at or below max(96.5% of the entry price, 97% of the highest close since
+    entry, excluding the bar itself). Scans in growing chunks so short trades stay cheap.
+    """
+    floor = entry_price * config.initial_stop
+    running = -np.inf
+    start = entry + 1
+    while start < len(close):
+        window = close[start : start + chunk]
+        highest = np.maximum.accumulate(window)
+        before = np.concatenate(([running], highest[:-1]))
+        hit = np.flatnonzero(window <= np.maximum(floor, config.trailing_stop * before))
+        if hit.size:
+            return start + int(hit[0])
+        running = max(running, float(highest[-1]))
+        start += len(window)
+        chunk *= 2
+    return None
+
+
+def _equity_curve(data: ReplayData, trades: list[dict], config: BacktestConfig) -> pd.Series:
+    """Cash plus positions marked at their last close, on the grid of all bar timestamps.
+
+    Built from deltas: cash moves at entry and exit bars, and a held position changes value
+    at each of its ticker's bars, so there is no per-grid-point work per trade.
+    """
+    delta = np.zeros(len(data.grid))
+    by_ticker: dict[int, list[dict]] = {}
+    for trade in trades:
+        by_ticker.setdefault(trade["ticker_id"], []).append(trade)
+
+    for tid, ticker_trades in by_ticker.items():
+        close, grid_pos = data.slice("close", tid), data.slice("grid_pos", tid)
+        held = np.zeros(len(close) + 1)
+        for trade in ticker_trades:
+            held[trade["entry_bar"]] += trade["quantity"]
+            held[trade["end_bar"]] -= trade["quantity"]
+            delta[grid_pos[trade["entry_bar"]]] -= trade["cost"]
+            if not trade["open"]:
+                delta[grid_pos[trade["end_bar"]]] += trade["proceeds"]
+        value = np.cumsum(held)[:-1] * close
+        delta[grid_pos] += np.diff(value, prepend=0.0)
+
+    equity = config.initial_balance + np.cumsum(delta)
+    return pd.Series(
+        equity, index=pd.DatetimeIndex(data.grid.view("datetime64[ns]")), name="equity"
+    )
+
+
+def run_backtest(
+    data: dict[str, BarStore] | ReplayData,
+    config: BacktestConfig | None = None,
+    equity: bool = True,
+) -> BacktestResult:
+    """Replay the rules over a universe of bars (prepare a ReplayData once to run many)."""
+    config = config or BacktestConfig()
+    started = time.perf_counter()
+    if not isinstance(data, ReplayData):
+        data = ReplayData.from_bars(data)
+    tickers = data.tickers
+    closes = [data.slice("close", i) for i in range(len(tickers))]
+    stamps = [data.slice("timestamps", i) for i in range(len(tickers))]
+
+    # Every signal bar of the universe, in time order (ties in ticker order, like a round)
+    flat = np.flatnonzero(
+        _signal_mask(data.arrays["price_change"], data.arrays["volume_change"], config)
+    )
+    ticker_ids = np.searchsorted(data.offsets, flat, side="right") - 1
+    bar_ids = flat - data.offsets[ticker_ids]
+    event_ns = data.arrays["timestamps"][flat]
+    order = np.lexsort((ticker_ids, event_ns))
+
+    cooldown_ns = int(config.cooldown * NANOSECONDS_PER_SECOND)
+    balance = config.initial_balance
+    trades: list[dict] = []
+    exits: list[tuple[int, int]] = []  # (exit_ns, trade number)
+    holding: set[int] = set()
+    last_sell: dict[int, int] = {}
+
+    def close_until(ns: int):
+        nonlocal balance
+        while exits and exits[0][0] <= ns:
+            _, number = heapq.heappop(exits)
+            trade = trades[number]
+            balance += trade["proceeds"]
+            holding.discard(trade["ticker_id"])
+            last_sell[trade["ticker_id"]] = trade["exit_ns"]
+
+    for ns, tid, bar in zip(
+        event_ns[order].tolist(), ticker_ids[order].tolist(), bar_ids[order].tolist()
+    ):
+        close_until(ns)
+        if tid in holding:
+            continue  # the monitor only checks the stop of a held ticker
+        sold_at = last_sell.get(tid)
+        if sold_at is not None and ns - sold_at < cooldown_ns:
+            continue
+
+        spend = balance * config.spend_fraction
+        if spend <= config.min_spend:
+            continue
+        close = closes[tid]
+        price = round(float(close[bar]), 4)
+        quantity = int(spend // price) if price > 0 else 0
+        if quantity <= 0 or price * quantity > balance:
+            continue
+        cost = price * quantity
+        balance -= cost
+        holding.add(tid)
+
+        exit_bar = find_exit(close, bar, price, config)
+        # Open positions are marked to the last close
+        last_bar = len(close) - 1 if exit_bar is None else exit_bar
+        trade = {
+            "ticker": tickers[tid],
+            "ticker_id": tid,
+            "entry_bar": bar,
+            "end_bar": len(close) if exit_bar is None else exit_bar,
+            "entry_ns": ns,
+            "entry_price": price,
+            "quantity": quantity,
+            "cost": cost,
+            "open": exit_bar is None,
+            "exit_ns": int(stamps[tid][last_bar]),
+            "exit_price": float(close[last_bar]),
+            "bars_held": last_bar - bar,
+        }
+        trade["proceeds"] = trade["exit_price"] * quantity
+        if exit_bar is not None:
+            heapq.heappush(exits, (trade["exit_ns"], len(trades)))
+        trades.append(trade)
+
+    close_until(np.iinfo(np.int64).max)
+
+    equity_curve = pd.Series(dtype=float)
+    if equity and tickers:
+        equity_curve = _equity_curve(data, trades, config)
+    table = pd.DataFrame(trades)
+    if len(table):
+        table["entry_time"] = pd.to_datetime(table["entry_ns"], unit="ns")
+        table["exit_time"] = pd.to_datetime(table["exit_ns"], unit="ns")
+        table["pnl"] = table["proceeds"] - table["cost"]
+        table["return"] = table["pnl"] / table["cost"]
+        table = table[
+            [
+                "ticker",
+                "entry_time",
+                "entry_price",
+                "quantity",
+                "cost",
+                "exit_time",
+                "exit_price",
+                "proceeds",
+                "pnl",
+                "return",
+                "bars_held",
+                "open",
+            ]
+        ]
+    return BacktestResult(table, equity_curve, config, time.perf_counter() - started)
+
+
+def synthetic_bars(tickers: int = 75, days: int = 252, seed: int = 0) -> dict[str, BarStore]:
+    """Random-walk 1-minute bars (390 per day) with occasional jumps, for benchmarking."""
+    rng = np.random.default_rng(seed)
+    minutes = days * 390
+    day_start = np.datetime64("2024-01-02T14:30", "ns").astype(np.int64)
+    offsets = np.arange(minutes)
+    # Trading minutes only: 390 per day, days one calendar day apart
+    timestamps = (
+        day_start
+        + (offsets // 390) * 86_400 * NANOSECONDS_PER_SECOND
+        + (offsets % 390) * 60 * NANOSECONDS_PER_SECOND
+    )
+    bars = {}
+    for i in range(tickers):
+        returns = rng.normal(0, 0.004, minutes)
+        jumps = rng.random(minutes) < 0.002
+        returns[jumps] += rng.normal(0, 0.03, jumps.sum())
+        close = 5.0 * np.exp(np.cumsum(returns))
+        volume = np.floor(rng.lognormal(8, 0.5, minutes))
+        spread = np.abs(rng.normal(0, 0.002, minutes))
+        columns = {
+            "adj_close": close,
+            "close": close,
+            "open": close * (1 - spread / 2),
+            "high": close * (1 + spread),
+            "low": close * (1 - spread),
+            "volume": volume,
+        }
+        bars[f"SYN{i:03d}"] = BarStore(timestamps.copy(), columns)
+    return bars
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Backtest the monitor rules on stored bars.")
+    parser.add_argument("--start", type=datetime.fromisoformat)
+    parser.add_argument("--end", type=datetime.fromisoformat)
+    parser.add_argument("--tickers", nargs="*")
+    parser.add_argument("--npz", help="read bars from a columnar export instead of the DB")
+    parser.add_argument("--archive", metavar="ROOT", help="read bars from the Parquet archive")
+    parser.add_argument("--export", help="write the loaded bars to a columnar .npz export")
+    parser.add_argument("--synthetic", type=int, metavar="TICKERS")
+    parser.add_argument("--days", type=int, default=252)
+    parser.add_argument("--trades", help="write the trade table to this CSV file")
+    args = parser.parse_args()
+
+    if args.synthetic:
+        data = synthetic_bars(args.synthetic, args.days)
+    elif args.npz:
+        data = load_npz(args.npz)
+    elif args.archive:
+        from archive import read_bars
+
+        data = read_bars(args.archive, args.tickers, args.start, args.end)
+    else:
+        data = load_bars(args.tickers, args.start, args.end)
+    if args.export:
+        save_npz(data, args.export)
+
+    result = run_backtest(data)
+    total_bars = sum(len(bars) for bars in data.values())
+    print(f"{total_bars:,} bars, {len(data)} tickers, replayed in {result.seconds:.2f}s")
+    for key, value in result.summary().items():
+        shown = f"{value:,.4f}" if isinstance(value, float) else value
+        print(f"  {key:>15}: {shown}")
+    if args.trades:
+        result.trades.to_csv(args.trades, index=False)
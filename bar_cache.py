@@ -0,0 +1,279 @@
+"""Shared-memory cache of the latest bars per ticker.
+
+The data updater publishes every ticker's bars into a named shared-memory segment right after
+saving them; monitor processes on the same host read them from there instead of querying the
+database. The database stays the durable store and the fallback when a segment is missing or
+stale (e.g. the updater is not running).
+
+Segment layout (one per ticker, named "<prefix>_<ticker>"):
+
+    header   8 x uint64: seq, end, count, capacity, updated_at_ns, magic, 0, 0
+    records  capacity x RECORD_DTYPE, a ring; logical bar i lives at i % capacity
+
+There is a single writer per segment. It makes `seq` odd before touching the records and even
+again afterwards (a seqlock); readers copy the bars and retry when `seq` was odd or moved.
+"""
+import re
+import sys
+import threading
+import time
+from contextlib import contextmanager
+import numpy as np
+from multiprocessing import resource_tracker, shared_memory
+from bar_store import BarStore, FIELDS
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+RECORD_DTYPE = np.dtype(
+    [("timestamp", "<i8"), ("retrieved_at", "<i8")] + [(field, "<f8") for field in FIELDS]
+)
+HEADER_WORDS = 8
+HEADER_BYTES = HEADER_WORDS * 8
+SEQ, END, COUNT, CAPACITY, UPDATED_AT, MAGIC = range(6)
+SEGMENT_MAGIC = 0x5354424152530001  # "STBARS" + layout version
+# One regular trading session of 1-minute bars
+DEFAULT_CAPACITY = 390
+DEFAULT_PREFIX = "stocks_bars"
+
+
+def _segment_name(prefix: str, ticker: str) -> str:
+    # POSIX shared-memory names cannot contain "/"; keep them short and portable
+    return f"{prefix}_{re.sub(r'[^A-Za-z0-9]', '_', ticker)}"
+
+
+_tracker_lock = threading.Lock()
+
+
+@contextmanager
+def _untracked():
+    """Keep the resource tracker out of segment bookkeeping on Python < 3.13.
+
+    It would unlink the updater's segments as soon as any reader process exits, and pool
+    workers share their parent's tracker. Segments are unlinked explicitly instead.
+    """
+    with _tracker_lock:
+        register, unregister = resource_tracker.register, resource_tracker.unregister
+        resource_tracker.register = resource_tracker.unregister = lambda *args: None
+        try:
+            yield
+        finally:
+            resource_tracker.register, resource_tracker.unregister = register, unregister
+
+
+def _open(name: str, create: bool = False, size: int = 0) -> shared_memory.SharedMemory:
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, create=create, size=size, track=False)
+    with _untracked():
+        return shared_memory.SharedMemory(name=name, create=create, size=size)
+
+
+def _unlink(shm: shared_memory.SharedMemory):
+    with _untracked():
+        shm.unlink()
+
+
+class _Segment:
+    def __init__(self, shm: shared_memory.SharedMemory):
+        self.shm = shm
+        self.header = np.ndarray((HEADER_WORDS,), dtype=np.uint64, buffer=shm.buf)
+        capacity = int(self.header[CAPACITY])
+        self.records = np.ndarray(
+            (capacity,), dtype=RECORD_DTYPE, buffer=shm.buf, offset=HEADER_BYTES
+        )
+
+    @property
+    def capacity(self) -> int:
+        return len(self.records)
+
+    def _ordered_indices(self, end: int, count: int) -> np.ndarray:
+        return np.arange(end - count, end) % self.capacity
+
+    def read(self, retries: int = 100) -> tuple[np.ndarray, int] | None:
+        """Consistent copy of the bars (oldest first) and the publish time, or None."""
+        for _ in range(retries):
+            seq = int(self.header[SEQ])
+            if seq & 1:
+                time.sleep(0)  # writer active; let it finish
+                continue
+            end, count = int(self.header[END]), int(self.header[COUNT])
+            updated_at = int(self.header[UPDATED_AT])
+            if count > self.capacity or end < count:
+                continue  # torn header, seq will tell
+            records = self.records[self._ordered_indices(end, count)]  # fancy index = copy
+            if int(self.header[SEQ]) == seq:
+                return records, updated_at
+        return None
+
+    def close(self):
+        # Drop the numpy views first, otherwise the buffer cannot be released
+        self.header = self.records = None
+        self.shm.close()
+
+
+class BarCache:
+    """Per-ticker ring buffers of the latest bars in shared memory.
+
+    The updater uses it as writer (`publish`), monitor processes as readers (`read`,
+    `view`). Readers attach to segments lazily and keep them mapped; a ticker whose segment
+    does not exist yet simply reads as None.
+    """
+
+    def __init__(
+        self,
+        prefix: str = DEFAULT_PREFIX,
+        capacity: int = DEFAULT_CAPACITY,
+        max_age: float = 120.0,
+    ):
+        self.prefix = prefix
+        self.capacity = capacity
+        self.max_age = max_age
+        self._segments: dict[str, _Segment] = {}
+        self._owned: set[str] = set()
+
+    # -- writer --------------------------------------------------------------------------
+
+    def _create(self, ticker: str) -> _Segment:
+        name = _segment_name(self.prefix, ticker)
+        size = HEADER_BYTES + self.capacity * RECORD_DTYPE.itemsize
+        try:
+            shm = _open(name, create=True, size=size)
+            np.ndarray((HEADER_WORDS,), dtype=np.uint64, buffer=shm.buf)[:] = 0
+        except FileExistsError:
+            # Left behind by a previous updater run: reuse it when the layout still matches
+            shm = _open(name)
+            header = np.ndarray((HEADER_WORDS,), dtype=np.uint64, buffer=shm.buf)
+            layout_ok = (
+                int(header[MAGIC]) == SEGMENT_MAGIC and int(header[CAPACITY]) == self.capacity
+            )
+            del header
+            if layout_ok:
+                self._owned.add(ticker)
+                return _Segment(shm)
+            _unlink(shm)
+            shm.close()
+            shm = _open(name, create=True, size=size)
+            np.ndarray((HEADER_WORDS,), dtype=np.uint64, buffer=shm.buf)[:] = 0
+
+        header = np.ndarray((HEADER_WORDS,), dtype=np.uint64, buffer=shm.buf)
+        header[CAPACITY] = self.capacity
+        header[MAGIC] = SEGMENT_MAGIC
+        del header
+        self._owned.add(ticker)
+        return _Segment(shm)
+
+    def publish(self, ticker: str, bars: BarStore, retrieved_at_ns: int | None = None):
+        """Merge freshly downloaded bars into the ticker's ring.
+
+        Bars already in the ring keep their retrieved_at (like the database upsert); newer
+        timestamps are appended and the oldest bars fall out once the ring is full.
+        """
+        if not bars:
+            return
+        segment = self._segments.get(ticker)
+        if segment is None or ticker not in self._owned:
+            segment = self._segments[ticker] = self._create(ticker)
+
+        retrieved_at_ns = retrieved_at_ns or time.time_ns()
+        incoming = np.empty(len(bars), dtype=RECORD_DTYPE)
+        incoming["timestamp"] = bars.timestamps
+        incoming["retrieved_at"] = retrieved_at_ns
+        for field in FIELDS:
+            incoming[field] = bars.column(field)
+
+        header, records = segment.header, segment.records
+        end, count = int(header[END]), int(header[COUNT])
+        existing = records[segment._ordered_indices(end, count)]
+
+        # Rewrite the ring from the first bar that is not older than the incoming ones
+        keep = int(np.searchsorted(existing["timestamp"], incoming["timestamp"][0]))
+        tail = existing[keep:]
+        seen = np.isin(incoming["timestamp"], tail["timestamp"])
+        if seen.any():
+            previous = dict(zip(tail["timestamp"].tolist(), tail["retrieved_at"].tolist()))
+            incoming["retrieved_at"][seen] = [
+                previous[ts] for ts in incoming["timestamp"][seen].tolist()
+            ]
+        merged = np.concatenate(
+            [tail[~np.isin(tail["timestamp"], incoming["timestamp"])], incoming]
+        )
+        merged = merged[np.argsort(merged["timestamp"], kind="stable")][-segment.capacity :]
+
+        start = end - count + keep
+        new_end = start + len(merged)
+        new_count = min(segment.capacity, keep + len(merged))
+
+        header[SEQ] += 1  # odd: readers back off
+        records[np.arange(start, new_end) % segment.capacity] = merged
+        header[END] = new_end
+        header[COUNT] = new_count
+        header[UPDATED_AT] = time.time_ns()
+        header[SEQ] += 1  # even: consistent again
+
+    # -- readers -------------------------------------------------------------------------
+
+    def _segment(self, ticker: str) -> _Segment | None:
+        segment = self._segments.get(ticker)
+        if segment is None:
+            try:
+                segment = _Segment(_open(_segment_name(self.prefix, ticker)))
+            except FileNotFoundError:
+                return None
+            if int(segment.header[MAGIC]) != SEGMENT_MAGIC:
+                segment.close()
+                return None
+            self._segments[ticker] = segment
+        return segment
+
+    def view(self, ticker: str) -> tuple[np.ndarray, int] | None:
+        """Zero-copy view of the whole ring and the seq it was taken at.
+
+        Record order is physical, not chronological. Check `unchanged(ticker, seq)` after
+        using the view; if it returns False the data may have been torn.
+        """
+        segment = self._segment(ticker)
+        if segment is None:
+            return None
+        return segment.records, int(segment.header[SEQ])
+
+    def unchanged(self, ticker: str, seq: int) -> bool:
+        segment = self._segments.get(ticker)
+        return segment is not None and not seq & 1 and int(segment.header[SEQ]) == seq
+
+    def read(self, ticker: str, minutes: float | None = None) -> BarStore | None:
+        """The cached bars (optionally only the last N minutes), or None when not usable.
+
+        None means the segment is missing, stale (older than max_age) or kept changing
+        under the reader; callers should fall back to the database.
+        """
+        segment = self._segment(ticker)
+        if segment is None:
+            return None
+        result = segment.read()
+        if result is None:
+            logger.warning(f"Bar cache for {ticker} kept changing while reading.")
+            return None
+        records, updated_at = result
+        now = time.time_ns()
+        if now - updated_at > self.max_age * 1e9:
+            return None
+        if minutes is not None:
+            records = records[records["timestamp"] >= now - int(minutes * 60e9)]
+        return BarStore(
+            records["timestamp"].copy(),
+            {field: np.ascontiguousarray(records[field]) for field in FIELDS},
+            records["retrieved_at"].copy(),
+        )
+
+    def close(self, unlink: bool = False):
+        """Detach from all segments; the writer passes unlink=True to remove its segments."""
+        for ticker, segment in self._segments.items():
+            shm = segment.shm
+            segment.close()
+            if unlink and ticker in self._owned:
+                try:
+                    _unlink(shm)
+                except FileNotFoundError:
+                    pass
+        self._segments.clear()
+        self._owned.clear()
@@ -0,0 +1,138 @@
+import numpy as np
+import pandas as pd
+from market_data import MarketData
+
+# Bar fields held as float64 columns, in the order MarketData takes them
+FIELDS = ("adj_close", "close", "high", "low", "open", "volume")
+# yfinance column name -> BarStore field
+FRAME_COLUMNS = {
+    "Adj Close": "adj_close",
+    "Close": "close",
+    "High": "high",
+    "Low": "low",
+    "Open": "open",
+    "Volume": "volume",
+}
+REQUIRED_COLUMNS = ("Open", "High", "Low", "Close", "Volume")
+
+
+def to_utc_nanoseconds(index) -> np.ndarray:
+    """Convert a DatetimeIndex (naive = UTC) or datetime sequence to int64 ns since the epoch."""
+    index = pd.DatetimeIndex(index)
+    if index.tz is not None:
+        index = index.tz_convert("UTC").tz_localize(None)
+    return index.as_unit("ns").asi8
+
+
+class BarStore:
+    """Columnar bar history for one ticker.
+
+    Timestamps are int64 nanoseconds (UTC) and every price/volume field is a float64 array,
+    all sorted by timestamp. Index -1 is the latest bar, so lagged bars are O(1) lookups.
+    """
+
+    def __init__(
+        self,
+        timestamps: np.ndarray | None = None,
+        columns: dict[str, np.ndarray] | None = None,
+        retrieved_at: np.ndarray | None = None,
+    ):
+        self.timestamps: np.ndarray = (
+            np.empty(0, dtype=np.int64) if timestamps is None else timestamps
+        )
+        columns = columns or {}
+        for field in FIELDS:
+            values = columns.get(field)
+            if values is None:
+                values = np.full(len(self.timestamps), np.nan)
+            setattr(self, field, np.asarray(values, dtype=np.float64))
+        # Only set for bars read back from the database
+        self.retrieved_at: np.ndarray | None = retrieved_at
+
+    @classmethod
+    def from_frame(cls, frame: pd.DataFrame) -> "BarStore":
+        """Build from a single-ticker yfinance frame, dropping bars with missing OHLCV."""
+        if frame.empty:
+            return cls()
+        missing = [column for column in REQUIRED_COLUMNS if column not in frame.columns]
+        if missing:
+            raise KeyError(f"Missing columns {missing}")
+
+        valid = frame[list(REQUIRED_COLUMNS)].notna().all(axis=1).to_numpy()
+        frame = frame[valid]
+        if "Adj Close" not in frame.columns:
+            frame = frame.assign(**{"Adj Close": frame["Close"]})
+
+        timestamps = to_utc_nanoseconds(frame.index)
+        order = np.argsort(timestamps, kind="stable")
+        columns = {
+            field: frame[column].to_numpy(dtype=np.float64)[order]
+            for column, field in FRAME_COLUMNS.items()
+        }
+        return cls(timestamps[order], columns)
+
+    @classmethod
+    def from_rows(cls, rows, retrieved: bool = True) -> "BarStore":
+        """Build from (timestamp, retrieved_at, adj_close, close, high, low, open, volume) rows."""
+        if not rows:
+            return cls()
+        frame = pd.DataFrame(rows, columns=["timestamp", "retrieved_at", *FIELDS]).sort_values(
+            "timestamp", kind="stable"
+        )
+        columns = {field: frame[field].to_numpy(dtype=np.float64) for field in FIELDS}
+        retrieved_at = to_utc_nanoseconds(frame["retrieved_at"]) if retrieved else None
+        return cls(to_utc_nanoseconds(frame["timestamp"]), columns, retrieved_at)
+
+    def __len__(self) -> int:
+        return len(self.timestamps)
+
+    def __bool__(self) -> bool:
+        return len(self.timestamps) > 0
+
+    def column(self, field: str) -> np.ndarray:
+        if field not in FIELDS:
+            raise KeyError(field)
+        return getattr(self, field)
+
+    def latest(self, field: str = "close") -> float:
+        """Value of a field for the newest bar (NaN when empty)."""
+        return self.lag(0, field)
+
+    def lag(self, bars_ago: int, field: str = "close") -> float:
+        """Value of a field bars_ago bars before the newest one (NaN when out of range)."""
+        if bars_ago < 0 or bars_ago >= len(self.timestamps):
+            return float("nan")
+        return float(self.column(field)[-1 - bars_ago])
+
+    def timestamp(self, i: int = -1) -> pd.Timestamp:
+        return pd.Timestamp(self.timestamps[i], unit="ns")
+
+    def index(self) -> pd.DatetimeIndex:
+        """Bar timestamps as a naive UTC DatetimeIndex."""
+        return pd.DatetimeIndex(self.timestamps.view("datetime64[ns]"))
+
+    def bar(self, i: int) -> MarketData:
+        """Materialise one bar as a MarketData object (for logging and the wallet)."""
+        retrieved_at = None
+        if self.retrieved_at is not None:
+            retrieved_at = pd.Timestamp(self.retrieved_at[i], unit="ns").to_pydatetime()
+        return MarketData(
+            self.timestamp(i).to_pydatetime(),
+            *(float(getattr(self, field)[i]) for field in FIELDS),
+            retrieved_at=retrieved_at,
+        )
+
+    def to_frame(self) -> pd.DataFrame:
+        return pd.DataFrame({field: getattr(self, field) for field in FIELDS}, index=self.index())
+
+    @property
+    def nbytes(self) -> int:
+        total = self.timestamps.nbytes + sum(getattr(self, field).nbytes for field in FIELDS)
+        if self.retrieved_at is not None:
+            total += self.retrieved_at.nbytes
+        return total
+
+    def __repr__(self):
+        if not self:
+            return "BarStore(empty)"
+        return f"BarStore({len(self)} bars, {self.timestamp(0)} - {self.timestamp(-1)})"
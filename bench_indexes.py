@@ -0,0 +1,131 @@
+"""Query latency on market_data before and after the migration indexes.
+
+Builds a SQLite database with the pre-index schema (primary key only), times the hot
+queries, applies migrations.migrate() and times them again:
+
+    python bench_indexes.py --rows 10000000
+"""
+import argparse
+import os
+import random
+import sqlite3
+import time
+from datetime import datetime, timedelta
+from sqlalchemy import create_engine
+from migrations import migrate
+
+# market_data exactly as it was before the unique constraint and indexes were added
+OLD_SCHEMA = """
+CREATE TABLE stocks (id INTEGER PRIMARY KEY, ticker VARCHAR(16) NOT NULL UNIQUE);
+CREATE TABLE market_data (
+    id INTEGER PRIMARY KEY,
+    stock_id INTEGER REFERENCES stocks(id),
+    timestamp DATETIME NOT NULL,
+    retrieved_at DATETIME NOT NULL,
+    adj_close FLOAT, close FLOAT, high FLOAT, low FLOAT, open FLOAT, volume FLOAT,
+    rsi FLOAT, macd FLOAT, macd_signal FLOAT, ema_12 FLOAT, ema_26 FLOAT
+);
+"""
+
+START = datetime(2024, 1, 2, 14, 30)
+
+
+def build_database(path: str, rows: int, stocks: int):
+    if os.path.exists(path):
+        os.remove(path)
+    conn = sqlite3.connect(path)
+    conn.executescript(OLD_SCHEMA)
+    conn.executemany(
+        "INSERT INTO stocks (id, ticker) VALUES (?, ?)",
+        [(i, f"T{i:04d}") for i in range(1, stocks + 1)],
+    )
+
+    minutes = rows // stocks
+
+    def generate():
+        # Interleave stocks minute by minute, the way the updater writes them
+        price = 5.0
+        for minute in range(minutes):
+            ts = (START + timedelta(minutes=minute)).isoformat(sep=" ")
+            for stock_id in range(1, stocks + 1):
+                price = max(0.5, price + random.uniform(-0.01, 0.01))
+                yield (stock_id, ts, ts, price, price, price, price, price, 1000.0)
+
+    conn.executemany(
+        "INSERT INTO market_data (stock_id, timestamp, retrieved_at, adj_close, close, high, "
+        "low, open, volume) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        generate(),
+    )
+    conn.commit()
+    conn.close()
+    return minutes
+
+
+def hot_queries(minutes: int, stocks: int) -> dict[str, tuple[str, tuple]]:
+    last = START + timedelta(minutes=minutes - 1)
+    stock_id = stocks // 2 or 1
+    return {
+        "fetch_market_data_from_db (last 5 min, one stock)": (
+            "SELECT * FROM market_data WHERE stock_id = ? AND timestamp >= ? "
+            "ORDER BY timestamp DESC",
+            (stock_id, (last - timedelta(minutes=5)).isoformat(sep=" ")),
+        ),
+        "duplicate check (stock_id, timestamp)": (
+            "SELECT id FROM market_data WHERE stock_id = ? AND timestamp = ? LIMIT 1",
+            (stock_id, last.isoformat(sep=" ")),
+        ),
+        "latest timestamp (indicators)": (
+            "SELECT timestamp FROM market_data ORDER BY timestamp DESC LIMIT 1",
+            (),
+        ),
+        "26 minute window (indicators)": (
+            "SELECT * FROM market_data WHERE timestamp >= ?",
+            ((last - timedelta(minutes=26)).isoformat(sep=" "),),
+        ),
+        "latest timestamp per stock": (
+            "SELECT s.id, (SELECT MAX(timestamp) FROM market_data WHERE stock_id = s.id) "
+            "FROM stocks s",
+            (),
+        ),
+    }
+
+
+def time_queries(path: str, queries: dict, repeat: int) -> dict[str, float]:
+    conn = sqlite3.connect(path)
+    results = {}
+    for name, (sql, params) in queries.items():
+        best = float("inf")
+        for _ in range(repeat):
+            start = time.perf_counter()
+            conn.execute(sql, params).fetchall()
+            best = min(best, time.perf_counter() - start)
+        results[name] = best
+    conn.close()
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=10_000_000)
+    parser.add_argument("--stocks", type=int, default=75)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--path", default="bench_indexes.db")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    minutes = build_database(args.path, args.rows, args.stocks)
+    print(f"Built {minutes * args.stocks:,} rows in {time.perf_counter() - start:.1f}s")
+
+    queries = hot_queries(minutes, args.stocks)
+    before = time_queries(args.path, queries, args.repeat)
+
+    start = time.perf_counter()
+    migrate(create_engine(f"sqlite:///{args.path}"))
+    print(f"Migrations applied in {time.perf_counter() - start:.1f}s")
+
+    after = time_queries(args.path, queries, args.repeat)
+
+    print(f"\n{'query':<52}{'before (ms)':>14}{'after (ms)':>14}{'speedup':>10}")
+    for name in queries:
+        speedup = before[name] / after[name] if after[name] else float("inf")
+        print(f"{name:<52}{before[name] * 1000:>14.2f}{after[name] * 1000:>14.2f}{speedup:>9.0f}x")
@@ -0,0 +1,308 @@
+"""Reproducible benchmarks for the ingestion, storage and decision hot paths.
+
+Synthetic yfinance-shaped frames (FakeProvider) for a configurable number of tickers and
+minutes are pushed through the real code paths against a throwaway SQLite database in a
+temporary directory. Results are written as JSON, and two result files can be compared to
+flag slowdowns:
+
+    python benchmark.py --tickers 75 --minutes 390 --repeat 5 --out bench.json
+    python benchmark.py --compare baseline.json bench.json --threshold 0.15
+
+--compare exits with status 1 when any benchmark's median got slower than the threshold.
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+import numpy as np
+import pandas as pd
+import sqlalchemy
+from logger import logger, setup_logging
+
+DEFAULT_THRESHOLD = 0.10
+
+
+def _git_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def use_database(url: str):
+    """Point every module that uses db_setup.SessionLocal at `url` and create the schema."""
+    import db_setup
+    import stock_db
+    from db_models import Base
+    from migrations import migrate
+
+    config = db_setup.load_db_config()
+    config["url"] = url
+    engine = db_setup.create_db_engine(config)
+    db_setup.engine = engine
+    # Modules imported SessionLocal by name; reconfiguring the shared sessionmaker rebinds all
+    db_setup.SessionLocal.configure(bind=engine)
+    stock_db._stock_ids.clear()
+    Base.metadata.create_all(engine)
+    migrate(engine)
+    return engine
+
+
+class BenchmarkRun:
+    def __init__(self, repeat: int):
+        self.repeat = repeat
+        self.results: dict[str, dict] = {}
+
+    def measure(self, name: str, func, items: int = 1, repeat: int | None = None, setup=None):
+        """Time func() `repeat` times (setup() runs untimed before each call)."""
+        runs = []
+        for _ in range(repeat or self.repeat):
+            if setup is not None:
+                setup()
+            start = time.perf_counter()
+            func()
+            runs.append(time.perf_counter() - start)
+        median = statistics.median(runs)
+        self.results[name] = {
+            "median": median,
+            "min": min(runs),
+            "mean": statistics.fmean(runs),
+            "runs": runs,
+            "items": items,
+            "per_item_us": median / items * 1e6,
+        }
+        print(f"  {name:<28} median {median * 1000:9.2f}ms  ({median / items * 1e6:9.1f}us/item)")
+
+
+def run_benchmarks(tickers: int = 75, minutes: int = 390, repeat: int = 5) -> dict:
+    workdir = tempfile.mkdtemp(prefix="stocks-bench-")
+    cwd = os.getcwd()
+    # The wallet and the trade journal use files in the working directory
+    os.chdir(workdir)
+    try:
+        return _run_benchmarks(workdir, tickers, minutes, repeat)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def _run_benchmarks(workdir: str, n_tickers: int, minutes: int, repeat: int) -> dict:
+    engine = use_database(f"sqlite:///{os.path.join(workdir, 'bench.db')}")
+
+    import data_updater
+    import stock_monitor
+    from bar_cache import BarCache
+    from features import compute as compute_features
+    from indicator_engine import IndicatorEngine
+    from market_provider import FakeProvider, split_frame
+    from stock_db import StockRaw
+    from wallet import VirtualWallet
+
+    # An empty private cache prefix, so the monitor round always reads from the database
+    stock_monitor._bar_cache = BarCache(prefix=f"bench{os.getpid()}")
+    tickers = [f"SYN{i:04d}" for i in range(n_tickers)]
+    provider = FakeProvider()
+    end = datetime.now(timezone.utc).replace(second=0, microsecond=0)
+    frame = provider.download(tickers, end - timedelta(minutes=minutes), end)
+    frames = {ticker: split_frame(frame, ticker) for ticker in tickers}
+    bars = minutes * n_tickers
+    run = BenchmarkRun(repeat)
+    print(f"{n_tickers} tickers x {minutes} minutes ({bars:,} bars), {repeat} runs each")
+
+    run.measure(
+        "provider_download",
+        lambda: provider.download(tickers, end - timedelta(minutes=minutes), end),
+        items=bars,
+    )
+
+    def structure_all():
+        for ticker in tickers:
+            stock = StockRaw(ticker)
+            stock.raw_market_data = frames[ticker]
+            stock.structure_market_data()
+
+    run.measure("structure_market_data", structure_all, items=bars)
+
+    stocks = [StockRaw.from_frame(ticker, frames[ticker]) for ticker in tickers]
+
+    def reset_market_data():
+        with engine.begin() as connection:
+            connection.exec_driver_sql("DELETE FROM market_data")
+
+    def save_all():
+        for stock in stocks:
+            stock.save_to_db()
+
+    run.measure("save_to_db_insert", save_all, items=bars, setup=reset_market_data)
+    run.measure("save_to_db_upsert", save_all, items=bars)
+
+    # The latest three minutes of every ticker, as the updater fetches them each round
+    run.measure(
+        "ingest_round",
+        lambda: data_updater.update_latest_minute_data_batched(tickers, provider),
+        items=n_tickers,
+    )
+
+    # The same round with every module at DEBUG, written to a file by the listener thread
+    level = logger.level
+    setup_logging(os.path.join(workdir, "debug.log"))
+    logger.setLevel(logging.DEBUG)
+    try:
+        run.measure(
+            "ingest_round_debug",
+            lambda: data_updater.update_latest_minute_data_batched(tickers, provider),
+            items=n_tickers,
+        )
+    finally:
+        logger.setLevel(level)
+        setup_logging()
+
+    def fetch_all():
+        for ticker in tickers:
+            StockRaw(ticker).fetch_market_data_from_db()
+
+    run.measure("fetch_market_data_from_db", fetch_all, items=n_tickers)
+
+    def reset_indicators():
+        with engine.begin() as connection:
+            connection.exec_driver_sql("DELETE FROM indicator_state")
+            connection.exec_driver_sql(
+                "UPDATE market_data SET rsi = NULL, macd = NULL, macd_signal = NULL, "
+                "ema_12 = NULL, ema_26 = NULL"
+            )
+
+    # The first run seeds every stock from the warm-up window; later runs are incremental
+    run.measure(
+        "indicators_cold",
+        lambda: IndicatorEngine().run_once(),
+        items=bars,
+        setup=reset_indicators,
+    )
+    run.measure("indicators_incremental", lambda: IndicatorEngine().run_once(), items=n_tickers)
+
+    def reset_wallet():
+        for path in ("wallet.db", "wallet.db-wal", "wallet.db-shm"):
+            if os.path.exists(path):
+                os.remove(path)
+
+    run.measure(
+        "monitor_round",
+        lambda: stock_monitor.monitor_round(tickers),
+        items=n_tickers,
+        setup=reset_wallet,
+    )
+
+    # Uncached: every stock's features from scratch, as when a new bar has just arrived
+    histories = [StockRaw.from_frame(ticker, frames[ticker]).market_data for ticker in tickers]
+    lags = tuple(range(1, 11))
+    run.measure(
+        "features_10_lags",
+        lambda: [compute_features(history, lags) for history in histories],
+        items=n_tickers,
+    )
+
+    wallet = VirtualWallet(filename="missing.json", trade_filename="missing_history.json")
+    snapshot_stock = StockRaw.from_frame(tickers[0], frames[tickers[0]])
+    for i, ticker in enumerate(tickers[:50]):
+        wallet.stocks[ticker] = {"quantity": 10 + i, "buy_price": 5.0}
+        wallet.trailing_stoploss[ticker] = 4.8
+    run.measure("wallet_save", wallet.save_wallet)
+    run.measure("wallet_load", lambda: VirtualWallet(filename="missing.json").close())
+
+    run.measure(
+        "wallet_buy",
+        lambda: wallet.buy_stock(snapshot_stock, minutes_ago=1),
+        setup=lambda: wallet.store.replace_all({"balance": 10000.0}),
+    )
+    wallet.close()
+    stock_monitor._bar_cache = None
+    engine.dispose()
+
+    return {
+        "meta": {
+            "created": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "commit": _git_commit(),
+            "tickers": n_tickers,
+            "minutes": minutes,
+            "repeat": repeat,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "numpy": np.__version__,
+            "pandas": pd.__version__,
+            "sqlalchemy": sqlalchemy.__version__,
+        },
+        "results": run.results,
+    }
+
+
+def compare(old: dict, new: dict, threshold: float = DEFAULT_THRESHOLD) -> list[str]:
+    """Print a comparison table; returns the benchmarks whose median slowed beyond threshold."""
+    regressions = []
+    old_meta, new_meta = old["meta"], new["meta"]
+    if (old_meta["tickers"], old_meta["minutes"]) != (new_meta["tickers"], new_meta["minutes"]):
+        print("warning: the runs used different data sizes; per-item times are compared")
+
+    print(f"{'benchmark':<28} {'old':>12} {'new':>12} {'change':>8}")
+    for name, new_result in new["results"].items():
+        old_result = old["results"].get(name)
+        if old_result is None:
+            print(f"{name:<28} {'-':>12} {new_result['per_item_us']:>10.1f}us   (new)")
+            continue
+        before, after = old_result["per_item_us"], new_result["per_item_us"]
+        change = after / before - 1.0 if before else 0.0
+        flag = ""
+        if change > threshold:
+            flag = "  SLOWER"
+            regressions.append(name)
+        elif change < -threshold:
+            flag = "  faster"
+        print(f"{name:<28} {before:>10.1f}us {after:>10.1f}us {change:>+7.1%}{flag}")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--tickers", type=int, default=75)
+    parser.add_argument("--minutes", type=int, default=390)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--out", help="write results to this JSON file")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"))
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD)
+    parser.add_argument(
+        "--log-level", default="WARNING", help="application log level while timing"
+    )
+    args = parser.parse_args()
+
+    if args.compare:
+        with open(args.compare[0]) as f:
+            old = json.load(f)
+        with open(args.compare[1]) as f:
+            new = json.load(f)
+        slower = compare(old, new, args.threshold)
+        if slower:
+            names = ", ".join(slower)
+            print(f"\n{len(slower)} regression(s) beyond {args.threshold:.0%}: {names}")
+            sys.exit(1)
+        sys.exit(0)
+
+    # Logging every bar would dominate the timings; see --log-level
+    logger.setLevel(getattr(logging, args.log_level.upper()))
+    report = run_benchmarks(args.tickers, args.minutes, args.repeat)
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Results written to {args.out}")
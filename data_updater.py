@@ -1,42 +1,178 @@
+import argparse
 import time
-from datetime import datetime, timedelta, timezone
+from datetime import datetime
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from stock_db import StockRaw as Stock
-from logger import logger
+from market_provider import MarketDataProvider, YahooProvider, FakeProvider
+from indicator_engine import IndicatorEngine
+from bar_cache import BarCache
+from fetch_planner import FetchPlanner, newest_bar
+from logger import get_logger
+import metrics
+
+logger = get_logger(__name__)
 
 tickers = [
     "BIVI", "IMUX", "AUR", "CAPT", "THTX",
     "BHAT", "BLUE", "SILO", "SANA", "AEON", "IFBD",
 ]
 
-def update_latest_minute_data(ticker: str):
-    """Fetch and update the most recent 1-minute candle for the given stock."""
+# Number of tickers requested per provider call in batched mode
+BATCH_SIZE = 50
+
+def update_latest_minute_data(ticker: str, planner: FetchPlanner | None = None):
+    """Fetch and save the 1-minute candles the database is missing for the given stock."""
+    planner = planner or FetchPlanner()
+    ok = True
+    newest = None
     try:
         stock = Stock(ticker)
-        end_time = datetime.now(timezone.utc)
-        start_time = end_time - timedelta(minutes=3)
-        stock.obtain_market_data(start=start_time, end=end_time)
-        stock.save_to_db()
-        logger.info(f"[{ticker}] Latest 1m candle saved.")
+        for request in planner.plan([ticker]):
+            stock.obtain_market_data(start=request.start, end=request.end)
+            ok = stock.save_to_db(late=not request.tail) and ok
+            if request.tail:
+                newest = newest_bar(stock.market_data) or newest
+        logger.info("[%s] Latest 1m candle saved.", ticker)
     except Exception as e:
+        ok = False
         logger.error(f"[{ticker}] Error: {e}")
+    planner.record(ticker, ok, newest)
+
+def update_latest_minute_data_batched(
+    tickers: list[str],
+    provider: MarketDataProvider | None = None,
+    chunk_size: int = BATCH_SIZE,
+    save: bool = True,
+    cache: BarCache | None = None,
+    planner: FetchPlanner | None = None,
+) -> list[Stock]:
+    """Fetch the bars the database is missing for all tickers, in as few requests as possible.
+
+    The FetchPlanner asks only for what is not stored yet (at most chunk_size tickers per
+    request). When a BarCache is given, the newest bars are also published to shared memory
+    for the monitor. Pass the same planner every round so it remembers what was fetched.
+    """
+    provider = provider or YahooProvider()
+    planner = planner or FetchPlanner(provider, batch_size=chunk_size)
+    failed: set[str] = set()
+    stocks: dict[str, Stock] = {}
+    newest: dict[str, datetime] = {}
+
+    for request in planner.plan(tickers):
+        try:
+            frame = provider.download(request.tickers, start=request.start, end=request.end)
+        except Exception as e:
+            logger.error(f"Download of {len(request.tickers)} tickers failed: {e}")
+            failed.update(request.tickers)
+            continue
+        for ticker in request.tickers:
+            try:
+                stock = Stock.from_frame(ticker, frame, provider)
+                if save and not stock.save_to_db(late=not request.tail):
+                    failed.add(ticker)
+                    continue
+                if request.tail:
+                    newest[ticker] = newest_bar(stock.market_data) or newest.get(ticker)
+                    if cache is not None:
+                        cache.publish(ticker, stock.market_data)
+                    stocks[ticker] = stock
+            except Exception as e:
+                logger.error(f"[{ticker}] Error: {e}")
+                failed.add(ticker)
+
+    for ticker in tickers:
+        planner.record(ticker, ticker not in failed, newest.get(ticker))
+    logger.info(f"Saved latest 1m candles for {len(stocks)}/{len(tickers)} tickers.")
+    return list(stocks.values())
+
+def measure_round_latency(
+    provider: MarketDataProvider | None = None,
+    rounds: int = 5,
+    chunk_size: int = BATCH_SIZE,
+    save: bool = False,
+) -> list[float]:
+    """Time a number of batched rounds; defaults to the offline FakeProvider."""
+    provider = provider or FakeProvider()
+    planner = FetchPlanner(provider, batch_size=chunk_size)
+    timings = []
+    for _ in range(rounds):
+        start_time = time.perf_counter()
+        update_latest_minute_data_batched(
+            tickers, provider, chunk_size, save=save, planner=planner
+        )
+        timings.append(time.perf_counter() - start_time)
+    logger.info(
+        f"Batched round latency over {rounds} rounds: "
+        f"min {min(timings) * 1000:.1f}ms, max {max(timings) * 1000:.1f}ms"
+    )
+    return timings
 
 def run_parallel_data_updater():
     """Threaded data updater to download and update stock data as fast as possible."""
-    max_threads = 100 
+    max_threads = 100
+    planner = FetchPlanner()
     logger.info(f"Starting threaded data updater with {max_threads} threads...")
 
     while True:
         start_time = time.time()
 
         with ThreadPoolExecutor(max_workers=max_threads) as executor:
-            futures = [executor.submit(update_latest_minute_data, ticker) for ticker in tickers]
+            futures = [
+                executor.submit(update_latest_minute_data, ticker, planner) for ticker in tickers
+            ]
             for f in as_completed(futures):
-                pass  
+                pass
 
         elapsed = time.time() - start_time
+        metrics.observe("ingest_round", elapsed)
         logger.info(f" Round complete in {elapsed:.2f}s. Sleeping for 15 seconds...\n")
+        metrics.log_summary()
         time.sleep(15)
 
+def run_batched_data_updater(provider: MarketDataProvider | None = None, chunk_size: int = BATCH_SIZE):
+    """Data updater that downloads the whole universe in one (or a few chunked) requests per round."""
+    provider = provider or YahooProvider()
+    indicator_engine = IndicatorEngine()
+    planner = FetchPlanner(provider, batch_size=chunk_size)
+    # Latest bars go to shared memory as well, so the monitor does not have to poll the DB
+    cache = BarCache()
+    logger.info(f"Starting batched data updater ({len(tickers)} tickers, {chunk_size} per request)...")
+
+    try:
+        while True:
+            start_time = time.time()
+            update_latest_minute_data_batched(
+                tickers, provider, chunk_size, cache=cache, planner=planner
+            )
+            indicator_engine.run_once()
+            elapsed = time.time() - start_time
+            metrics.observe("ingest_round", elapsed)
+            logger.info(f" Round complete in {elapsed:.2f}s. Sleeping for 15 seconds...\n")
+            metrics.log_summary()
+            time.sleep(15)
+    finally:
+        planner.checkpoint()
+        cache.close(unlink=True)
+
 if __name__ == "__main__":
-    run_parallel_data_updater()
+    parser = argparse.ArgumentParser(description="Download the latest 1m candles into the database.")
+    parser.add_argument("--threaded", action="store_true", help="one request per ticker (old mode)")
+    parser.add_argument("--rounds", action="store_true", help="fixed 15s rounds of batched requests")
+    parser.add_argument("--bench", action="store_true", help="time batched rounds against FakeProvider")
+    parser.add_argument("--chunk-size", type=int, default=BATCH_SIZE)
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+
+    metrics.start_exporters(args)
+
+    if args.bench:
+        measure_round_latency(chunk_size=args.chunk_size)
+    elif args.threaded:
+        run_parallel_data_updater()
+    elif args.rounds:
+        run_batched_data_updater(chunk_size=args.chunk_size)
+    else:
+        import asyncio
+        from ingest_scheduler import run_scheduled_updater
+
+        asyncio.run(run_scheduled_updater(tickers, batch_size=args.chunk_size))
@@ -1,5 +1,7 @@
-from sqlalchemy import Column, Integer, String, Float, DateTime, ForeignKey, create_engine
-from sqlalchemy.orm import declarative_base, relationship, sessionmaker
+from sqlalchemy import (
+    BigInteger, Column, Integer, String, Float, DateTime, ForeignKey, Index, UniqueConstraint,
+)
+from sqlalchemy.orm import declarative_base, relationship
 from datetime import datetime
 
 Base = declarative_base()
@@ -18,6 +20,10 @@ class  Stock(Base):
 
 class MarketData(Base):
     __tablename__ = 'market_data'
+    __table_args__ = (
+        # One bar per stock per minute; the upsert in StockRaw.save_to_db conflicts on this
+        UniqueConstraint('stock_id', 'timestamp', name='uq_market_data_stock_timestamp'),
+    )
 
     id = Column(Integer, primary_key=True)
     
@@ -43,19 +49,93 @@ class MarketData(Base):
         return f"<MarketData(stock_id={self.stock_id}, timestamp={self.timestamp}, close={self.close})>"
 
 
-engine = create_engine('sqlite:///stock_data.db', echo=False)
+# Global "newest bar" lookups and time-window scans in indicators.py
+Index('ix_market_data_timestamp', MarketData.timestamp)
+# Covering index for "latest bar per stock": answers price/volume reads without touching the table
+Index(
+    'ix_market_data_stock_latest',
+    MarketData.stock_id,
+    MarketData.timestamp.desc(),
+    MarketData.close,
+    MarketData.volume,
+)
 
 
-SessionLocal = sessionmaker(bind=engine)
+class IndicatorState(Base):
+    """Running EMA/MACD/RSI state per stock, so the indicator engine can resume after a restart."""
+    __tablename__ = 'indicator_state'
+
+    stock_id = Column(Integer, ForeignKey('stocks.id'), primary_key=True)
+    last_timestamp = Column(DateTime, nullable=False)
+    last_close = Column(Float, nullable=False)
+    bar_count = Column(Integer, nullable=False, default=0)
+    ema_12 = Column(Float)
+    ema_26 = Column(Float)
+    macd_signal = Column(Float)
+    avg_gain = Column(Float)
+    avg_loss = Column(Float)
+    updated_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+
+    def __repr__(self):
+        return f"<IndicatorState(stock_id={self.stock_id}, last_timestamp={self.last_timestamp})>"
+
+
+class JobCheckpoint(Base):
+    """Resume position of a long-running batch job, keyed by job name."""
+    __tablename__ = 'job_checkpoints'
+
+    name = Column(String(64), primary_key=True)
+    stock_id = Column(Integer)
+    timestamp = Column(DateTime)
+    updated_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+
+    def __repr__(self):
+        return f"<JobCheckpoint(name={self.name}, stock_id={self.stock_id}, timestamp={self.timestamp})>"
+
+
+class MarketDataRollup(Base):
+    """OHLCV aggregates of market_data per resolution ('5m', '1h', '1d'), built by rollups.py."""
+    __tablename__ = 'market_data_rollup'
+
+    resolution = Column(String(8), primary_key=True)
+    stock_id = Column(Integer, ForeignKey('stocks.id'), primary_key=True)
+    bucket = Column(DateTime, primary_key=True)
+    open = Column(Float)
+    high = Column(Float)
+    low = Column(Float)
+    close = Column(Float)
+    adj_close = Column(Float)
+    volume = Column(Float)
+    bar_count = Column(Integer, nullable=False)
+    updated_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+
+    def __repr__(self):
+        return (
+            f"<MarketDataRollup(resolution={self.resolution}, stock_id={self.stock_id}, "
+            f"bucket={self.bucket}, close={self.close})>"
+        )
+
+
+class MarketSnapshot(Base):
+    """One polled quote: last price and cumulative session volume, written by snapshot_store.py.
+
+    Kept narrow and clustered on its key (no rowid on SQLite), so a micro-batch of snapshots
+    is one append to the b-tree and a (stock, time range) read is a single range scan.
+    """
+    __tablename__ = 'market_snapshots'
+    __table_args__ = {'sqlite_with_rowid': False}
+
+    stock_id = Column(Integer, ForeignKey('stocks.id'), primary_key=True, autoincrement=False)
+    # Nanoseconds since the epoch (UTC), the same representation BarStore uses
+    ts = Column(BigInteger, primary_key=True, autoincrement=False)
+    price = Column(Float, nullable=False)
+    volume = Column(Float)
+
+    def __repr__(self):
+        return f"<MarketSnapshot(stock_id={self.stock_id}, ts={self.ts}, price={self.price})>"
 
-def init_db():
-    """Function to create tables based on the defined models"""
-    try:
-        Base.metadata.create_all(engine)  # This will create the tables in the database
-        print("Database tables created successfully!")
-    except Exception as e:
-        print(f"Error creating tables: {e}")
-        raise
 
+# The engine and sessions live in db_setup (configured via env or db_config.json)
 if __name__ == '__main__':
+    from db_setup import init_db
     init_db()
@@ -1,18 +1,109 @@
-from sqlalchemy import create_engine
+import json
+import os
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine
 from sqlalchemy.orm import sessionmaker
 from db_models import Base  # Your ORM models
 from sqlalchemy.exc import SQLAlchemyError
 
-SQLALCHEMY_DATABASE_URL = (
-  "mssql+pyodbc://@DESKTOP-7Q8DA2Q\\SQLEXPRESS/stock_db?driver=ODBC+Driver+18+for+SQL+Server&Trusted_Connection=yes&TrustServerCertificate=yes")
+# Settings are read from the defaults below, then db_config.json (or the file named by
+# STOCKS_DB_CONFIG), then STOCKS_DB_* environment variables; later sources win.
+# SQL Server example:
+#   STOCKS_DATABASE_URL="mssql+pyodbc://@DESKTOP-7Q8DA2Q\SQLEXPRESS/stock_db?driver=ODBC+Driver+18+for+SQL+Server&Trusted_Connection=yes&TrustServerCertificate=yes"
+DEFAULT_CONFIG = {
+    "url": "sqlite:///stock_data.db",
+    "echo": False,
+    # data_updater runs up to 100 threads; pool_size + max_overflow covers all of them
+    "pool_size": 20,
+    "max_overflow": 80,
+    "pool_timeout": 30,
+    "pool_recycle": 1800,
+    "pool_pre_ping": True,
+    "sqlite_busy_timeout_ms": 5000,
+    "sqlite_wal": True,
+    "sqlite_synchronous": "NORMAL",
+}
 
-engine = create_engine(SQLALCHEMY_DATABASE_URL, echo=True)
+ENV_PREFIX = "STOCKS_DB_"
+CONFIG_FILE_ENV = "STOCKS_DB_CONFIG"
+
+
+def _parse(value: str, default):
+    if isinstance(default, bool):
+        return value.strip().lower() in ("1", "true", "yes", "on")
+    if isinstance(default, int):
+        return int(value)
+    return value
+
+
+def load_db_config(path: str | None = None) -> dict:
+    """Merge the defaults, the optional JSON config file and STOCKS_DB_* env overrides."""
+    config = dict(DEFAULT_CONFIG)
+
+    path = path or os.environ.get(CONFIG_FILE_ENV, "db_config.json")
+    if os.path.exists(path):
+        with open(path, "r") as f:
+            config.update(json.load(f))
+
+    if "STOCKS_DATABASE_URL" in os.environ:
+        config["url"] = os.environ["STOCKS_DATABASE_URL"]
+    for key, default in DEFAULT_CONFIG.items():
+        value = os.environ.get(ENV_PREFIX + key.upper())
+        if value is not None:
+            config[key] = _parse(value, default)
+    return config
+
+
+def _tune_sqlite(engine: Engine, config: dict):
+    in_memory = engine.url.database in (None, "", ":memory:")
+
+    @event.listens_for(engine, "connect")
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        # Wait for the write lock instead of failing with "database is locked"
+        cursor.execute(f"PRAGMA busy_timeout = {int(config['sqlite_busy_timeout_ms'])}")
+        if config["sqlite_wal"] and not in_memory:
+            # Readers no longer block the writer (and vice versa)
+            cursor.execute("PRAGMA journal_mode = WAL")
+        cursor.execute(f"PRAGMA synchronous = {config['sqlite_synchronous']}")
+        cursor.close()
+
+
+def create_db_engine(config: dict | None = None) -> Engine:
+    """Create the engine for the configured database, with pooling and SQLite tuning."""
+    config = config or load_db_config()
+    url = config["url"]
+    kwargs = {"echo": config["echo"], "pool_pre_ping": config["pool_pre_ping"]}
+
+    if url.startswith("sqlite"):
+        # Sessions hop between threads in the updater; SQLite serialises writes itself
+        kwargs["connect_args"] = {
+            "check_same_thread": False,
+            "timeout": config["sqlite_busy_timeout_ms"] / 1000,
+        }
+    if not url.startswith("sqlite") or ":memory:" not in url:
+        kwargs.update(
+            pool_size=config["pool_size"],
+            max_overflow=config["max_overflow"],
+            pool_timeout=config["pool_timeout"],
+            pool_recycle=config["pool_recycle"],
+        )
+
+    engine = create_engine(url, **kwargs)
+    if engine.dialect.name == "sqlite":
+        _tune_sqlite(engine, config)
+    return engine
+
+
+engine = create_db_engine()
 
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 def init_db():
     try:
         Base.metadata.create_all(bind=engine)
+        from migrations import migrate
+        migrate(engine)  # Record the schema version so later migrations know where to start
         print("Database tables created successfully!")
     except SQLAlchemyError as e:
         print(f"Error creating tables: {e}")
@@ -0,0 +1,136 @@
+"""Price and volume features of a BarStore as of its newest bar.
+
+One call computes every requested lag with a handful of NumPy gathers over the bar arrays,
+instead of one Python round trip per lag and field:
+
+* price_change(lag) / volume_change(lag): the one-bar change that ended `lag` bars ago
+  (lag 1 is the newest bar against the one before it), as Stock.get_price_movement and
+  get_change_in_volume have always computed it;
+* price_return(lag) / volume_return(lag): the change over the last `lag` bars;
+* volatility: standard deviation of the one-bar returns over the last `window` bars;
+* volume_zscore: the newest bar's volume against the `window` bars before it.
+
+Changes are rounded to 6 decimals and are 0.0 when either value is zero, like the rules have
+always used them; lags the history is too short for are NaN (every comparison is False).
+"""
+import numpy as np
+from bar_store import BarStore
+
+DEFAULT_LAGS = (1, 2, 3, 5, 10)
+DEFAULT_WINDOW = 20
+
+
+def _spread(values: np.ndarray) -> float:
+    """Sample standard deviation (np.std with ddof=1, without its per-call overhead)."""
+    deviations = values - values.mean()
+    return float(np.sqrt(deviations @ deviations / (values.size - 1)))
+
+
+class Features:
+    __slots__ = (
+        "lags",
+        "bars",
+        "close",
+        "volatility",
+        "volume_zscore",
+        "_position",
+        "price_changes",
+        "volume_changes",
+        "price_returns",
+        "volume_returns",
+    )
+
+    def __init__(self, bars: BarStore, lags: tuple[int, ...], window: int):
+        self.lags = lags
+        self.bars = n = len(bars)
+        self._position = {lag: i for i, lag in enumerate(lags)}
+        close, volume = bars.close, bars.volume
+        self.close = float(close[-1]) if n else float("nan")
+
+        lag_array = np.asarray(lags, dtype=np.intp)
+        # Every lag needs two bars
+        if n < 2:
+            empty = np.full(lag_array.size, np.nan)
+            self.price_changes = self.volume_changes = empty
+            self.price_returns = self.volume_returns = empty
+            self.volatility = self.volume_zscore = float("nan")
+            return
+
+        valid = lag_array < n
+        # Short histories gather from valid positions and are masked to NaN afterwards
+        lag_array = np.minimum(lag_array, n - 1)
+        # Bar `lag` back against the one before it, then the newest bar against `lag` back
+        newer = np.concatenate((n - lag_array, np.full(lag_array.size, n - 1)))
+        older = np.concatenate((n - 1 - lag_array, n - 1 - lag_array))
+        new = np.vstack((close[newer], volume[newer]))
+        old = np.vstack((close[older], volume[older]))
+        recent = close[-window - 1 :]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            changes = np.round((new - old) / old, 6)
+            returns = np.diff(recent) / recent[:-1]
+        changes[(new == 0) | (old == 0)] = 0.0
+        changes[:, np.concatenate((~valid, ~valid))] = np.nan
+        k = valid.size
+        self.price_changes, self.price_returns = changes[0, :k], changes[0, k:]
+        self.volume_changes, self.volume_returns = changes[1, :k], changes[1, k:]
+
+        returns[recent[:-1] == 0] = 0.0
+        self.volatility = _spread(returns) if returns.size > 1 else float("nan")
+        previous = volume[-window - 1 : -1]
+        if previous.size > 1:
+            spread = _spread(previous)
+            self.volume_zscore = float((volume[-1] - previous.mean()) / spread) if spread else 0.0
+        else:
+            self.volume_zscore = float("nan")
+
+    def _at(self, values: np.ndarray, lag: int) -> float:
+        return float(values[self._position[lag]])
+
+    def price_change(self, lag: int) -> float:
+        return self._at(self.price_changes, lag)
+
+    def volume_change(self, lag: int) -> float:
+        return self._at(self.volume_changes, lag)
+
+    def price_return(self, lag: int) -> float:
+        return self._at(self.price_returns, lag)
+
+    def volume_return(self, lag: int) -> float:
+        return self._at(self.volume_returns, lag)
+
+    def has(self, lag: int) -> bool:
+        """Whether the history reaches `lag` bars back."""
+        return lag < self.bars
+
+    def __repr__(self):
+        return f"Features({self.bars} bars, lags={self.lags}, close={self.close})"
+
+
+def compute(
+    bars: BarStore,
+    lags: tuple[int, ...] = DEFAULT_LAGS,
+    window: int = DEFAULT_WINDOW,
+    cache: dict | None = None,
+) -> Features:
+    """Features of bars, taken from `cache` when they were computed for the same bars before.
+
+    The cache (one dict per stock) is emptied as soon as the bars change.
+    """
+    n = len(bars)
+    newest = None
+    if n:
+        newest = (int(bars.timestamps[-1]), float(bars.close[-1]), float(bars.volume[-1]))
+    # A new bar changes the length; a re-downloaded partial bar changes its close or volume
+    state = (id(bars), n, newest)
+    if cache is not None:
+        if cache.get("state") != state:
+            cache.clear()
+            cache["state"] = state
+        elif (lags, window) in cache:
+            return cache[lags, window]
+    if any(lag < 1 for lag in lags):
+        raise ValueError(f"Lags start at 1 (the newest bar), got {lags}")
+    result = Features(bars, lags, window)
+    if cache is not None:
+        cache[lags, window] = result
+    return result
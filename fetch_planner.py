@@ -0,0 +1,302 @@
+"""Plan provider requests from what is already stored, instead of re-downloading a fixed window.
+
+For every ticker the planner keeps a "verified" mark: the newest bar its last successful tail
+fetch stored, so everything before it has been downloaded at least once (minutes still missing
+there had no trades). A download that returns nothing does not move the mark, since yfinance
+reports most failures as an empty frame. Marks are checkpointed in job_checkpoints. A plan
+asks, per ticker, for
+
+* the tail: from the newest stored bar (which may have been partial) or the minute before
+  the verified mark, whichever is later, up to now. After downtime this picks up everything
+  that was missed, back to the provider's history limit;
+* gaps: missing minutes inside the stored history that was written without a verified mark
+  (the first run, or bars saved by other paths). Gaps less than a few hours apart are
+  coalesced into one range.
+
+Ranges are cut to the provider's maximum span per request, and tickers that need nearly the
+same range share one request.
+
+    python fetch_planner.py [--tickers BIVI,AUR]      # print the plan for the next round
+"""
+import argparse
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+import numpy as np
+from sqlalchemy import func, select
+from db_models import JobCheckpoint, MarketData, Stock
+from db_setup import SessionLocal
+from bar_store import BarStore
+from logger import get_logger
+from market_provider import MarketDataProvider
+
+logger = get_logger(__name__)
+
+JOB_PREFIX = "fetch_planner:"
+MINUTE = timedelta(minutes=1)
+
+
+def _floor_minute(value: datetime) -> datetime:
+    return value.replace(second=0, microsecond=0)
+
+
+def _utc(value: datetime) -> datetime:
+    return value.replace(tzinfo=timezone.utc)
+
+
+class FetchRequest:
+    """One provider call: bars of `tickers` in [start, end), as timezone-aware UTC datetimes."""
+
+    __slots__ = ("tickers", "start", "end", "tail")
+
+    def __init__(self, tickers: list[str], start: datetime, end: datetime, tail: bool):
+        self.tickers = tickers
+        self.start = start
+        self.end = end
+        # Tail requests end at "now"; the others fill gaps in older history
+        self.tail = tail
+
+    @property
+    def minutes(self) -> float:
+        return (self.end - self.start) / MINUTE
+
+    def __repr__(self):
+        kind = "tail" if self.tail else "gap"
+        return (
+            f"<FetchRequest({kind}, {len(self.tickers)} tickers, "
+            f"{self.start:%Y-%m-%d %H:%M} - {self.end:%Y-%m-%d %H:%M})>"
+        )
+
+
+def newest_bar(bars: BarStore) -> datetime | None:
+    """Timestamp of the newest bar as a naive UTC datetime, like the stored ones."""
+    return bars.timestamp(-1).to_pydatetime() if bars else None
+
+
+def latest_timestamps(session, tickers: list[str]) -> dict[str, datetime]:
+    """Newest stored bar per ticker, in one grouped query (tickers without bars are left out)."""
+    rows = session.execute(
+        select(Stock.ticker, func.max(MarketData.timestamp))
+        .join(MarketData, MarketData.stock_id == Stock.id)
+        .where(Stock.ticker.in_(tickers))
+        .group_by(Stock.ticker)
+    ).all()
+    return {ticker: latest for ticker, latest in rows if latest is not None}
+
+
+def find_gaps(
+    session, since: dict[str, datetime], coalesce: timedelta = timedelta(hours=6)
+) -> dict[str, list[tuple[datetime, datetime]]]:
+    """Missing minutes between stored bars after since[ticker], as [start, end) ranges.
+
+    Gaps with at most `coalesce` of stored bars between them are merged: another request
+    costs more than downloading a few hundred bars twice.
+    """
+    if not since:
+        return {}
+    rows = session.execute(
+        select(Stock.ticker, MarketData.timestamp)
+        .join(MarketData, MarketData.stock_id == Stock.id)
+        .where(Stock.ticker.in_(since))
+        .where(MarketData.timestamp >= min(since.values()))
+        .order_by(Stock.ticker, MarketData.timestamp)
+    ).all()
+    timestamps: dict[str, list[datetime]] = {}
+    for ticker, timestamp in rows:
+        if timestamp >= since[ticker]:
+            timestamps.setdefault(ticker, []).append(timestamp)
+
+    gaps = {}
+    for ticker, values in timestamps.items():
+        stamps = np.array(values, dtype="datetime64[us]")
+        missing = np.flatnonzero(np.diff(stamps) > np.timedelta64(1, "m"))
+        ranges: list[tuple[datetime, datetime]] = []
+        for i in missing.tolist():
+            start, end = values[i] + MINUTE, values[i + 1]
+            if ranges and start - ranges[-1][1] <= coalesce:
+                ranges[-1] = (ranges[-1][0], end)
+            else:
+                ranges.append((start, end))
+        if ranges:
+            gaps[ticker] = ranges
+    return gaps
+
+
+class FetchPlanner:
+    """Turns "which tickers are due" into the fewest provider requests for their missing bars.
+
+    Call plan() with the due tickers, run the requests, then record() every ticker's outcome;
+    only successful tickers advance their verified mark, and only up to the bars they stored.
+    """
+
+    def __init__(
+        self,
+        provider: MarketDataProvider | None = None,
+        backfill: timedelta = timedelta(days=1),
+        overlap: timedelta = MINUTE,
+        coalesce: timedelta = timedelta(hours=6),
+        slack: timedelta = timedelta(minutes=5),
+        batch_size: int = 50,
+        checkpoint_interval: float = 300.0,
+    ):
+        limits = provider or MarketDataProvider
+        self.max_span: timedelta = limits.max_request_span
+        self.max_history: timedelta = limits.max_history
+        # History requested for a ticker that has no bars and no mark yet
+        self.backfill = backfill
+        self.overlap = overlap
+        self.coalesce = coalesce
+        # Tickers whose ranges start and end within `slack` of each other share a request
+        self.slack = slack
+        self.batch_size = batch_size
+        self.checkpoint_interval = checkpoint_interval
+        self.verified: dict[str, datetime] = {}
+        self.requests = 0
+        self.requested_minutes = 0.0
+        self._planned: dict[str, datetime] = {}
+        self._loaded: set[str] = set()
+        self._dirty: set[str] = set()
+        self._last_checkpoint = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _load_marks(self, session, tickers: list[str]):
+        missing = [ticker for ticker in tickers if ticker not in self._loaded]
+        if not missing:
+            return
+        names = {JOB_PREFIX + ticker: ticker for ticker in missing}
+        for checkpoint in session.query(JobCheckpoint).filter(JobCheckpoint.name.in_(names)):
+            if checkpoint.timestamp is not None:
+                self.verified.setdefault(names[checkpoint.name], checkpoint.timestamp)
+        self._loaded.update(missing)
+
+    def plan(self, tickers: list[str], now: datetime | None = None) -> list[FetchRequest]:
+        """Requests covering every bar the given tickers are missing up to now (UTC)."""
+        now = now or datetime.utcnow()
+        # The provider rejects ranges that reach past its history limit
+        horizon = _floor_minute(now - self.max_history) + MINUTE
+        session = SessionLocal()
+        try:
+            with self._lock:
+                self._load_marks(session, tickers)
+                verified = {ticker: self.verified.get(ticker) for ticker in tickers}
+            latest = latest_timestamps(session, tickers)
+            unverified = {
+                ticker: max(verified[ticker] or horizon, horizon)
+                for ticker, last in latest.items()
+                if verified[ticker] is None or verified[ticker] < last
+            }
+            gaps = find_gaps(session, unverified, self.coalesce)
+        finally:
+            session.close()
+
+        ranges = []
+        for ticker in tickers:
+            mark, last = verified[ticker], latest.get(ticker)
+            if mark is None and last is None:
+                start = now - self.backfill
+            else:
+                candidates = [last, _floor_minute(mark) - self.overlap if mark else None]
+                start = max(value for value in candidates if value is not None)
+            ranges.append((max(start, horizon), now, ticker, True))
+            for gap_start, gap_end in gaps.get(ticker, ()):
+                if max(gap_start, horizon) < gap_end:
+                    ranges.append((max(gap_start, horizon), gap_end, ticker, False))
+
+        requests = self._group(ranges)
+        with self._lock:
+            for ticker in tickers:
+                self._planned[ticker] = now
+            self.requests += len(requests)
+            self.requested_minutes += sum(r.minutes * len(r.tickers) for r in requests)
+        logger.debug(
+            "Planned %d requests (%d gap ranges) for %d tickers",
+            len(requests),
+            sum(map(len, gaps.values())),
+            len(tickers),
+        )
+        return requests
+
+    def _group(self, ranges: list[tuple]) -> list[FetchRequest]:
+        grouped: list[FetchRequest] = []
+        for tail in (True, False):
+            current = None
+            for start, end, ticker, _ in sorted(r for r in ranges if r[3] is tail):
+                if (
+                    current is not None
+                    and start - current.start <= self.slack
+                    and abs(end - current.end) <= self.slack
+                    and len(current.tickers) < self.batch_size
+                    and ticker not in current.tickers
+                ):
+                    current.tickers.append(ticker)
+                    current.end = max(current.end, end)
+                else:
+                    current = FetchRequest([ticker], start, end, tail)
+                    grouped.append(current)
+
+        requests = []
+        for request in grouped:
+            start = request.start
+            while start < request.end:
+                end = min(start + self.max_span, request.end)
+                requests.append(
+                    FetchRequest(request.tickers, _utc(start), _utc(end), request.tail)
+                )
+                start = end
+        return requests
+
+    def record(self, ticker: str, ok: bool, newest: datetime | None = None):
+        """Report whether every planned request for the ticker was fetched and stored.
+
+        newest is the newest bar the tail requests stored (None when they returned nothing).
+        """
+        with self._lock:
+            planned = self._planned.pop(ticker, None)
+            mark = self.verified.get(ticker)
+            if (
+                ok
+                and planned is not None
+                and newest is not None
+                and (mark is None or newest > mark)
+            ):
+                self.verified[ticker] = min(newest, planned)
+                self._dirty.add(ticker)
+            due = time.monotonic() - self._last_checkpoint >= self.checkpoint_interval
+        if due:
+            self.checkpoint()
+
+    def checkpoint(self):
+        """Persist the verified marks that changed since the last checkpoint."""
+        with self._lock:
+            marks = {ticker: self.verified[ticker] for ticker in self._dirty}
+            self._dirty.clear()
+            self._last_checkpoint = time.monotonic()
+        if not marks:
+            return
+        session = SessionLocal()
+        try:
+            for ticker, mark in marks.items():
+                session.merge(
+                    JobCheckpoint(
+                        name=JOB_PREFIX + ticker, timestamp=mark, updated_at=datetime.utcnow()
+                    )
+                )
+            session.commit()
+        except Exception as e:
+            logger.error(f"Could not checkpoint fetch marks: {e}")
+            session.rollback()
+            with self._lock:
+                self._dirty.update(marks)
+        finally:
+            session.close()
+
+
+if __name__ == "__main__":
+    from data_updater import tickers
+
+    parser = argparse.ArgumentParser(description="Show the requests the next round would make.")
+    parser.add_argument("--tickers", help="comma-separated (default: the updater's list)")
+    args = parser.parse_args()
+
+    for request in FetchPlanner().plan(args.tickers.split(",") if args.tickers else tickers):
+        print(f"{request!r}: {', '.join(request.tickers)}")
@@ -0,0 +1,210 @@
+"""Fill rsi/macd/macd_signal/ema_12/ema_26 for the whole market_data history.
+
+Streams bars in (stock_id, timestamp) order, computes the indicators per chunk with
+grouped vectorised operations and bulk-updates them. Progress is checkpointed in
+job_checkpoints together with the per-stock state in indicator_state, so an interrupted
+run resumes where it stopped and the streaming IndicatorEngine continues afterwards.
+
+    python indicator_backfill.py [--chunk-size 200000] [--restart]
+    python indicator_backfill.py --archive bar_archive [--tickers AAPL MSFT]
+
+Stop the data updater while a backfill runs; both write indicator_state. With --archive the
+indicator columns of the Parquet archive are recomputed from the archive alone, one ticker
+at a time in partition order, without touching the database.
+"""
+import argparse
+import time
+from datetime import datetime
+import numpy as np
+import pandas as pd
+from sqlalchemy import delete
+from db_models import IndicatorState, JobCheckpoint
+from db_setup import SessionLocal
+from indicator_engine import StreamingIndicators
+from indicators import calculate_indicators_grouped
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+JOB_NAME = "indicator_backfill"
+INDICATOR_COLUMNS = ["rsi", "macd", "macd_signal", "ema_12", "ema_26"]
+
+UPDATE_SQL = (
+    "UPDATE market_data SET rsi = ?, macd = ?, macd_signal = ?, ema_12 = ?, ema_26 = ? "
+    "WHERE id = ?"
+)
+CHUNK_SQL = (
+    "SELECT id, stock_id, timestamp, close FROM market_data "
+    "WHERE timestamp < ? AND close IS NOT NULL AND "
+    "(stock_id > ? OR (stock_id = ? AND timestamp > ?)) "
+    "ORDER BY stock_id, timestamp"
+)
+
+
+def _limit(sql: str, dialect: str, chunk_size: int) -> str:
+    if dialect == "mssql":
+        return sql.replace("SELECT ", f"SELECT TOP {chunk_size} ", 1)
+    return f"{sql} LIMIT {chunk_size}"
+
+
+def _param(value: datetime, dialect: str):
+    # Match SQLAlchemy's SQLite storage format, or string comparison drops/repeats bars
+    if dialect == "sqlite":
+        return value.strftime("%Y-%m-%d %H:%M:%S.%f")
+    return value
+
+
+def _to_datetime(value) -> datetime:
+    # SQLite hands back the raw ISO string when queried through the driver
+    return pd.Timestamp(value).to_pydatetime()
+
+
+def _load_checkpoint(session) -> tuple[int, datetime]:
+    checkpoint = session.get(JobCheckpoint, JOB_NAME)
+    if checkpoint is None:
+        return -1, datetime.min
+    return checkpoint.stock_id, checkpoint.timestamp
+
+
+def _save_progress(session, stock_id: int, timestamp: datetime, states: list[StreamingIndicators]):
+    session.merge(
+        JobCheckpoint(
+            name=JOB_NAME, stock_id=stock_id, timestamp=timestamp, updated_at=datetime.utcnow()
+        )
+    )
+    for state in states:
+        session.merge(IndicatorState(**state.to_row()))
+
+
+def _rows_for_update(result: pd.DataFrame, ids: np.ndarray) -> list[tuple]:
+    values = result[INDICATOR_COLUMNS].astype(object)
+    values = values.where(result[INDICATOR_COLUMNS].notna(), None)
+    values["id"] = ids.tolist()
+    return list(values.itertuples(index=False, name=None))
+
+
+def _states_from_result(data: pd.DataFrame, result: pd.DataFrame) -> list[StreamingIndicators]:
+    last = data.groupby("stock_id", sort=False).tail(1).index
+    states = []
+    for i in last:
+        state = StreamingIndicators(int(data.at[i, "stock_id"]))
+        state.last_timestamp = _to_datetime(data.at[i, "timestamp"])
+        state.last_close = float(data.at[i, "close"])
+        state.bar_count = int(result.at[i, "bar_count"])
+        state.ema_12 = float(result.at[i, "ema_12"])
+        state.ema_26 = float(result.at[i, "ema_26"])
+        state.macd_signal = float(result.at[i, "macd_signal"])
+        for column in ("avg_gain", "avg_loss"):
+            value = result.at[i, column]
+            setattr(state, column, None if pd.isna(value) else float(value))
+        states.append(state)
+    return states
+
+
+def backfill(chunk_size: int = 200_000, restart: bool = False) -> int:
+    """Run (or resume) the backfill; returns the number of bars updated in this run."""
+    session = SessionLocal()
+    dialect = session.get_bind().dialect.name
+    chunk_sql = _limit(CHUNK_SQL, dialect, chunk_size)
+    # Bars from the still-forming minute are left to the streaming engine
+    closed_before = datetime.utcnow().replace(second=0, microsecond=0)
+    total = 0
+    started = time.perf_counter()
+
+    try:
+        if restart:
+            session.execute(delete(JobCheckpoint).where(JobCheckpoint.name == JOB_NAME))
+            session.commit()
+
+        last_stock_id, last_timestamp = _load_checkpoint(session)
+        seeds: dict[int, StreamingIndicators] = {}
+        if last_stock_id >= 0:
+            row = session.get(IndicatorState, last_stock_id)
+            if row is not None:
+                seeds[last_stock_id] = StreamingIndicators.from_row(row)
+            logger.info(f"Resuming backfill after stock {last_stock_id} at {last_timestamp}")
+
+        while True:
+            connection = session.connection()
+            rows = connection.exec_driver_sql(
+                chunk_sql,
+                (
+                    _param(closed_before, dialect),
+                    last_stock_id,
+                    last_stock_id,
+                    _param(last_timestamp, dialect),
+                ),
+            ).fetchall()
+            if not rows:
+                break
+
+            data = pd.DataFrame(rows, columns=["id", "stock_id", "timestamp", "close"])
+            result = calculate_indicators_grouped(data, seeds)
+
+            connection.exec_driver_sql(UPDATE_SQL, _rows_for_update(result, data["id"].to_numpy()))
+            states = _states_from_result(data, result)
+            last_stock_id = int(data["stock_id"].iloc[-1])
+            last_timestamp = _to_datetime(data["timestamp"].iloc[-1])
+            _save_progress(session, last_stock_id, last_timestamp, states)
+            session.commit()
+
+            # Only the last stock of a chunk can continue in the next one
+            seeds = {state.stock_id: state for state in states if state.stock_id == last_stock_id}
+            total += len(data)
+            elapsed = time.perf_counter() - started
+            logger.info(
+                f"Backfilled {total} bars ({total / elapsed:,.0f} bars/s), "
+                f"at stock {last_stock_id} {last_timestamp}"
+            )
+
+        logger.info(f"Backfill complete: {total} bars in {time.perf_counter() - started:.1f}s")
+        return total
+    except Exception as e:
+        logger.error(f"Backfill failed, rerun to resume from the last checkpoint: {e}")
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+
+def backfill_archive(root: str, tickers: list[str] | None = None) -> int:
+    """Recompute the indicator columns of archived days; returns the number of bars updated."""
+    import archive
+
+    total = 0
+    started = time.perf_counter()
+    for ticker in tickers or archive.archived_tickers(root):
+        # Each ticker runs through its days in order; stock_id 0 stands in for the ticker
+        seeds: dict[int, StreamingIndicators] = {}
+        for key in archive.partitions(root, ticker):
+            frame = archive.read_partition(root, ticker, key)
+            valid = frame["close"].notna().to_numpy()
+            data = frame.loc[valid, ["timestamp", "close"]].reset_index(drop=True)
+            if data.empty:
+                continue
+            data.insert(0, "stock_id", 0)
+            result = calculate_indicators_grouped(data, seeds)
+            for column in INDICATOR_COLUMNS:
+                values = np.full(len(frame), np.nan)
+                values[valid] = result[column].to_numpy(dtype=np.float64)
+                frame[column] = values
+            archive.write_partition(root, ticker, key, frame)
+            seeds = {0: state for state in _states_from_result(data, result)}
+            total += len(data)
+        logger.info(f"Backfilled archived indicators for {ticker} ({total} bars so far)")
+
+    logger.info(f"Archive backfill complete: {total} bars in {time.perf_counter() - started:.1f}s")
+    return total
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--chunk-size", type=int, default=200_000)
+    parser.add_argument("--restart", action="store_true", help="ignore the saved checkpoint")
+    parser.add_argument("--archive", metavar="ROOT", help="backfill the Parquet archive instead")
+    parser.add_argument("--tickers", nargs="*", help="with --archive: only these tickers")
+    args = parser.parse_args()
+    if args.archive:
+        backfill_archive(args.archive, args.tickers)
+    else:
+        backfill(args.chunk_size, args.restart)
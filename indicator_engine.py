@@ -0,0 +1,251 @@
+from datetime import datetime, timedelta
+from sqlalchemy import and_, or_, update
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from db_models import IndicatorState, MarketData
+from db_setup import SessionLocal
+import late_bars
+from logger import get_logger
+from metrics import timed
+
+logger = get_logger(__name__)
+
+FAST_PERIOD = 12
+SLOW_PERIOD = 26
+SIGNAL_PERIOD = 9
+RSI_WINDOW = 14
+
+STATE_COLUMNS = [
+    "last_timestamp",
+    "last_close",
+    "bar_count",
+    "ema_12",
+    "ema_26",
+    "macd_signal",
+    "avg_gain",
+    "avg_loss",
+]
+
+
+def ema_alpha(span: int) -> float:
+    """Smoothing factor used by pandas ewm(span=..., adjust=False)."""
+    return 2.0 / (span + 1)
+
+
+def rsi_from_averages(avg_gain: float, avg_loss: float) -> float:
+    if avg_loss == 0:
+        return 100.0 if avg_gain > 0 else 50.0
+    return 100.0 - 100.0 / (1.0 + avg_gain / avg_loss)
+
+
+class StreamingIndicators:
+    """EMA-12/26, MACD signal and Wilder RSI for one stock, updated in O(1) per bar.
+
+    EMAs match pandas ewm(adjust=False) seeded with the first close; RSI uses Wilder's
+    smoothing (alpha = 1/14) seeded with the first gain/loss and is reported once 14
+    price changes have been seen.
+    """
+
+    def __init__(self, stock_id: int):
+        self.stock_id = stock_id
+        self.last_timestamp: datetime | None = None
+        self.last_close: float | None = None
+        self.bar_count = 0
+        self.ema_12: float | None = None
+        self.ema_26: float | None = None
+        self.macd_signal: float | None = None
+        self.avg_gain: float | None = None
+        self.avg_loss: float | None = None
+
+    @classmethod
+    def from_row(cls, row: IndicatorState) -> "StreamingIndicators":
+        state = cls(row.stock_id)
+        for column in STATE_COLUMNS:
+            setattr(state, column, getattr(row, column))
+        return state
+
+    def to_row(self) -> dict:
+        row = {column: getattr(self, column) for column in STATE_COLUMNS}
+        row["stock_id"] = self.stock_id
+        row["updated_at"] = datetime.utcnow()
+        return row
+
+    def update(self, timestamp: datetime, close: float) -> dict:
+        """Fold in one closed bar and return its indicator values."""
+        if self.bar_count == 0:
+            self.ema_12 = self.ema_26 = close
+            self.macd_signal = 0.0
+        else:
+            a_fast, a_slow, a_signal = (
+                ema_alpha(FAST_PERIOD),
+                ema_alpha(SLOW_PERIOD),
+                ema_alpha(SIGNAL_PERIOD),
+            )
+            self.ema_12 += a_fast * (close - self.ema_12)
+            self.ema_26 += a_slow * (close - self.ema_26)
+            self.macd_signal += a_signal * ((self.ema_12 - self.ema_26) - self.macd_signal)
+
+            delta = close - self.last_close
+            gain, loss = max(delta, 0.0), max(-delta, 0.0)
+            if self.bar_count == 1:
+                self.avg_gain, self.avg_loss = gain, loss
+            else:
+                self.avg_gain += (gain - self.avg_gain) / RSI_WINDOW
+                self.avg_loss += (loss - self.avg_loss) / RSI_WINDOW
+
+        self.bar_count += 1
+        self.last_close = close
+        self.last_timestamp = timestamp
+
+        rsi = None
+        if self.bar_count > RSI_WINDOW:
+            rsi = rsi_from_averages(self.avg_gain, self.avg_loss)
+        return {
+            "rsi": rsi,
+            "macd": self.ema_12 - self.ema_26,
+            "macd_signal": self.macd_signal,
+            "ema_12": self.ema_12,
+            "ema_26": self.ema_26,
+        }
+
+
+class IndicatorEngine:
+    """Keeps StreamingIndicators per stock and fills the indicator columns of new bars.
+
+    Only closed bars are processed (the current minute is still being re-downloaded).
+    Stocks without saved state start from the bars inside the warm-up window. Stocks with
+    late bars (gap fills behind their state, see late_bars) are restarted the same way from
+    the warm-up window before the oldest late bar, and rewritten from that bar on.
+    """
+
+    def __init__(self, warmup: timedelta = timedelta(days=1)):
+        self.warmup = warmup
+        self.states: dict[int, StreamingIndicators] = {}
+        self.loaded = False
+
+    def load_states(self, session):
+        self.states = {
+            row.stock_id: StreamingIndicators.from_row(row)
+            for row in session.query(IndicatorState).all()
+        }
+        self.loaded = True
+        logger.info(f"Loaded indicator state for {len(self.states)} stocks.")
+
+    def _new_bars(self, session, closed_before: datetime):
+        """All closed bars after each stock's last processed bar, in one query."""
+        cutoff = closed_before - self.warmup
+        return (
+            session.query(
+                MarketData.id, MarketData.stock_id, MarketData.timestamp, MarketData.close
+            )
+            .outerjoin(IndicatorState, IndicatorState.stock_id == MarketData.stock_id)
+            .filter(MarketData.timestamp < closed_before)
+            .filter(MarketData.close.isnot(None))
+            .filter(
+                or_(
+                    and_(
+                        IndicatorState.stock_id.is_(None),
+                        MarketData.timestamp >= cutoff,
+                    ),
+                    MarketData.timestamp > IndicatorState.last_timestamp,
+                )
+            )
+            .order_by(MarketData.stock_id, MarketData.timestamp)
+            .all()
+        )
+
+    def _replay_bars(self, session, late: dict, closed_before: datetime):
+        """Closed bars of stocks with late marks, from the warm-up window before each mark."""
+        return (
+            session.query(
+                MarketData.id, MarketData.stock_id, MarketData.timestamp, MarketData.close
+            )
+            .filter(MarketData.timestamp < closed_before)
+            .filter(MarketData.close.isnot(None))
+            .filter(
+                or_(
+                    *(
+                        and_(
+                            MarketData.stock_id == stock_id,
+                            MarketData.timestamp >= since - self.warmup,
+                        )
+                        for stock_id, (since, _) in late.items()
+                    )
+                )
+            )
+            .order_by(MarketData.stock_id, MarketData.timestamp)
+            .all()
+        )
+
+    def _save_states(self, session, stock_ids: set[int]):
+        rows = [self.states[stock_id].to_row() for stock_id in stock_ids]
+        if not rows:
+            return
+        if session.get_bind().dialect.name == "sqlite":
+            stmt = sqlite_insert(IndicatorState)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[IndicatorState.stock_id],
+                set_={column: stmt.excluded[column] for column in STATE_COLUMNS + ["updated_at"]},
+            )
+            session.execute(stmt, rows)
+        else:
+            for row in rows:
+                session.merge(IndicatorState(**row))
+
+    def update(self, session, now: datetime | None = None) -> int:
+        """Process every new closed bar for all stocks; returns the number of bars updated."""
+        if not self.loaded:
+            self.load_states(session)
+
+        now = now or datetime.utcnow()
+        closed_before = now.replace(second=0, microsecond=0)
+        bars = self._new_bars(session, closed_before)
+        late = late_bars.pending(session, "indicators")
+        # Late bars' values are rewritten; the bars before them only warm the state up
+        write_from: dict[int, datetime] = {}
+        if late:
+            replay = self._replay_bars(session, late, closed_before)
+            replayed = {stock_id for _, stock_id, _, _ in replay}
+            bars = [bar for bar in bars if bar[1] not in replayed] + replay
+            for stock_id in replayed:
+                self.states.pop(stock_id, None)
+                write_from[stock_id] = late[stock_id][0]
+        if not bars:
+            late_bars.clear(session, "indicators", late)
+            session.commit()
+            return 0
+
+        updates = []
+        touched = set()
+        for bar_id, stock_id, timestamp, close in bars:
+            state = self.states.get(stock_id)
+            if state is None:
+                state = self.states[stock_id] = StreamingIndicators(stock_id)
+            values = state.update(timestamp, close)
+            touched.add(stock_id)
+            if stock_id in write_from and timestamp < write_from[stock_id]:
+                continue
+            values["id"] = bar_id
+            updates.append(values)
+
+        # Bulk UPDATE by primary key: one executemany for the whole round
+        if updates:
+            session.execute(update(MarketData), updates)
+        self._save_states(session, touched)
+        late_bars.clear(session, "indicators", late)
+        session.commit()
+        logger.info(f"Updated indicators for {len(updates)} bars across {len(touched)} stocks.")
+        return len(updates)
+
+    @timed("indicator_update")
+    def run_once(self) -> int:
+        session = SessionLocal()
+        try:
+            return self.update(session)
+        except Exception as e:
+            logger.error(f"Indicator update failed: {e}")
+            session.rollback()
+            # Drop in-memory state that may have advanced past what was committed
+            self.loaded = False
+            return 0
+        finally:
+            session.close()
@@ -1,9 +1,14 @@
 import pandas as pd
 import numpy as np
-from sqlalchemy.orm import Session
-from db_models import MarketData
-from db_setup import SessionLocal
-from datetime import datetime, timedelta
+from indicator_engine import (
+    FAST_PERIOD,
+    RSI_WINDOW,
+    SIGNAL_PERIOD,
+    SLOW_PERIOD,
+    IndicatorEngine,
+    StreamingIndicators,
+    ema_alpha,
+)
 
 def calculate_rsi(data, window=14):
     delta = data['close'].diff()
@@ -39,59 +44,96 @@ def calculate_ema(data, fast_period=12, slow_period=26):
     return data
 
 
+def _grouped_ewm(values: pd.Series, groups: pd.Series, alpha: float) -> pd.Series:
+    """ewm(adjust=False) restarted per group; leading NaNs in a group are skipped."""
+    return (
+        values.groupby(groups, sort=False)
+        .ewm(alpha=alpha, adjust=False)
+        .mean()
+        .reset_index(level=0, drop=True)
+        .sort_index()
+    )
+
+
+def calculate_indicators_grouped(
+    data: pd.DataFrame, seeds: dict[int, StreamingIndicators] | None = None
+) -> pd.DataFrame:
+    """Vectorised EMA/MACD/Wilder RSI for many stocks at once.
+
+    data holds stock_id and close sorted by (stock_id, timestamp). seeds carries the
+    StreamingIndicators of stocks whose earlier bars were already processed, so the result
+    continues exactly where the streaming engine (or a previous chunk) left off. Besides the
+    indicator columns the result has avg_gain, avg_loss and bar_count for rebuilding state.
+    """
+    seeds = {stock_id: s for stock_id, s in (seeds or {}).items() if s.bar_count > 0}
+    frame = data[["stock_id", "close"]].reset_index(drop=True)
+    frame["is_seed"] = False
+    frame["ema_12_in"] = frame["ema_26_in"] = frame["close"]
+    frame["signal_in"] = np.nan
+    frame["gain_in"] = frame["loss_in"] = np.nan
+    frame["base_count"] = 0
+
+    if seeds:
+        # One synthetic row per seeded stock, placed before its first real bar
+        seed_rows = pd.DataFrame(
+            [
+                {
+                    "stock_id": stock_id,
+                    "close": state.last_close,
+                    "is_seed": True,
+                    "ema_12_in": state.ema_12,
+                    "ema_26_in": state.ema_26,
+                    "signal_in": state.macd_signal,
+                    "gain_in": np.nan if state.avg_gain is None else state.avg_gain,
+                    "loss_in": np.nan if state.avg_loss is None else state.avg_loss,
+                    "base_count": state.bar_count,
+                }
+                for stock_id, state in seeds.items()
+                if stock_id in set(frame["stock_id"])
+            ]
+        )
+        if not seed_rows.empty:
+            frame = pd.concat([seed_rows, frame], ignore_index=True)
+            frame = frame.sort_values(["stock_id", "is_seed"], ascending=[True, False], kind="stable")
+            frame = frame.reset_index(drop=True)
+
+    groups = frame["stock_id"]
+    frame["ema_12"] = _grouped_ewm(frame["ema_12_in"], groups, ema_alpha(FAST_PERIOD))
+    frame["ema_26"] = _grouped_ewm(frame["ema_26_in"], groups, ema_alpha(SLOW_PERIOD))
+    frame["macd"] = frame["ema_12"] - frame["ema_26"]
+    frame["signal_in"] = frame["signal_in"].where(frame["is_seed"], frame["macd"])
+    frame["macd_signal"] = _grouped_ewm(frame["signal_in"], groups, ema_alpha(SIGNAL_PERIOD))
+
+    delta = frame.groupby("stock_id", sort=False)["close"].diff()
+    gains = frame["gain_in"].where(frame["is_seed"], delta.clip(lower=0))
+    losses = frame["loss_in"].where(frame["is_seed"], (-delta).clip(lower=0))
+    frame["avg_gain"] = _grouped_ewm(gains, groups, 1.0 / RSI_WINDOW)
+    frame["avg_loss"] = _grouped_ewm(losses, groups, 1.0 / RSI_WINDOW)
+
+    base_count = frame.groupby("stock_id", sort=False)["base_count"].transform("max")
+    real = ~frame["is_seed"]
+    frame["bar_count"] = base_count + real.groupby(frame["stock_id"], sort=False).cumsum()
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        rsi = 100.0 - 100.0 / (1.0 + frame["avg_gain"] / frame["avg_loss"])
+    rsi = rsi.where(frame["avg_loss"] != 0, np.where(frame["avg_gain"] > 0, 100.0, 50.0))
+    frame["rsi"] = rsi.where(frame["bar_count"] > RSI_WINDOW)
+
+    result = frame.loc[real, ["rsi", "macd", "macd_signal", "ema_12", "ema_26"]]
+    result[["avg_gain", "avg_loss", "bar_count"]] = frame.loc[
+        real, ["avg_gain", "avg_loss", "bar_count"]
+    ]
+    result.index = data.index
+    return result
+
+
 def calculate_indicators_for_last_minute():
-    # Start a session to interact with the database
-    session = SessionLocal()
-
-    # Get the most recent timestamp (last minute)
-    latest_timestamp = session.query(MarketData.timestamp).order_by(MarketData.timestamp.desc()).first()
-    if not latest_timestamp:
-        print("No data found in the database.")
-        return
-    
-    latest_timestamp = latest_timestamp[0]
-    start_time = latest_timestamp - timedelta(minutes=26)
-    market_data = session.query(MarketData).filter(MarketData.timestamp >= start_time).all()
-
-    if len(market_data) < 26:
-        print("Not enough data to calculate indicators (missing data). Trying to forward-fill missing data.")
-        missing_minutes = 26 - len(market_data)
-        last_data_point = market_data[-1] if market_data else None
-        if last_data_point:
-            for _ in range(missing_minutes):
-                market_data.append(last_data_point)
-        else:
-            print("Cannot forward-fill as there's no available data.")
-            return
-
-    data = pd.DataFrame([(d.timestamp, d.close, d.stock_id) for d in market_data], columns=["timestamp", "close", "stock_id"])
-
-    data['rsi'] = calculate_rsi(data, window=14)  # RSI requires at least 14 periods
-    data = calculate_macd(data)  # MACD requires at least 26 periods
-    data = calculate_ema(data)  # EMA requires at least 26 periods
-
-    if len(data) < 14:  
-        prev_day_data = session.query(MarketData).filter(MarketData.timestamp < latest_timestamp).order_by(MarketData.timestamp.desc()).limit(14).all()
-        prev_day_data = pd.DataFrame([(d.timestamp, d.close, d.stock_id) for d in prev_day_data], columns=["timestamp", "close", "stock_id"])
-        data = pd.concat([prev_day_data, data])
-
-    last_record = data.iloc[-1] 
-    stock_id = last_record['stock_id']
-    timestamp = last_record['timestamp']
-
-    # Fetch the market data record that corresponds to the most recent minute
-    market_data_record = session.query(MarketData).filter_by(stock_id=stock_id, timestamp=timestamp).first()
-    if market_data_record:
-        market_data_record.rsi = last_record['rsi']
-        market_data_record.macd = last_record['macd']
-        market_data_record.macd_signal = last_record['macd_signal']
-        market_data_record.ema_12 = last_record['ema_12']
-        market_data_record.ema_26 = last_record['ema_26']
-
-        # Commit the changes to the database
-        session.commit()
-
-    session.close()
+    """Fill rsi/macd/macd_signal/ema_12/ema_26 for every stock's new closed bars.
+
+    State is kept per stock in indicator_state, so each call only touches bars that arrived
+    since the previous one instead of recomputing a mixed 26-minute window.
+    """
+    return IndicatorEngine().run_once()
 
 
 if __name__ == "__main__":
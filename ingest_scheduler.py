@@ -0,0 +1,378 @@
+"""asyncio ingestion scheduler for the data updater.
+
+Every ticker has its own next-due time in a heap instead of the whole universe moving in
+lock-step rounds. A FetchPlanner turns the tickers that come due together into batched
+requests for just the bars the database is missing.
+Concurrency is capped by a semaphore, provider calls go through a token bucket, failures
+back off exponentially (with jitter) per ticker, and tickers that keep returning no new bar
+are polled less often until they do. Provider calls run in threads via asyncio.to_thread;
+database writes go to a dedicated thread pool so they never block the event loop.
+
+    python ingest_scheduler.py [--interval 15] [--concurrency 4] [--rate 2] [--fake]
+"""
+import argparse
+import asyncio
+import heapq
+import random
+import time
+from collections.abc import Awaitable, Callable
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from bar_cache import BarCache
+from fetch_planner import FetchPlanner, newest_bar
+from indicator_engine import IndicatorEngine
+import metrics
+from logger import get_logger
+from market_provider import FakeProvider, MarketDataProvider, YahooProvider
+import rollups
+from stock_db import StockRaw as Stock
+
+logger = get_logger(__name__)
+
+NANOSECONDS_PER_SECOND = 1_000_000_000
+
+
+class TokenBucket:
+    """Allow `rate` acquisitions per second on average, with bursts of up to `capacity`."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def pause(self, seconds: float):
+        """Stop handing out tokens for a while (the provider said we are rate limited)."""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0.0
+
+    async def acquire(self, tokens: float = 1.0):
+        while True:
+            now = time.monotonic()
+            if now < self.paused_until:
+                await asyncio.sleep(self.paused_until - now)
+                continue
+            self._refill(now)
+            if self.tokens >= tokens:
+                self.tokens -= tokens
+                return
+            await asyncio.sleep((tokens - self.tokens) / self.rate)
+
+
+class TickerState:
+    __slots__ = (
+        "ticker",
+        "interval",
+        "failures",
+        "fetches",
+        "errors",
+        "last_bar_ns",
+        "last_bar",
+        "last_lag",
+    )
+
+    def __init__(self, ticker: str, interval: float):
+        self.ticker = ticker
+        self.interval = interval
+        self.failures = 0
+        self.fetches = 0
+        self.errors = 0
+        self.last_bar_ns: int | None = None
+        # (timestamp, close, volume) of the newest bar, to tell whether a fetch brought news
+        self.last_bar: tuple | None = None
+        # Freshness lag measured right after the last successful fetch, in seconds
+        self.last_lag: float | None = None
+
+    def lag(self, now_ns: int) -> float | None:
+        """Seconds since the minute of the newest stored bar started."""
+        if self.last_bar_ns is None:
+            return None
+        return (now_ns - self.last_bar_ns) / NANOSECONDS_PER_SECOND
+
+
+def _is_rate_limit(error: Exception) -> bool:
+    text = f"{type(error).__name__} {error}".lower()
+    markers = ("ratelimit", "rate limit", "too many requests", "429")
+    return any(marker in text for marker in markers)
+
+
+class IngestScheduler:
+    def __init__(
+        self,
+        tickers: list[str],
+        provider: MarketDataProvider | None = None,
+        interval: float = 15.0,
+        max_interval: float = 120.0,
+        concurrency: int = 4,
+        rate: float = 2.0,
+        burst: int = 4,
+        batch_size: int = 50,
+        planner: FetchPlanner | None = None,
+        max_backoff: float = 300.0,
+        db_workers: int = 4,
+        save: bool = True,
+        cache: BarCache | None = None,
+        on_bar: Callable[[str], Awaitable[None]] | None = None,
+    ):
+        self.provider = provider or YahooProvider()
+        self.interval = interval
+        self.max_interval = max_interval
+        self.batch_size = batch_size
+        # Decides which range each due ticker still needs, instead of a fixed lookback
+        self.planner = planner or FetchPlanner(self.provider, batch_size=batch_size)
+        self.max_backoff = max_backoff
+        self.save = save
+        self.cache = cache
+        # Awaited with the ticker after a fetch that brought a new or updated bar; awaiting
+        # it (e.g. a full queue) holds that ticker back, which is the backpressure
+        self.on_bar = on_bar
+        self.concurrency = concurrency
+        self.bucket = TokenBucket(rate, burst)
+        self.db_pool = ThreadPoolExecutor(max_workers=db_workers, thread_name_prefix="ingest-db")
+        self.states = {ticker: TickerState(ticker, interval) for ticker in tickers}
+        now = time.monotonic()
+        # (due, sequence, ticker); the sequence keeps ordering stable for equal due times
+        self._heap = [(now, i, ticker) for i, ticker in enumerate(tickers)]
+        heapq.heapify(self._heap)
+        self._sequence = len(tickers)
+        self._tasks: set[asyncio.Task] = set()
+
+    def _schedule(self, ticker: str, delay: float):
+        self._sequence += 1
+        heapq.heappush(self._heap, (time.monotonic() + delay, self._sequence, ticker))
+
+    def _backoff(self, state: TickerState) -> float:
+        # Full jitter keeps failing tickers from retrying in sync
+        ceiling = min(self.max_backoff, self.interval * 2**state.failures)
+        return random.uniform(self.interval, max(self.interval, ceiling))
+
+    def _persist(self, stock: Stock, tail: bool):
+        # Gap fills land behind the indicator and rollup watermarks
+        if self.save and not stock.save_to_db(late=not tail):
+            raise RuntimeError("database write failed")
+        if tail and self.cache is not None:
+            self.cache.publish(stock.ticker, stock.market_data)
+
+    async def _fetch_batch(self, batch: list[str], semaphore: asyncio.Semaphore):
+        loop = asyncio.get_running_loop()
+        try:
+            requests = await loop.run_in_executor(self.db_pool, self.planner.plan, batch)
+        except Exception as e:
+            for ticker in batch:
+                self._failed(ticker, e)
+            return
+
+        failed: dict[str, Exception] = {}
+        newest: dict[str, Stock] = {}
+        stored: dict[str, datetime] = {}
+        for request in requests:
+            tickers = [ticker for ticker in request.tickers if ticker not in failed]
+            if not tickers:
+                continue
+            async with semaphore:
+                await self.bucket.acquire()
+                try:
+                    frame = await asyncio.to_thread(
+                        self.provider.download, tickers, request.start, request.end
+                    )
+                except Exception as e:
+                    if _is_rate_limit(e):
+                        self.bucket.pause(self.interval * 2)
+                    failed.update(dict.fromkeys(tickers, e))
+                    continue
+
+            for ticker in tickers:
+                try:
+                    stock = Stock.from_frame(ticker, frame, self.provider)
+                    await loop.run_in_executor(self.db_pool, self._persist, stock, request.tail)
+                except Exception as e:
+                    failed[ticker] = e
+                    continue
+                if request.tail:
+                    newest[ticker] = stock
+                    stored[ticker] = newest_bar(stock.market_data) or stored.get(ticker)
+
+        for ticker in batch:
+            self.planner.record(ticker, ticker not in failed, stored.get(ticker))
+            if ticker in failed:
+                self._failed(ticker, failed[ticker])
+                continue
+            stock = newest.get(ticker) or Stock(ticker, self.provider)
+            if self._succeeded(ticker, stock) and self.on_bar is not None:
+                await self.on_bar(ticker)
+
+    def _succeeded(self, ticker: str, stock: Stock) -> bool:
+        state = self.states[ticker]
+        state.fetches += 1
+        state.failures = 0
+        bars = stock.market_data
+        newest = None
+        if bars:
+            newest = (int(bars.timestamps[-1]), bars.latest("close"), bars.latest("volume"))
+        changed = newest is not None and newest != state.last_bar
+        if changed:
+            state.last_bar = newest
+            state.last_bar_ns = newest[0]
+            state.interval = self.interval
+        else:
+            # Nothing changed (illiquid ticker, market closed): poll it less often
+            state.interval = min(self.max_interval, state.interval * 1.5)
+        state.last_lag = state.lag(time.time_ns())
+        self._schedule(ticker, state.interval)
+        return changed
+
+    def _failed(self, ticker: str, error: Exception):
+        state = self.states[ticker]
+        state.errors += 1
+        state.failures += 1
+        delay = self._backoff(state)
+        logger.warning(f"[{ticker}] fetch failed ({error}); retrying in {delay:.1f}s")
+        self._schedule(ticker, delay)
+
+    def _due_batches(self) -> list[list[str]]:
+        now = time.monotonic()
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            due.append(heapq.heappop(self._heap)[2])
+        return [due[i : i + self.batch_size] for i in range(0, len(due), self.batch_size)]
+
+    def freshness(self) -> dict[str, float | None]:
+        """Current freshness lag per ticker in seconds (None until its first bar)."""
+        now_ns = time.time_ns()
+        return {ticker: state.lag(now_ns) for ticker, state in self.states.items()}
+
+    def metrics(self) -> dict:
+        lags = np.array([lag for lag in self.freshness().values() if lag is not None])
+        return {
+            "tickers": len(self.states),
+            "fresh": int(lags.size),
+            "lag_p50": float(np.percentile(lags, 50)) if lags.size else None,
+            "lag_p95": float(np.percentile(lags, 95)) if lags.size else None,
+            "lag_max": float(lags.max()) if lags.size else None,
+            "fetches": sum(state.fetches for state in self.states.values()),
+            "errors": sum(state.errors for state in self.states.values()),
+            "backing_off": sum(state.failures > 0 for state in self.states.values()),
+            "requests": self.planner.requests,
+            "requested_minutes": self.planner.requested_minutes,
+        }
+
+    def log_metrics(self):
+        m = self.metrics()
+        for key in ("lag_p50", "lag_p95", "lag_max"):
+            if m[key] is not None:
+                metrics.set_gauge(
+                    "freshness_lag_seconds",
+                    m[key],
+                    "Age of the newest bar across tickers.",
+                    stat=key.removeprefix("lag_"),
+                )
+        for key in ("fetches", "errors", "backing_off", "requests", "requested_minutes"):
+            metrics.set_gauge(f"ingest_{key}", m[key])
+        metrics.log_summary()
+        if m["fresh"]:
+            lags = self.freshness()
+            worst = sorted((lag, ticker) for ticker, lag in lags.items() if lag is not None)[-3:]
+            logger.info(
+                f"Freshness lag p50 {m['lag_p50']:.1f}s, p95 {m['lag_p95']:.1f}s, "
+                f"max {m['lag_max']:.1f}s over {m['fresh']}/{m['tickers']} tickers "
+                f"(worst: {', '.join(f'{t} {lag:.0f}s' for lag, t in reversed(worst))}); "
+                f"{m['fetches']} fetches, {m['errors']} errors, {m['backing_off']} backing off"
+            )
+        else:
+            logger.info(f"No bars yet for {m['tickers']} tickers; {m['errors']} errors")
+
+    async def run(self, stop: asyncio.Event | None = None):
+        """Fetch tickers as they come due until `stop` is set."""
+        stop = stop or asyncio.Event()
+        semaphore = asyncio.Semaphore(self.concurrency)
+        logger.info(
+            f"Starting ingest scheduler for {len(self.states)} tickers "
+            f"(every {self.interval}s, {self.concurrency} concurrent, {self.bucket.rate}/s)"
+        )
+        try:
+            while not stop.is_set():
+                for batch in self._due_batches():
+                    task = asyncio.create_task(self._fetch_batch(batch, semaphore))
+                    self._tasks.add(task)
+                    task.add_done_callback(self._tasks.discard)
+
+                # Sleep until the next ticker is due (tickers in flight re-enter the heap later)
+                timeout = self._heap[0][0] - time.monotonic() if self._heap else self.interval
+                try:
+                    await asyncio.wait_for(stop.wait(), timeout=max(0.05, min(timeout, 1.0)))
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            for task in self._tasks:
+                task.cancel()
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+            self.planner.checkpoint()
+            self.db_pool.shutdown(wait=True)
+
+
+async def _run_periodically(func, interval: float, stop: asyncio.Event, executor=None):
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        try:
+            await asyncio.wait_for(stop.wait(), timeout=interval)
+        except asyncio.TimeoutError:
+            await loop.run_in_executor(executor, func)
+
+
+async def run_scheduled_updater(
+    tickers: list[str],
+    provider: MarketDataProvider | None = None,
+    stop: asyncio.Event | None = None,
+    metrics_interval: float = 60.0,
+    rollup_interval: float = 60.0,
+    **kwargs,
+):
+    """Run the scheduler with the indicator engine, the rollups and freshness logging."""
+    stop = stop or asyncio.Event()
+    cache = BarCache()
+    scheduler = IngestScheduler(tickers, provider, cache=cache, **kwargs)
+    indicator_engine = IndicatorEngine()
+    try:
+        await asyncio.gather(
+            scheduler.run(stop),
+            _run_periodically(indicator_engine.run_once, scheduler.interval, stop),
+            _run_periodically(rollups.run_once, rollup_interval, stop),
+            _run_periodically(scheduler.log_metrics, metrics_interval, stop),
+        )
+    finally:
+        cache.close(unlink=True)
+
+
+if __name__ == "__main__":
+    from data_updater import tickers
+
+    parser = argparse.ArgumentParser(description="Run the asyncio ingestion scheduler.")
+    parser.add_argument("--interval", type=float, default=15.0)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--rate", type=float, default=2.0, help="provider requests per second")
+    parser.add_argument("--batch-size", type=int, default=50)
+    parser.add_argument("--fake", action="store_true", help="use the offline FakeProvider")
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+
+    metrics.start_exporters(args)
+    provider = FakeProvider() if args.fake else None
+    try:
+        asyncio.run(
+            run_scheduled_updater(
+                tickers,
+                provider,
+                interval=args.interval,
+                concurrency=args.concurrency,
+                rate=args.rate,
+                batch_size=args.batch_size,
+            )
+        )
+    except KeyboardInterrupt:
+        pass
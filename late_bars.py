@@ -0,0 +1,65 @@
+"""Marks for bars written behind the indicator engine's and the rollups' watermarks.
+
+Both jobs only look forward from where they got to, so bars that a gap request fills in
+further back would never get indicators or reach the rollups. Saving such bars records, per
+stock and job, the oldest timestamp written ("late since") in job_checkpoints, in the same
+transaction as the bars. Each job reads its marks, reprocesses from there and then clears
+exactly the marks it read: a mark that was lowered or touched again meanwhile stays for
+the next run.
+"""
+from datetime import datetime
+from sqlalchemy import and_, delete, or_
+from db_models import JobCheckpoint
+
+JOBS = ("indicators", "rollups")
+PREFIX = "late_bars:"
+
+
+def _name(job: str, stock_id: int) -> str:
+    return f"{PREFIX}{job}:{stock_id}"
+
+
+def mark(session, stock_id: int, since: datetime):
+    """Record that bars from `since` on were (re)written for the stock; caller commits."""
+    now = datetime.utcnow()
+    for job in JOBS:
+        checkpoint = session.get(JobCheckpoint, _name(job, stock_id))
+        if checkpoint is None:
+            session.add(
+                JobCheckpoint(
+                    name=_name(job, stock_id), stock_id=stock_id, timestamp=since, updated_at=now
+                )
+            )
+        else:
+            checkpoint.timestamp = min(checkpoint.timestamp, since)
+            # A new updated_at keeps a job that read the old mark from clearing this one
+            checkpoint.updated_at = now
+
+
+def pending(session, job: str) -> dict[int, tuple[datetime, datetime]]:
+    """The job's uncleared marks: stock id -> (late since, updated_at), as read now."""
+    rows = session.query(
+        JobCheckpoint.stock_id, JobCheckpoint.timestamp, JobCheckpoint.updated_at
+    ).filter(JobCheckpoint.name.like(f"{PREFIX}{job}:%"))
+    return {stock_id: (since, updated_at) for stock_id, since, updated_at in rows}
+
+
+def clear(session, job: str, marks: dict[int, tuple[datetime, datetime]]):
+    """Delete the marks a job has reprocessed, unless they changed since it read them."""
+    if not marks:
+        return
+    session.execute(
+        delete(JobCheckpoint).where(
+            or_(
+                *(
+                    and_(
+                        JobCheckpoint.name == _name(job, stock_id),
+                        JobCheckpoint.timestamp == since,
+                        JobCheckpoint.updated_at == updated_at,
+                    )
+                    for stock_id, (since, updated_at) in marks.items()
+                )
+            )
+        ),
+        execution_options={"synchronize_session": False},
+    )
@@ -1,6 +1,178 @@
+"""Application logging.
+
+Records are put on a queue by the thread that logs them and written out by a single listener
+thread, so a slow terminal or disk never stalls an ingestion thread. Modules take a logger
+with `get_logger(__name__)`; levels and output come from the environment:
+
+    STOCKS_LOG_LEVEL=INFO                             # default for every module
+    STOCKS_LOG_LEVELS=stock_db=DEBUG,wallet=WARNING   # per-module overrides
+    STOCKS_LOG_FILE=stocks.log                        # instead of stderr
+
+Below WARNING, every call site is rate-limited (RateLimitFilter), so per-bar debug lines are
+sampled instead of flooding the output; the next record that gets through reports how many
+were dropped. Once log_queue() has been called, processes forked afterwards send their
+records to this process's listener (pass `initializer=init_worker, initargs=(log_queue(),)`
+to a Pool for the spawn start method); otherwise a child writes to the output itself.
+"""
+import atexit
 import logging
+import logging.handlers
+import multiprocessing
+import os
+import queue
+import threading
+import time
+
+ROOT = "stocks"
+FORMAT = "%(asctime)s %(message)s"
+DATEFMT = "%m/%d/%Y %I:%M:%S %p"
+
+logger = logging.getLogger(ROOT)
+
+
+def get_logger(name: str) -> logging.Logger:
+    """Logger for a module; its level can be set with STOCKS_LOG_LEVELS=<name>=LEVEL."""
+    return logging.getLogger(f"{ROOT}.{name}")
+
+
+class RateLimitFilter(logging.Filter):
+    """Token bucket per call site: `burst` records at once, refilled at `rate` per second.
+
+    WARNING and above always pass.
+    """
+
+    def __init__(self, rate: float = 20.0, burst: float = 100.0):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        # (path, line) -> [tokens, last refill, suppressed since the last record let through]
+        self._sites: dict[tuple[str, int], list] = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        key = (record.pathname, record.lineno)
+        now = time.monotonic()
+        with self._lock:
+            site = self._sites.get(key)
+            if site is None:
+                site = self._sites[key] = [self.burst, now, 0]
+            tokens = min(self.burst, site[0] + (now - site[1]) * self.rate)
+            site[1] = now
+            if tokens < 1.0:
+                site[0] = tokens
+                site[2] += 1
+                return False
+            site[0] = tokens - 1.0
+            suppressed, site[2] = site[2], 0
+        if suppressed:
+            record.msg = f"{record.msg} [{suppressed} similar messages suppressed]"
+        return True
+
+
+class _LocalQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler for an in-process queue.
+
+    The stock prepare() formats the message before queueing it (records may have to be
+    pickled); here the record stays in the process, so formatting is left to the listener.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+_output: logging.Handler | None = None
+_listener: logging.handlers.QueueListener | None = None
+_mp_queue = None
+_mp_listener: logging.handlers.QueueListener | None = None
+_lock = threading.Lock()
+
+
+def _output_handler(filename: str | None) -> logging.Handler:
+    handler = logging.FileHandler(filename) if filename else logging.StreamHandler()
+    handler.setFormatter(logging.Formatter(FORMAT, DATEFMT))
+    return handler
+
+
+def configure_levels(default: str | None = None, levels: str | None = None):
+    """Apply STOCKS_LOG_LEVEL / STOCKS_LOG_LEVELS (or the given values)."""
+    default = default or os.environ.get("STOCKS_LOG_LEVEL", "INFO")
+    logger.setLevel(default.upper())
+    levels = levels if levels is not None else os.environ.get("STOCKS_LOG_LEVELS", "")
+    for item in filter(None, (part.strip() for part in levels.split(","))):
+        name, _, level = item.partition("=")
+        get_logger(name.strip()).setLevel(level.strip().upper())
+
+
+def setup_logging(filename: str | None = None):
+    """(Re)start the listener thread; call again to switch the output, e.g. to a file."""
+    global _output, _listener
+    with _lock:
+        _stop_listeners()
+        _output = _output_handler(filename or os.environ.get("STOCKS_LOG_FILE"))
+        records: queue.SimpleQueue = queue.SimpleQueue()
+        handler = _LocalQueueHandler(records)
+        handler.addFilter(RateLimitFilter())
+        # On the root logger, so warnings from libraries go through the same queue
+        logging.getLogger().handlers = [handler]
+        _listener = logging.handlers.QueueListener(records, _output)
+        _listener.start()
+
+
+def _stop_listeners():
+    global _listener, _mp_listener, _mp_queue
+    # Stopping a listener drains its queue first, so nothing logged before exit is lost
+    for listener in (_mp_listener, _listener):
+        if listener is not None:
+            listener.stop()
+    _listener = _mp_listener = _mp_queue = None
+    if _output is not None:
+        _output.close()
+    # Anything logged from here on (e.g. by later atexit hooks) goes to logging.lastResort
+    logging.getLogger().handlers = []
+
+
+def stop_logging():
+    with _lock:
+        _stop_listeners()
+
+
+def log_queue():
+    """Queue that other processes can log to (see init_worker); drained by this process."""
+    global _mp_queue, _mp_listener
+    with _lock:
+        if _mp_queue is None:
+            _mp_queue = multiprocessing.Queue(-1)
+            _mp_listener = logging.handlers.QueueListener(_mp_queue, _output)
+            _mp_listener.start()
+        return _mp_queue
+
+
+def init_worker(records):
+    """Pool initializer: send this process's records to the parent's listener."""
+    handler = logging.handlers.QueueHandler(records)
+    handler.addFilter(RateLimitFilter())
+    logging.getLogger().handlers = [handler]
+
+
+def _after_fork_in_child():
+    # The listener threads did not survive the fork: log to the parent's process queue if
+    # it has one, or else straight to the output
+    global _listener, _mp_listener, _mp_queue, _lock
+    _lock = threading.Lock()
+    records = _mp_queue
+    _listener = _mp_listener = _mp_queue = None
+    if records is not None:
+        init_worker(records)
+        return
+    handler = _output_handler(os.environ.get("STOCKS_LOG_FILE"))
+    handler.addFilter(RateLimitFilter())
+    logging.getLogger().handlers = [handler]
+
 
-logger = logging.getLogger(__name__)
-logging.basicConfig(format="%(asctime)s %(message)s", datefmt="%m/%d/%Y %I:%M:%S %p")
-# logger.setLevel(logging.INFO)
-logger.setLevel(logging.DEBUG)
+configure_levels()
+setup_logging()
+atexit.register(stop_logging)
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
@@ -1,8 +1,117 @@
-from logger import logger
-from stock_monitor import monitor_stocks_parallel
-from data_updater import run_parallel_data_updater
+"""Run ingestion and monitoring together in one process.
+
+The ingest scheduler publishes every fetched ticker to the shared bar cache and then
+announces it on a bounded queue; the monitor evaluates the announced tickers as soon as they
+arrive instead of polling on its own timer. A ticker that is already waiting in the queue is
+not queued twice (the monitor reads the newest bars when it gets to it). When the monitor
+falls behind the queue fills up and the scheduler's fetch tasks wait on it, which slows
+ingestion down to the pace the monitor can keep up with.
+
+    python main.py [--fake] [--interval 15] [--queue-size 32] [--metrics-port 9108]
+
+Ctrl+C / SIGTERM stops fetching, lets the evaluation in progress finish and exits.
+"""
+import argparse
+import asyncio
+import signal
+import time
+from concurrent.futures import ThreadPoolExecutor
+import metrics
+from logger import get_logger
+from market_provider import FakeProvider
+from ingest_scheduler import run_scheduled_updater
+from signal_scanner import SignalScanner
+from stock_monitor import TICKERS, monitor_round
+
+logger = get_logger(__name__)
+
+
+class BarEvents:
+    """Bounded, coalescing queue of "new bar for ticker X" events."""
+
+    def __init__(self, maxsize: int):
+        self.queue: asyncio.Queue[str] = asyncio.Queue(maxsize)
+        # ticker -> monotonic time it was queued, for the bar-to-evaluation latency
+        self.pending: dict[str, float] = {}
+
+    async def put(self, ticker: str):
+        if ticker in self.pending:
+            return
+        self.pending[ticker] = time.monotonic()
+        await self.queue.put(ticker)  # blocks the fetch task while the queue is full
+
+    async def get_batch(self, limit: int) -> list[tuple[str, float]]:
+        """Wait for one event, then take whatever else is already queued (up to limit)."""
+        tickers = [await self.queue.get()]
+        while len(tickers) < limit and not self.queue.empty():
+            tickers.append(self.queue.get_nowait())
+        return [(ticker, self.pending.pop(ticker)) for ticker in tickers]
+
+
+async def run_monitor(
+    events: BarEvents, stop: asyncio.Event, scanner: SignalScanner, batch_limit: int = 64
+):
+    loop = asyncio.get_running_loop()
+    # One thread: the wallet and monitor_round are not meant to run concurrently
+    executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="monitor")
+    try:
+        while not stop.is_set():
+            get = asyncio.create_task(events.get_batch(batch_limit))
+            stopped = asyncio.create_task(stop.wait())
+            done, _ = await asyncio.wait({get, stopped}, return_when=asyncio.FIRST_COMPLETED)
+            if get not in done:
+                get.cancel()
+                break
+            stopped.cancel()
+
+            batch = get.result()
+            tickers = [ticker for ticker, _ in batch]
+            waited = [time.monotonic() - queued_at for _, queued_at in batch]
+            await loop.run_in_executor(executor, monitor_round, tickers, scanner)
+            metrics.observe("bar_to_decision", time.monotonic() - min(q for _, q in batch))
+            logger.info(
+                f"Evaluated {len(tickers)} tickers, {max(waited) * 1000:.1f}ms after their "
+                f"bars landed (queue depth {events.queue.qsize()})"
+            )
+    finally:
+        executor.shutdown(wait=True)
+        if events.queue.qsize():
+            logger.info(f"Shutting down with {events.queue.qsize()} unevaluated tickers.")
+
+
+async def run(tickers: list[str], provider=None, interval: float = 15.0, queue_size: int = 32):
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except (NotImplementedError, AttributeError):  # Windows: KeyboardInterrupt instead
+            pass
+
+    events = BarEvents(queue_size)
+    # The rule is compiled once; each batch of tickers is then a single vectorised scan
+    scanner = SignalScanner()
+    logger.info(f"Starting orchestrator for {len(tickers)} tickers ({scanner.rule!r}).")
+    await asyncio.gather(
+        run_scheduled_updater(tickers, provider, stop, interval=interval, on_bar=events.put),
+        run_monitor(events, stop, scanner),
+    )
+    logger.info("Orchestrator stopped.")
 
 
 if __name__ == "__main__":
-    monitor_stocks_parallel()
-    run_parallel_data_updater()
+    parser = argparse.ArgumentParser(description="Run ingestion and monitoring together.")
+    parser.add_argument("--fake", action="store_true", help="use the offline FakeProvider")
+    parser.add_argument("--interval", type=float, default=15.0)
+    parser.add_argument("--queue-size", type=int, default=32)
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+
+    metrics.start_exporters(args)
+
+    try:
+        asyncio.run(
+            run(TICKERS, FakeProvider() if args.fake else None, args.interval, args.queue_size)
+        )
+    except KeyboardInterrupt:
+        pass
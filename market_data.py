@@ -8,6 +8,7 @@ class MarketData:
         low: float,
         open: float,
         volume: float,
+        retrieved_at=None,
     ):
         self.timestamp = timestamp
         self.adj_close = adj_close
@@ -16,6 +17,7 @@ class MarketData:
         self.low = low
         self.open = open
         self.volume = volume
+        self.retrieved_at = retrieved_at
 
     def __repr__(self):
         # Return a string with all the values for easy reading
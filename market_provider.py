@@ -0,0 +1,173 @@
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, date, timedelta, timezone
+import numpy as np
+import pandas as pd
+import yfinance as yf
+from logger import get_logger
+from metrics import timed
+
+logger = get_logger(__name__)
+
+PRICE_COLUMNS = ["Adj Close", "Close", "High", "Low", "Open", "Volume"]
+EPOCH = pd.Timestamp(0, tz=timezone.utc)
+
+
+def _to_utc(value: datetime | date | str) -> pd.Timestamp:
+    ts = pd.Timestamp(value)
+    if ts.tzinfo is None:
+        return ts.tz_localize(timezone.utc)
+    return ts.tz_convert(timezone.utc)
+
+
+def chunked(tickers: list[str], chunk_size: int) -> list[list[str]]:
+    """Split a ticker list into chunks of at most chunk_size symbols."""
+    return [tickers[i : i + chunk_size] for i in range(0, len(tickers), chunk_size)]
+
+
+def split_frame(frame: pd.DataFrame, ticker: str) -> pd.DataFrame:
+    """Return the single-ticker slice of a (Price, Ticker) MultiIndex frame."""
+    if not isinstance(frame.columns, pd.MultiIndex):
+        return frame
+    if ticker not in frame.columns.get_level_values(1):
+        return pd.DataFrame(columns=PRICE_COLUMNS)
+    # A multi-ticker download pads every symbol to the union of timestamps
+    return frame.xs(key=ticker, axis=1, level=1).dropna(how="all")
+
+
+class MarketDataProvider:
+    """Source of 1-minute bars in the yfinance layout: one (Price, Ticker) column per field."""
+
+    # Yahoo's limits for 1-minute bars: 8 days per request, only the last 30 days
+    max_request_span = timedelta(days=7)
+    max_history = timedelta(days=30)
+
+    def download(
+        self,
+        tickers: list[str],
+        start: datetime | date | str,
+        end: datetime | date | str,
+        interval: str = "1m",
+    ) -> pd.DataFrame:
+        raise NotImplementedError
+
+    def download_chunks(
+        self,
+        tickers: list[str],
+        start: datetime | date | str,
+        end: datetime | date | str,
+        chunk_size: int = 50,
+        interval: str = "1m",
+    ):
+        """Yield (chunk, frame) pairs, one provider request per chunk of tickers."""
+        for chunk in chunked(tickers, chunk_size):
+            yield chunk, self.download(chunk, start=start, end=end, interval=interval)
+
+    def snapshot(self, tickers: list[str]) -> dict[str, tuple[float, float]]:
+        """Latest quote per ticker: (last price, cumulative session volume).
+
+        Tickers without a quote are left out.
+        """
+        raise NotImplementedError
+
+
+class YahooProvider(MarketDataProvider):
+    """Download bars from Yahoo Finance through yfinance."""
+
+    @timed("provider_fetch")
+    def download(self, tickers, start, end, interval="1m"):
+        logger.debug("Downloading %d tickers from Yahoo (%s - %s)", len(tickers), start, end)
+        return yf.download(
+            tickers, start=start, end=end, interval=interval, group_by="column", progress=False
+        )
+
+    @timed("provider_snapshot")
+    def snapshot(self, tickers, max_workers: int = 8):
+        # fast_info is one quote request per ticker, so they go out a few at a time
+        def quote(ticker):
+            try:
+                info = yf.Ticker(ticker).fast_info
+                return ticker, (float(info.last_price), float(info.last_volume or 0.0))
+            except Exception as e:
+                logger.warning(f"No quote for {ticker}: {e}")
+                return ticker, None
+
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            quotes = pool.map(quote, tickers)
+        return {ticker: values for ticker, values in quotes if values is not None}
+
+
+class FakeProvider(MarketDataProvider):
+    """Serve deterministic synthetic bars, so rounds can run without a network.
+
+    Every (ticker, minute) pair always produces the same bar, which means overlapping
+    windows return consistent data just like the real provider does.
+    """
+
+    def __init__(self, latency: float = 0.0, seed: int = 0, base_price: float = 5.0):
+        self.latency = latency
+        self.seed = seed
+        self.base_price = base_price
+        self.requests = 0
+
+    def _bars(self, ticker: str, minutes: np.ndarray) -> dict[str, np.ndarray]:
+        # Seed per ticker so results don't depend on which chunk a symbol lands in
+        rng = np.random.default_rng(zlib.crc32(ticker.encode()) ^ self.seed)
+        start_price = self.base_price * (0.5 + rng.random())
+        phase = rng.random() * 1000
+        # Smooth oscillation keyed by the absolute minute number
+        walk = np.sin(minutes / 37.0 + phase) * 0.03 + np.sin(minutes / 5.0 + phase) * 0.01
+        close = start_price * (1 + walk)
+        noise = np.abs(np.cos(minutes * 1.7 + phase)) * 0.004
+        open_ = close * (1 - noise / 2)
+        high = np.maximum(open_, close) * (1 + noise)
+        low = np.minimum(open_, close) * (1 - noise)
+        volume = np.floor(1000 + 900 * np.abs(np.sin(minutes * 0.61 + phase)) * 10)
+        return {
+            "Adj Close": close,
+            "Close": close,
+            "High": high,
+            "Low": low,
+            "Open": open_,
+            "Volume": volume,
+        }
+
+    @timed("provider_fetch")
+    def download(self, tickers, start, end, interval="1m"):
+        if interval != "1m":
+            raise ValueError(f"FakeProvider only serves 1m bars, not {interval}")
+        self.requests += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+        index = pd.date_range(
+            _to_utc(start).ceil("min"), _to_utc(end), freq="min", inclusive="left"
+        )
+        index.name = "Datetime"
+        minutes = ((index - EPOCH) // pd.Timedelta(minutes=1)).to_numpy(dtype=np.float64)
+        columns = {}
+        for ticker in tickers:
+            for field, values in self._bars(ticker, minutes).items():
+                columns[(field, ticker)] = values
+        frame = pd.DataFrame(columns, index=index)
+        frame.columns = pd.MultiIndex.from_tuples(frame.columns, names=["Price", "Ticker"])
+        return frame.sort_index(axis=1, level=0, sort_remaining=False)
+
+    @timed("provider_snapshot")
+    def snapshot(self, tickers, at: datetime | None = None):
+        """Quotes that follow the synthetic minute bars; volume accumulates over the UTC day."""
+        self.requests += 1
+        if self.latency:
+            time.sleep(self.latency)
+        at = _to_utc(at or datetime.now(timezone.utc))
+        minute = (at - EPOCH) / pd.Timedelta(minutes=1)
+        day_minute = float(minute // 1440 * 1440)
+        minutes = np.array([minute, day_minute])
+        quotes = {}
+        for ticker in tickers:
+            bars = self._bars(ticker, minutes)
+            # A constant per-day rate keeps the cumulative volume increasing within the day
+            volume = bars["Volume"][1] * (minute - day_minute)
+            quotes[ticker] = (float(bars["Close"][0]), float(np.floor(volume)))
+        return quotes
@@ -0,0 +1,274 @@
+"""Per-stage latency histograms and a Prometheus text export.
+
+Wrap a pipeline stage in `timed()` (as a context manager or a decorator) and its duration
+lands in a fixed log-spaced histogram: one bisect and a few integer updates per observation,
+no allocation. The registry is per process and can be exposed for a local scraper either as
+an HTTP endpoint or as a text file (node_exporter textfile collector format):
+
+    with timed("db_write"):
+        ...
+
+    @timed("structure")
+    def structure_market_data(self): ...
+
+    start_http_server(9108)                       # GET /metrics
+    start_textfile_writer("/var/lib/node_exporter/stocks.prom")
+"""
+import bisect
+import functools
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+# 1us .. ~67s, doubling; everything slower lands in +Inf
+BUCKETS = tuple(1e-6 * 2**i for i in range(27))
+QUANTILES = (0.5, 0.95, 0.99)
+PREFIX = "stocks"
+
+
+class Histogram:
+    __slots__ = ("buckets", "counts", "sum", "count", "errors", "_lock")
+
+    def __init__(self, buckets: tuple[float, ...] = BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+
+    def observe(self, seconds: float, error: bool = False):
+        i = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += seconds
+            self.count += 1
+            if error:
+                self.errors += 1
+
+    def snapshot(self) -> tuple[list[int], float, int, int]:
+        with self._lock:
+            return list(self.counts), self.sum, self.count, self.errors
+
+    def quantile(self, q: float) -> float:
+        """Estimate a quantile the way Prometheus' histogram_quantile does."""
+        counts, _, count, _ = self.snapshot()
+        if not count:
+            return float("nan")
+        rank = q * count
+        cumulative = 0
+        for i, bucket_count in enumerate(counts):
+            if cumulative + bucket_count >= rank and bucket_count:
+                if i == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[i - 1] if i else 0.0
+                return lower + (self.buckets[i] - lower) * (rank - cumulative) / bucket_count
+            cumulative += bucket_count
+        return self.buckets[-1]
+
+
+_histograms: dict[str, Histogram] = {}
+_gauges: dict[tuple[str, tuple], float] = {}
+_gauge_help: dict[str, str] = {}
+_registry_lock = threading.Lock()
+
+
+def histogram(stage: str) -> Histogram:
+    found = _histograms.get(stage)
+    if found is None:
+        with _registry_lock:
+            found = _histograms.setdefault(stage, Histogram())
+    return found
+
+
+def observe(stage: str, seconds: float):
+    histogram(stage).observe(seconds)
+
+
+def set_gauge(name: str, value: float, help: str = "", **labels):
+    """Set a gauge exported as <prefix>_<name>{labels}."""
+    with _registry_lock:
+        _gauges[(name, tuple(sorted(labels.items())))] = value
+        if help:
+            _gauge_help[name] = help
+
+
+class timed:
+    """Time a block (`with timed("stage"):`) or every call of a function (`@timed("stage")`).
+
+    Exceptions are still recorded, and counted as errors for the stage.
+    """
+
+    __slots__ = ("stage", "_histogram", "_start")
+
+    def __init__(self, stage: str):
+        self.stage = stage
+        self._histogram = histogram(stage)
+        self._start = 0.0
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._histogram.observe(time.perf_counter() - self._start, exc_type is not None)
+        return False
+
+    def __call__(self, func):
+        stage_histogram = self._histogram
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            failed = True
+            try:
+                result = func(*args, **kwargs)
+                failed = False
+                return result
+            finally:
+                stage_histogram.observe(time.perf_counter() - start, failed)
+
+        return wrapper
+
+
+def summary() -> dict[str, dict]:
+    """count, errors, mean and p50/p95/p99 (seconds) per stage."""
+    result = {}
+    for stage, hist in sorted(_histograms.items()):
+        _, total, count, errors = hist.snapshot()
+        mean = total / count if count else float("nan")
+        stats = {"count": count, "errors": errors, "mean": mean}
+        for q in QUANTILES:
+            stats[f"p{round(q * 100)}"] = hist.quantile(q)
+        result[stage] = stats
+    return result
+
+
+def log_summary():
+    for stage, stats in summary().items():
+        if stats["count"]:
+            logger.info(
+                f"[metrics] {stage}: n={stats['count']} err={stats['errors']} "
+                f"p50={stats['p50'] * 1000:.2f}ms p95={stats['p95'] * 1000:.2f}ms "
+                f"p99={stats['p99'] * 1000:.2f}ms"
+            )
+
+
+def _labels(**labels) -> str:
+    return ",".join(f'{key}="{value}"' for key, value in labels.items())
+
+
+def render() -> str:
+    """The registry in the Prometheus text exposition format."""
+    name = f"{PREFIX}_stage_seconds"
+    lines = [
+        f"# HELP {name} Time spent per pipeline stage.",
+        f"# TYPE {name} histogram",
+    ]
+    quantile_lines, error_lines = [], []
+    for stage, hist in sorted(_histograms.items()):
+        counts, total, count, errors = hist.snapshot()
+        cumulative = 0
+        for bound, bucket_count in zip(hist.buckets, counts):
+            cumulative += bucket_count
+            le = f"{bound:.6g}"
+            lines.append(f"{name}_bucket{{{_labels(stage=stage, le=le)}}} {cumulative}")
+        lines.append(f"{name}_bucket{{{_labels(stage=stage, le='+Inf')}}} {count}")
+        lines.append(f"{name}_sum{{{_labels(stage=stage)}}} {total:.9g}")
+        lines.append(f"{name}_count{{{_labels(stage=stage)}}} {count}")
+        for q in QUANTILES:
+            value = hist.quantile(q)
+            quantile_lines.append(
+                f"{name}_quantile{{{_labels(stage=stage, quantile=q)}}} {value:.9g}"
+            )
+        error_lines.append(f"{PREFIX}_stage_errors_total{{{_labels(stage=stage)}}} {errors}")
+
+    lines += [
+        f"# HELP {name}_quantile Estimated latency quantiles per stage (from the histogram).",
+        f"# TYPE {name}_quantile gauge",
+        *quantile_lines,
+        f"# HELP {PREFIX}_stage_errors_total Stage runs that raised.",
+        f"# TYPE {PREFIX}_stage_errors_total counter",
+        *error_lines,
+    ]
+
+    with _registry_lock:
+        gauges = sorted(_gauges.items())
+        gauge_help = dict(_gauge_help)
+    declared = set()
+    for (gauge, labels), value in gauges:
+        full = f"{PREFIX}_{gauge}"
+        if gauge not in declared:
+            declared.add(gauge)
+            if gauge in gauge_help:
+                lines.append(f"# HELP {full} {gauge_help[gauge]}")
+            lines.append(f"# TYPE {full} gauge")
+        label_text = f"{{{_labels(**dict(labels))}}}" if labels else ""
+        lines.append(f"{full}{label_text} {value:.9g}")
+    return "\n".join(lines) + "\n"
+
+
+def write_textfile(path: str):
+    """Write the registry atomically, so a scraper never reads a half-written file."""
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w") as f:
+        f.write(render())
+    os.replace(tmp, path)
+
+
+def start_textfile_writer(path: str, interval: float = 15.0) -> threading.Thread:
+    def loop():
+        while True:
+            try:
+                write_textfile(path)
+            except OSError as e:
+                logger.error(f"Could not write metrics to {path}: {e}")
+            time.sleep(interval)
+
+    thread = threading.Thread(target=loop, name="metrics-textfile", daemon=True)
+    thread.start()
+    return thread
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/metrics", "/"):
+            self.send_error(404)
+            return
+        body = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # scrapes every few seconds would flood the log
+
+
+def start_http_server(port: int, host: str = "127.0.0.1") -> ThreadingHTTPServer:
+    """Serve /metrics from a daemon thread."""
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    logger.info(f"Serving metrics on http://{host}:{port}/metrics")
+    return server
+
+
+def add_arguments(parser):
+    parser.add_argument("--metrics-port", type=int, help="serve Prometheus metrics on this port")
+    parser.add_argument(
+        "--metrics-file", help="write Prometheus metrics to this file periodically"
+    )
+
+
+def start_exporters(args):
+    """Start whichever exporters the --metrics-* arguments ask for."""
+    if args.metrics_port:
+        start_http_server(args.metrics_port)
+    if args.metrics_file:
+        start_textfile_writer(args.metrics_file)
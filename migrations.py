@@ -0,0 +1,164 @@
+import argparse
+from datetime import datetime
+from sqlalchemy import create_engine, inspect, text
+from sqlalchemy.engine import Connection, Engine
+from db_models import (
+    IndicatorState,
+    JobCheckpoint,
+    MarketData,
+    MarketDataRollup,
+    MarketSnapshot,
+)
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+# Migrations are applied in order and recorded in schema_version. Every step is idempotent,
+# so running them against a database that create_all() already built just records them.
+MIGRATIONS = []
+
+
+def migration(version: int, description: str):
+    def register(func):
+        MIGRATIONS.append((version, description, func))
+        return func
+
+    return register
+
+
+def _index_names(conn: Connection, table: str) -> set[str]:
+    inspector = inspect(conn)
+    names = {index["name"] for index in inspector.get_indexes(table)}
+    names.update(constraint["name"] for constraint in inspector.get_unique_constraints(table))
+    return names
+
+
+def _create_model_index(conn: Connection, name: str):
+    index = next(index for index in MarketData.__table__.indexes if index.name == name)
+    if name in _index_names(conn, MarketData.__tablename__):
+        logger.info(f"Index {name} already exists, skipping.")
+        return
+    logger.info(f"Creating index {name}...")
+    index.create(conn)
+
+
+@migration(1, "unique (stock_id, timestamp) on market_data")
+def _unique_stock_timestamp(conn: Connection):
+    name = "uq_market_data_stock_timestamp"
+    if name in _index_names(conn, "market_data"):
+        return
+
+    # Older databases can hold duplicate bars from concurrent writers; keep the first copy
+    deleted = conn.execute(
+        text(
+            "DELETE FROM market_data WHERE id NOT IN "
+            "(SELECT MIN(id) FROM market_data GROUP BY stock_id, timestamp)"
+        )
+    ).rowcount
+    if deleted:
+        logger.info(f"Removed {deleted} duplicate market_data rows.")
+
+    if conn.dialect.name == "sqlite":
+        # SQLite cannot add constraints to an existing table; a unique index is equivalent
+        conn.execute(text(f"CREATE UNIQUE INDEX {name} ON market_data (stock_id, timestamp)"))
+    else:
+        conn.execute(
+            text(f"ALTER TABLE market_data ADD CONSTRAINT {name} UNIQUE (stock_id, timestamp)")
+        )
+
+
+@migration(2, "hot-query indexes on market_data")
+def _hot_query_indexes(conn: Connection):
+    _create_model_index(conn, "ix_market_data_timestamp")
+    _create_model_index(conn, "ix_market_data_stock_latest")
+
+
+@migration(3, "indicator_state table for the streaming indicator engine")
+def _indicator_state(conn: Connection):
+    IndicatorState.__table__.create(conn, checkfirst=True)
+
+
+@migration(4, "job_checkpoints table for resumable batch jobs")
+def _job_checkpoints(conn: Connection):
+    JobCheckpoint.__table__.create(conn, checkfirst=True)
+
+
+@migration(5, "market_data_rollup table for 5m/1h/1d aggregates")
+def _market_data_rollup(conn: Connection):
+    MarketDataRollup.__table__.create(conn, checkfirst=True)
+
+
+@migration(6, "market_snapshots table for 12-second quote polling")
+def _market_snapshots(conn: Connection):
+    MarketSnapshot.__table__.create(conn, checkfirst=True)
+
+
+def _ensure_version_table(conn: Connection):
+    conn.execute(
+        text(
+            "CREATE TABLE IF NOT EXISTS schema_version ("
+            "version INTEGER PRIMARY KEY, description VARCHAR(200), applied_at DATETIME)"
+        )
+        if conn.dialect.name != "mssql"
+        else text(
+            "IF OBJECT_ID('schema_version', 'U') IS NULL CREATE TABLE schema_version ("
+            "version INTEGER PRIMARY KEY, description VARCHAR(200), applied_at DATETIME)"
+        )
+    )
+
+
+def current_version(conn: Connection) -> int:
+    _ensure_version_table(conn)
+    version = conn.execute(text("SELECT MAX(version) FROM schema_version")).scalar()
+    return version or 0
+
+
+def migrate(engine: Engine, target: int | None = None) -> int:
+    """Apply all pending migrations up to target (default: latest). Returns the new version."""
+    with engine.begin() as conn:
+        version = current_version(conn)
+
+    for number, description, func in sorted(MIGRATIONS, key=lambda m: m[0]):
+        if number <= version or (target is not None and number > target):
+            continue
+        logger.info(f"Applying migration {number}: {description}")
+        # One transaction per step, so a failure leaves the earlier steps recorded
+        with engine.begin() as conn:
+            func(conn)
+            conn.execute(
+                text(
+                    "INSERT INTO schema_version (version, description, applied_at) "
+                    "VALUES (:version, :description, :applied_at)"
+                ),
+                {"version": number, "description": description, "applied_at": datetime.utcnow()},
+            )
+        version = number
+
+    logger.info(f"Database schema is at version {version}.")
+    return version
+
+
+def status(engine: Engine):
+    with engine.begin() as conn:
+        version = current_version(conn)
+    for number, description, _ in sorted(MIGRATIONS, key=lambda m: m[0]):
+        state = "applied" if number <= version else "pending"
+        print(f"{number:>3}  {state:<8} {description}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Apply schema migrations to the stock database.")
+    parser.add_argument("--url", help="database URL (default: the engine from db_setup)")
+    parser.add_argument("--target", type=int, help="stop after this migration version")
+    parser.add_argument("--status", action="store_true", help="list migrations and exit")
+    args = parser.parse_args()
+
+    if args.url:
+        engine = create_engine(args.url)
+    else:
+        from db_setup import engine
+
+    if args.status:
+        status(engine)
+    else:
+        migrate(engine, args.target)
@@ -0,0 +1,487 @@
+"""On-disk cache of downloaded 1-minute bars, in front of any MarketDataProvider.
+
+Bars are kept per ticker as .npz segments (int64 ns timestamps plus one float64 array per
+field), each covering a closed [start, end) range that ends at the last bar the provider
+returned (an empty answer is how yfinance reports failure, so it is never cached);
+manifest.json records every segment's range, size and last use. download() answers a ticker
+from disk as far as the cached ranges cover the request without a hole, and only the
+uncovered suffix goes to the provider, in one call for all tickers that need the same
+suffix. A range never reaches into the last `settle` before its fetch, because the newest
+bars are still changing. Identical requests in flight at the same time share one provider
+call, and the least recently used segments are evicted once the cache grows past max_bytes.
+
+Every process using the same root (the updater, the monitor, sweep and backtest workers,
+research scripts) shares the cache: changes to the manifest are made under manifest.lock,
+on the manifest as re-read from disk, and readers pick up other processes' segments as soon
+as the manifest file changes.
+
+    provider = CachingProvider(YahooProvider())
+
+    python provider_cache.py [--clear]            # size of the cache (after clearing it)
+"""
+import argparse
+import json
+import os
+import re
+import shutil
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import contextmanager
+from datetime import datetime, date, timedelta
+import numpy as np
+import pandas as pd
+import metrics
+from bar_store import BarStore, FIELDS, FRAME_COLUMNS
+from logger import get_logger
+from market_provider import MarketDataProvider, YahooProvider, split_frame
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+logger = get_logger(__name__)
+
+DEFAULT_ROOT = "provider_cache"
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+DEFAULT_SETTLE = timedelta(minutes=2)
+# Segments per ticker before overlapping ones are merged into one file
+MAX_SEGMENTS = 16
+MANIFEST = "manifest.json"
+LOCK_FILE = "manifest.lock"
+MINUTE_NS = 60 * 10**9
+
+
+def _ns(value: datetime | date | str) -> int:
+    ts = pd.Timestamp(value)
+    if ts.tzinfo is None:
+        ts = ts.tz_localize("UTC")
+    return ts.value
+
+
+def covered_until(segments: list[dict], start: int) -> int:
+    """End of the hole-free coverage from `start` on (start itself when nothing covers it)."""
+    point = start
+    for segment in sorted(segments, key=lambda s: s["start"]):
+        if segment["start"] > point:
+            break
+        point = max(point, segment["end"])
+    return point
+
+
+def _concat(parts: list[BarStore]) -> BarStore:
+    """Bars of several stores in time order; where timestamps repeat, the later store wins."""
+    parts = [part for part in parts if part]
+    if not parts:
+        return BarStore()
+    if len(parts) == 1:
+        return parts[0]
+    timestamps = np.concatenate([part.timestamps for part in parts])
+    order = np.argsort(timestamps, kind="stable")
+    timestamps = timestamps[order]
+    last = np.r_[timestamps[1:] != timestamps[:-1], True]
+    keep = order[last]
+    columns = {
+        field: np.concatenate([part.column(field) for part in parts])[keep] for field in FIELDS
+    }
+    return BarStore(timestamps[last], columns)
+
+
+def _slice(bars: BarStore, start: int, end: int) -> BarStore:
+    first, last = np.searchsorted(bars.timestamps, [start, end])
+    return BarStore(
+        bars.timestamps[first:last], {field: bars.column(field)[first:last] for field in FIELDS}
+    )
+
+
+def to_frame(bars: dict[str, BarStore]) -> pd.DataFrame:
+    """Bars per ticker in the provider layout: (Price, Ticker) columns, UTC index."""
+    parts = {
+        ticker: pd.DataFrame(
+            {column: store.column(field) for column, field in FRAME_COLUMNS.items()},
+            index=store.index().tz_localize("UTC"),
+        )
+        for ticker, store in bars.items()
+    }
+    frame = pd.concat(parts, axis=1).swaplevel(axis=1)
+    frame.columns.names = ["Price", "Ticker"]
+    frame.index.name = "Datetime"
+    return frame.sort_index(axis=1, level=0, sort_remaining=False)
+
+
+class CachingProvider(MarketDataProvider):
+    """Serve 1-minute bars from the on-disk cache, downloading only what it does not have.
+
+    Other intervals go straight to the wrapped provider. Safe to share between threads, and
+    between processes that use the same root.
+    """
+
+    def __init__(
+        self,
+        provider: MarketDataProvider,
+        root: str = DEFAULT_ROOT,
+        max_bytes: int = DEFAULT_MAX_BYTES,
+        settle: timedelta = DEFAULT_SETTLE,
+    ):
+        self.provider = provider
+        self.max_request_span = provider.max_request_span
+        self.max_history = provider.max_history
+        self.root = root
+        self.max_bytes = max_bytes
+        self.settle_ns = int(settle / timedelta(microseconds=1)) * 1000
+        self.hits = 0
+        self.partial_hits = 0
+        self.misses = 0
+        self.bars_served = 0
+        self.bars_fetched = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._inflight: dict[tuple, Future] = {}
+        self._manifest: dict[str, list[dict]] = {}
+        # (mtime_ns, size) of the manifest file as last read or written by this process
+        self._manifest_stat: tuple | None = None
+        with self._lock:
+            self._refresh_locked()
+
+    # Manifest and segment files
+
+    def _manifest_path(self) -> str:
+        return os.path.join(self.root, MANIFEST)
+
+    def _load_manifest(self) -> dict[str, list[dict]]:
+        try:
+            with open(self._manifest_path(), "r") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except json.JSONDecodeError:
+            logger.error(f"Corrupt cache manifest in {self.root}; starting empty.")
+            return {}
+
+    def _refresh_locked(self, force: bool = False):
+        """Re-read the manifest if another process has changed it since we last saw it.
+
+        Last-use times this process recorded in memory are kept (the later one wins), so
+        eviction still sees what was read here.
+        """
+        try:
+            stat = os.stat(self._manifest_path())
+            current = (stat.st_mtime_ns, stat.st_size)
+        except FileNotFoundError:
+            current = None
+        if not force and current == self._manifest_stat:
+            return
+        used = {
+            segment["file"]: segment["used"]
+            for ticker_segments in self._manifest.values()
+            for segment in ticker_segments
+        }
+        self._manifest = self._load_manifest()
+        for ticker_segments in self._manifest.values():
+            for segment in ticker_segments:
+                segment["used"] = max(segment["used"], used.get(segment["file"], 0.0))
+        self._manifest_stat = current
+
+    def _save_manifest(self):
+        path = self._manifest_path()
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(self._manifest, f, separators=(",", ":"))
+        os.replace(tmp, path)
+        stat = os.stat(path)
+        self._manifest_stat = (stat.st_mtime_ns, stat.st_size)
+
+    @contextmanager
+    def _shared_manifest(self):
+        """Hold the cross-process lock, with the manifest freshly re-read; saves it on exit."""
+        os.makedirs(self.root, exist_ok=True)
+        # Opened per use, so a cache directory removed by hand gets a fresh lock file
+        fd = os.open(os.path.join(self.root, LOCK_FILE), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            else:
+                while True:
+                    try:
+                        msvcrt.locking(fd, msvcrt.LK_LOCK, 1)
+                        break
+                    except OSError:  # gave up after its own ~10 s of retries
+                        continue
+            self._refresh_locked(force=True)
+            try:
+                yield
+            except BaseException:
+                # The in-memory manifest may be half changed; re-read it on the next use
+                self._manifest_stat = None
+                raise
+            self._save_manifest()
+        finally:
+            if fcntl is None:
+                msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+            # Closing the descriptor releases the flock
+            os.close(fd)
+
+    def _write_segment(self, ticker: str, bars: BarStore, start: int, end: int) -> dict:
+        directory = os.path.join(self.root, re.sub(r"[^A-Za-z0-9._-]", "_", ticker))
+        os.makedirs(directory, exist_ok=True)
+        # Unique per write: a merged segment may cover exactly the range of one it replaces
+        name = os.path.join(directory, f"{start}-{end}-{time.time_ns()}.npz")
+        tmp = f"{name}.{os.getpid()}.tmp.npz"
+        columns = {field: bars.column(field) for field in FIELDS}
+        np.savez_compressed(tmp, timestamps=bars.timestamps, **columns)
+        os.replace(tmp, name)
+        return {
+            "file": os.path.relpath(name, self.root),
+            "start": start,
+            "end": end,
+            "bytes": os.path.getsize(name),
+            "used": time.time(),
+        }
+
+    def _read_segment(self, segment: dict) -> BarStore:
+        with np.load(os.path.join(self.root, segment["file"])) as data:
+            return BarStore(data["timestamps"], {field: data[field] for field in FIELDS})
+
+    def _remove_segment(self, ticker: str, segment: dict):
+        self._manifest[ticker].remove(segment)
+        if not self._manifest[ticker]:
+            del self._manifest[ticker]
+        self._delete_file(ticker, segment)
+
+    def _delete_file(self, ticker: str, segment: dict):
+        path = os.path.join(self.root, segment["file"])
+        try:
+            os.remove(path)
+            if ticker not in self._manifest:
+                os.rmdir(os.path.dirname(path))
+        except OSError:
+            pass
+
+    def _read_locked(self, ticker: str, start: int, end: int) -> BarStore | None:
+        """Cached bars in [start, end), or None when a segment file has disappeared."""
+        parts = []
+        # Manifest order is fetch order, so newer downloads of a bar win in _concat
+        for segment in list(self._manifest.get(ticker, [])):
+            if segment["end"] <= start or segment["start"] >= end:
+                continue
+            try:
+                parts.append(self._read_segment(segment))
+            except (OSError, KeyError, ValueError) as e:
+                # Also how a segment another process has evicted or compacted away shows up
+                logger.warning(f"Dropping unreadable cache segment {segment['file']}: {e}")
+                with self._shared_manifest():
+                    self._drop_locked(ticker, segment["file"])
+                return None
+            segment["used"] = time.time()
+        return _slice(_concat(parts), start, end)
+
+    def _drop_locked(self, ticker: str, file: str):
+        """Remove a segment by file name, if the (re-read) manifest still lists it."""
+        for segment in self._manifest.get(ticker, []):
+            if segment["file"] == file:
+                self._remove_segment(ticker, segment)
+                return
+        self._delete_file(ticker, {"file": file})
+
+    def _compact_locked(self, ticker: str):
+        """Merge every run of touching segments into one file."""
+        segments = sorted(self._manifest[ticker], key=lambda s: s["start"])
+        runs, run = [], [segments[0]]
+        for segment in segments[1:]:
+            if segment["start"] <= max(s["end"] for s in run):
+                run.append(segment)
+            else:
+                runs.append(run)
+                run = [segment]
+        runs.append(run)
+
+        for run in runs:
+            if len(run) < 2:
+                continue
+            order = self._manifest[ticker]
+            run.sort(key=order.index)
+            bars = _concat([self._read_segment(segment) for segment in run])
+            start, end = min(s["start"] for s in run), max(s["end"] for s in run)
+            merged = self._write_segment(ticker, bars, start, end)
+            for segment in run:
+                self._remove_segment(ticker, segment)
+            self._manifest.setdefault(ticker, []).append(merged)
+
+    def _evict_locked(self):
+        segments = [
+            (segment["used"], ticker, segment)
+            for ticker, ticker_segments in self._manifest.items()
+            for segment in ticker_segments
+        ]
+        total = sum(segment["bytes"] for _, _, segment in segments)
+        for _, ticker, segment in sorted(segments, key=lambda item: item[0]):
+            if total <= self.max_bytes:
+                break
+            total -= segment["bytes"]
+            self._remove_segment(ticker, segment)
+            self.evictions += 1
+
+    def _store(self, bars: dict[str, BarStore], start: int, ends: dict[str, int]):
+        """Cache each ticker's bars as covering [start, ends[ticker])."""
+        written = {
+            ticker: self._write_segment(ticker, _slice(bars[ticker], start, end), start, end)
+            for ticker, end in ends.items()
+        }
+        with self._lock, self._shared_manifest():
+            for ticker, segment in written.items():
+                self._manifest.setdefault(ticker, []).append(segment)
+                if len(self._manifest[ticker]) > MAX_SEGMENTS:
+                    self._compact_locked(ticker)
+            self._evict_locked()
+
+    # Fetching
+
+    def _fetch(self, tickers: list[str], start: int, end: int) -> dict[str, BarStore]:
+        key = (tuple(tickers), start, end)
+        with self._lock:
+            future = self._inflight.get(key)
+            owner = future is None
+            if owner:
+                future = self._inflight[key] = Future()
+        if not owner:
+            return future.result()
+
+        try:
+            fetched_at = time.time_ns()
+            frame = self.provider.download(
+                tickers, pd.Timestamp(start, tz="UTC"), pd.Timestamp(end, tz="UTC")
+            )
+            bars = {ticker: BarStore.from_frame(split_frame(frame, ticker)) for ticker in tickers}
+            # Bars of the last few minutes may still change; they are served but not cached
+            closed_end = min(end, fetched_at - self.settle_ns)
+            # yfinance reports failures as an empty frame, so a ticker only counts as covered
+            # up to the last bar it returned; tickers without bars are not cached at all
+            ends = {
+                ticker: min(closed_end, int(store.timestamps[-1]) + MINUTE_NS)
+                for ticker, store in bars.items()
+                if store
+            }
+            ends = {ticker: until for ticker, until in ends.items() if until > start}
+            if ends:
+                self._store(bars, start, ends)
+            future.set_result(bars)
+            return bars
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+
+    def download(self, tickers, start, end, interval="1m"):
+        if interval != "1m":
+            return self.provider.download(tickers, start=start, end=end, interval=interval)
+        start_ns, end_ns = _ns(start), _ns(end)
+
+        cached: dict[str, BarStore] = {}
+        suffixes: dict[int, list[str]] = {}
+        with self._lock:
+            self._refresh_locked()
+            for ticker in tickers:
+                until = min(covered_until(self._manifest.get(ticker, []), start_ns), end_ns)
+                bars = self._read_locked(ticker, start_ns, until) if until > start_ns else None
+                if bars is None:
+                    until, bars = start_ns, BarStore()
+                cached[ticker] = bars
+                self.bars_served += len(bars)
+                if until >= end_ns:
+                    self.hits += 1
+                else:
+                    if until > start_ns:
+                        self.partial_hits += 1
+                    else:
+                        self.misses += 1
+                    suffixes.setdefault(until, []).append(ticker)
+
+        fetched: dict[str, BarStore] = {}
+        for suffix_start, group in suffixes.items():
+            fetched.update(self._fetch(group, suffix_start, end_ns))
+        with self._lock:
+            self.bars_fetched += sum(len(bars) for bars in fetched.values())
+        self._publish_metrics()
+        logger.debug(
+            "Cache: %d/%d tickers served from disk, %d provider calls",
+            len(tickers) - sum(map(len, suffixes.values())),
+            len(tickers),
+            len(suffixes),
+        )
+        return to_frame(
+            {ticker: _concat([cached[ticker], fetched.get(ticker)]) for ticker in tickers}
+        )
+
+    # Reporting
+
+    def stats(self) -> dict:
+        with self._lock:
+            self._refresh_locked()
+            segments = [s for ticker_segments in self._manifest.values() for s in ticker_segments]
+            return {
+                "hits": self.hits,
+                "partial_hits": self.partial_hits,
+                "misses": self.misses,
+                "bars_served": self.bars_served,
+                "bars_fetched": self.bars_fetched,
+                "evictions": self.evictions,
+                "tickers": len(self._manifest),
+                "segments": len(segments),
+                "bytes": sum(segment["bytes"] for segment in segments),
+            }
+
+    def _publish_metrics(self):
+        stats = self.stats()
+        for result in ("hits", "partial_hits", "misses"):
+            metrics.set_gauge(
+                "provider_cache_requests",
+                stats[result],
+                "Ticker lookups in the provider cache.",
+                result=result,
+            )
+        metrics.set_gauge("provider_cache_bytes", stats["bytes"])
+        metrics.set_gauge("provider_cache_evictions", stats["evictions"])
+
+    def clear(self):
+        with self._lock, self._shared_manifest():
+            for name in os.listdir(self.root):
+                if name != LOCK_FILE:
+                    path = os.path.join(self.root, name)
+                    if os.path.isdir(path):
+                        shutil.rmtree(path, ignore_errors=True)
+                    else:
+                        os.remove(path)
+            self._manifest = {}
+
+
+_default: CachingProvider | None = None
+_default_lock = threading.Lock()
+
+
+def default_provider() -> CachingProvider:
+    """The process-wide cached Yahoo provider, for code that is not handed a provider."""
+    global _default
+    with _default_lock:
+        if _default is None:
+            _default = CachingProvider(YahooProvider())
+        return _default
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inspect or clear the provider cache.")
+    parser.add_argument("--root", default=DEFAULT_ROOT)
+    parser.add_argument("--clear", action="store_true")
+    args = parser.parse_args()
+
+    cache = CachingProvider(YahooProvider(), root=args.root)
+    if args.clear:
+        cache.clear()
+    stats = cache.stats()
+    print(
+        f"{stats['tickers']} tickers, {stats['segments']} segments, "
+        f"{stats['bytes'] / 1024 / 1024:.1f} MiB in {args.root}"
+    )
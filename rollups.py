@@ -0,0 +1,333 @@
+"""Incremental 5-minute, hourly and daily OHLCV rollups, and retention for raw minute bars.
+
+Rollups: each resolution keeps a watermark per stock in job_checkpoints, the start of the
+newest bucket written for that stock, so a ticker whose bars arrive late (backed off, slow
+or failing for a while) is picked up from its own watermark, not skipped past by the others.
+A run reads market_data from the oldest watermark on, one UTC day at a time (every
+resolution nests inside a day, so no bucket straddles two chunks), only for the stocks due
+by that day; it recomputes each stock's buckets at or after its watermark (the newest may
+still be filling) and replaces them in market_data_rollup. Bars filled in behind the
+watermarks (see late_bars) rewind that stock's watermarks to the bucket of the oldest such
+bar first.
+
+Retention: minute bars older than --keep-days are deleted in batches of --batch-size rows,
+each batch in its own short transaction with a pause after it, so the updater's writes never
+wait long for the lock. Only bars the rollups (behind every watermark of their stock) and
+with --archive the Parquet archive already cover are deleted.
+
+    python rollups.py                                 # bring the rollups up to date
+    python rollups.py --prune --keep-days 30 [--archive bar_archive]
+"""
+import argparse
+import time
+from datetime import datetime, timedelta
+import pandas as pd
+from sqlalchemy import and_, bindparam, cast, delete, func, insert, literal, or_, select, String
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from db_models import JobCheckpoint, MarketData, MarketDataRollup, Stock
+from db_setup import SessionLocal
+import late_bars
+from logger import get_logger
+from metrics import timed
+
+logger = get_logger(__name__)
+
+# Resolution -> pandas frequency of its buckets
+RESOLUTIONS = {"5m": "5min", "1h": "1h", "1d": "1D"}
+JOB_PREFIX = "rollup_"
+DEFAULT_KEEP_DAYS = 30
+DEFAULT_BATCH_SIZE = 5000
+BAR_COLUMNS = ["stock_id", "timestamp", "open", "high", "low", "close", "adj_close", "volume"]
+
+
+def _day_start(value: datetime) -> datetime:
+    return value.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def _bucket(value: datetime, freq: str) -> datetime:
+    return pd.Timestamp(value).floor(freq).to_pydatetime()
+
+
+def _name(resolution: str, stock_id: int) -> str:
+    return f"{JOB_PREFIX}{resolution}:{stock_id}"
+
+
+def watermarks(session) -> tuple[dict[str, dict[int, datetime]], dict[str, datetime | None]]:
+    """Start of the newest bucket written per resolution and stock, and the shared marks.
+
+    The shared mark per resolution is the single watermark older versions kept for every
+    stock; stocks without a mark of their own were rolled up to it.
+    """
+    marks = {resolution: {} for resolution in RESOLUTIONS}
+    shared = dict.fromkeys(RESOLUTIONS)
+    rows = session.query(JobCheckpoint.name, JobCheckpoint.stock_id, JobCheckpoint.timestamp)
+    for name, stock_id, timestamp in rows.filter(
+        JobCheckpoint.name.startswith(JOB_PREFIX, autoescape=True)
+    ):
+        resolution, _, stock = name[len(JOB_PREFIX) :].partition(":")
+        if resolution not in RESOLUTIONS:
+            continue
+        if stock:
+            marks[resolution][stock_id] = timestamp
+        else:
+            shared[resolution] = timestamp
+    return marks, shared
+
+
+def _first_bars(session) -> dict[int, datetime]:
+    """Oldest stored bar per stock that has any (one index seek per stock)."""
+    first = (
+        select(func.min(MarketData.timestamp))
+        .where(MarketData.stock_id == Stock.id)
+        .scalar_subquery()
+    )
+    rows = session.execute(select(Stock.id, first))
+    return {stock_id: timestamp for stock_id, timestamp in rows if timestamp is not None}
+
+
+def aggregate(bars: pd.DataFrame, freq: str) -> pd.DataFrame:
+    """OHLCV per (stock_id, bucket) from bars sorted by stock_id and timestamp."""
+    grouped = bars.assign(bucket=bars["timestamp"].dt.floor(freq)).groupby(
+        ["stock_id", "bucket"], sort=True
+    )
+    return grouped.agg(
+        open=("open", "first"),
+        high=("high", "max"),
+        low=("low", "min"),
+        close=("close", "last"),
+        adj_close=("adj_close", "last"),
+        volume=("volume", "sum"),
+        bar_count=("timestamp", "size"),
+    ).reset_index()
+
+
+def _due_filter(statement, stocks: list[int] | None):
+    return statement if stocks is None else statement.where(MarketData.stock_id.in_(stocks))
+
+
+def _load_bars(
+    session, start: datetime, end: datetime, stocks: list[int] | None = None
+) -> pd.DataFrame:
+    statement = (
+        select(*(getattr(MarketData, column) for column in BAR_COLUMNS))
+        .where(MarketData.timestamp >= start)
+        .where(MarketData.timestamp < end)
+        .order_by(MarketData.stock_id, MarketData.timestamp)
+    )
+    bars = pd.DataFrame(session.execute(_due_filter(statement, stocks)).all(), columns=BAR_COLUMNS)
+    bars["timestamp"] = pd.to_datetime(bars["timestamp"])
+    return bars
+
+
+def _rows(rollup: pd.DataFrame, resolution: str) -> list[dict]:
+    values = rollup.astype(object).where(rollup.notna(), None)
+    values["bucket"] = [bucket.to_pydatetime() for bucket in rollup["bucket"]]
+    values["resolution"] = resolution
+    return values.to_dict("records")
+
+
+def update(session, now: datetime | None = None) -> int:
+    """Bring every resolution of every stock up to date; returns the number of buckets written."""
+    now = now or datetime.utcnow()
+    marks, shared = watermarks(session)
+    # Stocks without a mark of their own start at their first bar (or the old shared mark)
+    first = _first_bars(session)
+    since = {}
+    for resolution, freq in RESOLUTIONS.items():
+        since[resolution] = dict(marks[resolution])
+        for stock_id, timestamp in first.items():
+            if stock_id not in marks[resolution]:
+                bucket = _bucket(timestamp, freq)
+                floor = shared[resolution]
+                since[resolution][stock_id] = max(bucket, floor) if floor else bucket
+    late = late_bars.pending(session, "rollups")
+    for stock_id, (late_since, _) in late.items():
+        for resolution, freq in RESOLUTIONS.items():
+            if stock_id in since[resolution]:
+                rewound = _bucket(late_since, freq)
+                since[resolution][stock_id] = min(since[resolution][stock_id], rewound)
+    # First day each stock needs; a stock that stopped trading only costs lookups of its bars
+    starts = {}
+    for stocks in since.values():
+        for stock_id, timestamp in stocks.items():
+            day = _day_start(timestamp)
+            starts[stock_id] = min(starts.get(stock_id, day), day)
+    if not starts:
+        return 0
+
+    written = 0
+    day = min(starts.values())
+    while day <= now:
+        day_end = day + timedelta(days=1)
+        due = [stock_id for stock_id, start in starts.items() if start < day_end]
+        # Skip the stock filter once every stock is due, the usual case for today
+        stocks = None if len(due) == len(starts) else due
+        bars = _load_bars(session, day, day_end, stocks)
+        if bars.empty:
+            # Skip weekends, holidays and outages in one step instead of a query per day
+            following = session.execute(
+                _due_filter(
+                    select(func.min(MarketData.timestamp)).where(MarketData.timestamp >= day_end),
+                    stocks,
+                )
+            ).scalar()
+            later = [start for start in starts.values() if start >= day_end]
+            candidates = [value for value in (following, *later) if value is not None]
+            if not candidates:
+                break
+            day = _day_start(pd.Timestamp(min(candidates)).to_pydatetime())
+            continue
+        for resolution, freq in RESOLUTIONS.items():
+            floors = bars["stock_id"].map(since[resolution])
+            rollup = aggregate(bars[bars["timestamp"] >= floors], freq)
+            # Every bucket from each stock's watermark on is recomputed from scratch
+            ranges = [
+                {"stock": stock_id, "since": max(since[resolution][stock_id], day)}
+                for stock_id in rollup["stock_id"].unique().tolist()
+            ]
+            if not ranges:
+                continue
+            session.execute(
+                MarketDataRollup.__table__.delete()
+                .where(MarketDataRollup.resolution == resolution)
+                .where(MarketDataRollup.stock_id == bindparam("stock"))
+                .where(MarketDataRollup.bucket >= bindparam("since"))
+                .where(MarketDataRollup.bucket < day_end),
+                ranges,
+            )
+            session.execute(insert(MarketDataRollup), _rows(rollup, resolution))
+            newest = rollup.groupby("stock_id")["bucket"].max()
+            _save_marks(session, resolution, newest)
+            for stock_id, bucket in newest.items():
+                since[resolution][stock_id] = bucket.to_pydatetime()
+            written += len(rollup)
+        session.commit()
+        day = day_end
+    late_bars.clear(session, "rollups", late)
+    session.commit()
+    return written
+
+
+def _save_marks(session, resolution: str, newest: pd.Series):
+    """Move the stocks' watermarks to their newest bucket written; caller commits."""
+    now = datetime.utcnow()
+    rows = [
+        {
+            "name": _name(resolution, stock_id),
+            "stock_id": stock_id,
+            "timestamp": bucket.to_pydatetime(),
+            "updated_at": now,
+        }
+        for stock_id, bucket in zip(newest.index.tolist(), newest)
+    ]
+    if session.get_bind().dialect.name == "sqlite":
+        stmt = sqlite_insert(JobCheckpoint)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[JobCheckpoint.name],
+            set_={"timestamp": stmt.excluded.timestamp, "updated_at": stmt.excluded.updated_at},
+        )
+        session.execute(stmt, rows)
+    else:
+        for row in rows:
+            session.merge(JobCheckpoint(**row))
+
+
+@timed("rollup")
+def run_once() -> int:
+    session = SessionLocal()
+    try:
+        written = update(session)
+        logger.info(f"Rolled up {written} buckets.")
+        return written
+    except Exception as e:
+        logger.error(f"Rollup failed: {e}")
+        session.rollback()
+        return 0
+    finally:
+        session.close()
+
+
+def _checkpoint_of(prefix: str):
+    """The timestamp of the checkpoint named prefix + the bar's stock id, as a SQL expression."""
+    name = literal(prefix) + cast(MarketData.stock_id, String)
+    return select(JobCheckpoint.timestamp).where(JobCheckpoint.name == name).scalar_subquery()
+
+
+def prune(
+    keep_days: int = DEFAULT_KEEP_DAYS,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    archive_root: str | None = None,
+    pause: float = 0.05,
+    now: datetime | None = None,
+) -> int:
+    """Delete minute bars older than keep_days (whole UTC days); returns the rows deleted.
+
+    With archive_root the days are exported to the Parquet archive first. Bars the rollups
+    (or the archive) have not covered yet are kept, whatever their age.
+    """
+    now = now or datetime.utcnow()
+    cutoff = _day_start(now - timedelta(days=keep_days))
+    if archive_root:
+        import archive
+
+        archive.export_closed_days(archive_root, until=cutoff.date())
+
+    session = SessionLocal()
+    try:
+        marks, shared = watermarks(session)
+        if not any(marks.values()) and None in shared.values():
+            logger.warning("Rollups have not run yet; not pruning any minute bars.")
+            return 0
+        if archive_root:
+            checkpoint = session.get(JobCheckpoint, archive.JOB_NAME)
+            archived_until = checkpoint.timestamp if checkpoint is not None else datetime.min
+            cutoff = min(cutoff, archived_until)
+    finally:
+        session.close()
+
+    # Each stock's bars are covered up to its own watermarks (primary key lookups per bar);
+    # bars filled in behind them are not in any rollup until the next run
+    covered = [
+        MarketData.timestamp < func.coalesce(_checkpoint_of(JOB_PREFIX + resolution + ":"), mark)
+        for resolution, mark in shared.items()
+    ]
+    late = _checkpoint_of(late_bars.PREFIX + "rollups:")
+    covered.append(or_(late.is_(None), MarketData.timestamp < late))
+
+    logger.info(f"Pruning minute bars before {cutoff} in batches of {batch_size}.")
+    deleted = 0
+    started = time.perf_counter()
+    while True:
+        batch = (
+            select(MarketData.id)
+            .where(MarketData.timestamp < cutoff)
+            .where(and_(*covered))
+            .limit(batch_size)
+            .scalar_subquery()
+        )
+        session = SessionLocal()
+        try:
+            count = session.execute(delete(MarketData).where(MarketData.id.in_(batch))).rowcount
+            session.commit()
+        finally:
+            session.close()
+        deleted += count
+        if count < batch_size:
+            break
+        # Let the updater take the write lock between batches
+        time.sleep(pause)
+    logger.info(f"Pruned {deleted} minute bars in {time.perf_counter() - started:.1f}s.")
+    return deleted
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rollups and retention for market_data.")
+    parser.add_argument("--prune", action="store_true", help="also apply the retention policy")
+    parser.add_argument("--keep-days", type=int, default=DEFAULT_KEEP_DAYS)
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument("--archive", metavar="ROOT", help="archive days to Parquet before pruning")
+    args = parser.parse_args()
+
+    run_once()
+    if args.prune:
+        prune(args.keep_days, args.batch_size, args.archive)
@@ -0,0 +1,510 @@
+"""Declarative buy rules, evaluated over the whole universe at once.
+
+A rule is a tree of Threshold, Band and Crossover conditions on named features, combined with
+& (all), | (any) and ~ (not):
+
+    Threshold("volume_zscore", above=3) & Crossover("macd", "macd_signal")
+    Band("rsi", 30, 70) | ~Threshold("volatility", above=0.02)
+
+compile() turns the tree into nested NumPy expressions over a (tickers x features) matrix once;
+a scan is then one pass over the matrix per round, not an if-statement per ticker. Every
+condition also scores how far past its boundary a ticker is (0..1); & keeps the weakest score,
+| the strongest, and hits are ranked by that confidence.
+
+Features come from each ticker's bars (price_change and volume_change since the previous
+retrieval, as the monitor has always compared them, plus close, volume, volatility and
+volume_zscore) and, only when a rule uses them, the indicator columns the IndicatorEngine
+stores (rsi, macd, macd_signal and their *_prev values one bar earlier, for crossovers).
+
+    python signal_scanner.py [--symbols 5000] [--bars 30]     # time a scan on synthetic bars
+"""
+import argparse
+import time
+from datetime import datetime, timedelta
+import numpy as np
+from sqlalchemy import select
+from bar_store import BarStore
+from db_models import MarketData, Stock
+from db_setup import SessionLocal
+from features import DEFAULT_WINDOW
+from logger import get_logger
+from metrics import timed
+from trading_rules import PRICE_THRESHOLD, VOLUME_THRESHOLD
+
+logger = get_logger(__name__)
+
+CHANGE_COLUMNS = ("price_change", "volume_change")
+LATEST_COLUMNS = ("close", "volume")
+WINDOW_COLUMNS = ("volatility", "volume_zscore")
+INDICATOR_COLUMNS = ("rsi", "macd", "macd_signal")
+PREVIOUS_INDICATOR_COLUMNS = tuple(f"{column}_prev" for column in INDICATOR_COLUMNS)
+COLUMNS = (
+    CHANGE_COLUMNS
+    + LATEST_COLUMNS
+    + WINDOW_COLUMNS
+    + INDICATOR_COLUMNS
+    + PREVIOUS_INDICATOR_COLUMNS
+)
+# Indicators are only filled in for closed bars, so look back further than the bar snapshot
+INDICATOR_MINUTES = 15
+
+
+def _score(margin: np.ndarray, scale: float) -> np.ndarray:
+    """Confidence from a margin past the boundary: 0 at it, 0.5 at `scale` beyond, towards 1."""
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(margin > 0, margin / (margin + scale), 0.0)
+
+
+class Rule:
+    """A condition on the feature matrix. Subclasses implement features() and compile()."""
+
+    def features(self) -> set[str]:
+        raise NotImplementedError
+
+    def compile(self, index: dict[str, int]):
+        """A function matrix -> (hit, confidence) arrays, with column positions resolved."""
+        raise NotImplementedError
+
+    def __and__(self, other: "Rule") -> "Rule":
+        return AllOf(self, other)
+
+    def __or__(self, other: "Rule") -> "Rule":
+        return AnyOf(self, other)
+
+    def __invert__(self) -> "Rule":
+        return Not(self)
+
+
+class Threshold(Rule):
+    """feature > above, or feature < below (of its absolute value when absolute=True).
+
+    Confidence is 0.5 when the feature is past the threshold by `scale` (default: the
+    threshold's own size, so twice the threshold scores 0.5).
+    """
+
+    def __init__(
+        self,
+        feature: str,
+        above: float | None = None,
+        below: float | None = None,
+        absolute: bool = False,
+        scale: float | None = None,
+    ):
+        if (above is None) == (below is None):
+            raise ValueError("Threshold takes exactly one of above= or below=")
+        self.feature = feature
+        self.above = above
+        self.below = below
+        self.absolute = absolute
+        bound = above if above is not None else below
+        self.scale = scale or abs(bound) or 1.0
+
+    def features(self) -> set[str]:
+        return {self.feature}
+
+    def compile(self, index: dict[str, int]):
+        column, absolute, scale = index[self.feature], self.absolute, self.scale
+        above, below = self.above, self.below
+
+        def evaluate(matrix: np.ndarray):
+            values = np.abs(matrix[:, column]) if absolute else matrix[:, column]
+            margin = values - above if above is not None else below - values
+            return margin > 0, _score(margin, scale)
+
+        return evaluate
+
+    def __repr__(self):
+        name = f"|{self.feature}|" if self.absolute else self.feature
+        return f"{name} > {self.above}" if self.above is not None else f"{name} < {self.below}"
+
+
+class Band(Rule):
+    """low <= feature <= high; confidence is 1 in the middle of the band and 0 at its edges."""
+
+    def __init__(self, feature: str, low: float, high: float):
+        if not low < high:
+            raise ValueError(f"Band needs low < high, got {low}, {high}")
+        self.feature = feature
+        self.low = low
+        self.high = high
+
+    def features(self) -> set[str]:
+        return {self.feature}
+
+    def compile(self, index: dict[str, int]):
+        column, low, high = index[self.feature], self.low, self.high
+        middle, half = (low + high) / 2, (high - low) / 2
+
+        def evaluate(matrix: np.ndarray):
+            values = matrix[:, column]
+            hit = (values >= low) & (values <= high)
+            return hit, np.where(hit, 1.0 - np.abs(values - middle) / half, 0.0)
+
+        return evaluate
+
+    def __repr__(self):
+        return f"{self.low} <= {self.feature} <= {self.high}"
+
+
+class Crossover(Rule):
+    """fast crossed slow between the previous bar and this one (upwards unless up=False).
+
+    Uses the fast/slow columns and their *_prev values. Confidence is the gap after the
+    cross relative to the size of both lines.
+    """
+
+    def __init__(self, fast: str, slow: str, up: bool = True):
+        self.fast = fast
+        self.slow = slow
+        self.up = up
+
+    def features(self) -> set[str]:
+        return {self.fast, self.slow, f"{self.fast}_prev", f"{self.slow}_prev"}
+
+    def compile(self, index: dict[str, int]):
+        fast, slow = index[self.fast], index[self.slow]
+        fast_prev, slow_prev = index[f"{self.fast}_prev"], index[f"{self.slow}_prev"]
+        sign = 1.0 if self.up else -1.0
+
+        def evaluate(matrix: np.ndarray):
+            gap = sign * (matrix[:, fast] - matrix[:, slow])
+            gap_prev = sign * (matrix[:, fast_prev] - matrix[:, slow_prev])
+            hit = (gap > 0) & (gap_prev <= 0)
+            size = np.abs(matrix[:, fast]) + np.abs(matrix[:, slow])
+            with np.errstate(divide="ignore", invalid="ignore"):
+                confidence = np.where(hit, np.minimum(gap / size, 1.0), 0.0)
+            return hit, confidence
+
+        return evaluate
+
+    def __repr__(self):
+        return f"{self.fast} crosses {'above' if self.up else 'below'} {self.slow}"
+
+
+class AllOf(Rule):
+    """Every rule holds; confidence is the lowest of theirs."""
+
+    def __init__(self, *rules: Rule):
+        # Flatten a & b & c into one node
+        self.rules = [
+            part for rule in rules for part in (rule.rules if type(rule) is type(self) else [rule])
+        ]
+
+    def features(self) -> set[str]:
+        return set().union(*(rule.features() for rule in self.rules))
+
+    def compile(self, index: dict[str, int]):
+        parts = [rule.compile(index) for rule in self.rules]
+
+        def evaluate(matrix: np.ndarray):
+            hit, confidence = parts[0](matrix)
+            for part in parts[1:]:
+                part_hit, part_confidence = part(matrix)
+                hit = hit & part_hit
+                confidence = np.minimum(confidence, part_confidence)
+            return hit, np.where(hit, confidence, 0.0)
+
+        return evaluate
+
+    def __repr__(self):
+        return "(" + " & ".join(map(repr, self.rules)) + ")"
+
+
+class AnyOf(AllOf):
+    """At least one rule holds; confidence is the highest of the rules that hold."""
+
+    def compile(self, index: dict[str, int]):
+        parts = [rule.compile(index) for rule in self.rules]
+
+        def evaluate(matrix: np.ndarray):
+            hit, confidence = parts[0](matrix)
+            for part in parts[1:]:
+                part_hit, part_confidence = part(matrix)
+                hit = hit | part_hit
+                confidence = np.maximum(confidence, part_confidence)
+            return hit, confidence
+
+        return evaluate
+
+    def __repr__(self):
+        return "(" + " | ".join(map(repr, self.rules)) + ")"
+
+
+class Not(Rule):
+    """The rule does not hold (NaN features count as not holding, so ~ of them hits)."""
+
+    def __init__(self, rule: Rule):
+        self.rule = rule
+
+    def features(self) -> set[str]:
+        return self.rule.features()
+
+    def compile(self, index: dict[str, int]):
+        part = self.rule.compile(index)
+
+        def evaluate(matrix: np.ndarray):
+            hit, _ = part(matrix)
+            return ~hit, np.where(hit, 0.0, 1.0)
+
+        return evaluate
+
+    def __repr__(self):
+        return f"~{self.rule!r}"
+
+
+# The monitor's rule: price and volume both moved more than the thresholds since the last bar
+DEFAULT_RULE = Threshold("price_change", above=PRICE_THRESHOLD, absolute=True) & Threshold(
+    "volume_change", above=VOLUME_THRESHOLD, absolute=True
+)
+
+
+def _changes(previous: np.ndarray, current: np.ndarray) -> np.ndarray:
+    """Relative changes like get_change_since_last_retrieved: NaN where either value is 0."""
+    with np.errstate(divide="ignore", invalid="ignore"):
+        changes = np.round((current - previous) / previous, 6)
+    changes[(previous == 0) | (current == 0)] = np.nan
+    return changes
+
+
+def _sample_std(values: np.ndarray) -> np.ndarray:
+    """Row-wise np.nanstd(ddof=1); NaN for rows with fewer than two values."""
+    count = np.sum(~np.isnan(values), axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean = np.nansum(values, axis=1) / count
+        squares = np.nansum((values - mean[:, None]) ** 2, axis=1)
+        return np.where(count > 1, np.sqrt(squares / (count - 1)), np.nan)
+
+
+def bar_features(bars: list[BarStore], window: int = DEFAULT_WINDOW) -> dict[str, np.ndarray]:
+    """Every bar-derived column for many tickers at once, one value per BarStore.
+
+    Only the newest window + 1 bars of each ticker are copied (into a NaN-padded block); the
+    features are then computed for all tickers together, with the same meaning as
+    features.compute() and StockRaw.get_change_since_last_retrieved() have for one.
+    """
+    width = window + 1
+    close = np.full((len(bars), width), np.nan)
+    volume = np.full((len(bars), width), np.nan)
+    # Positions of the previous and the latest retrieval, or -1 for "no such bar"
+    previous = np.full(len(bars), -1)
+    current = np.full(len(bars), -1)
+    for i, store in enumerate(bars):
+        n = len(store)
+        if n == 0:
+            continue
+        k = min(n, width)
+        close[i, width - k :] = store.close[-k:]
+        volume[i, width - k :] = store.volume[-k:]
+        if n < 2:
+            continue
+        if store.retrieved_at is None:
+            previous[i], current[i] = n - 2, n - 1
+        else:
+            previous[i], current[i] = np.argsort(store.retrieved_at, kind="stable")[-2:]
+
+    columns = {"close": close[:, -1], "volume": volume[:, -1]}
+    has_pair = current >= 0
+    pair_close = np.full((2, len(bars)), np.nan)
+    pair_volume = np.full((2, len(bars)), np.nan)
+    for i in np.flatnonzero(has_pair).tolist():
+        store = bars[i]
+        pair_close[:, i] = store.close[previous[i]], store.close[current[i]]
+        pair_volume[:, i] = store.volume[previous[i]], store.volume[current[i]]
+    columns["price_change"] = _changes(*pair_close)
+    columns["volume_change"] = _changes(*pair_volume)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        returns = np.diff(close, axis=1) / close[:, :-1]
+    returns[close[:, :-1] == 0] = 0.0
+    columns["volatility"] = _sample_std(returns)
+    before = volume[:, :-1]
+    spread = _sample_std(before)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean = np.nansum(before, axis=1) / np.sum(~np.isnan(before), axis=1)
+        zscore = (volume[:, -1] - mean) / spread
+    zscore[spread == 0] = 0.0
+    columns["volume_zscore"] = zscore
+    return columns
+
+
+def latest_indicators(
+    session, tickers: list[str], now: datetime | None = None, minutes: int = INDICATOR_MINUTES
+) -> dict[str, list[float]]:
+    """Indicators of the two newest processed bars per ticker, in one query.
+
+    Values are in INDICATOR_COLUMNS + PREVIOUS_INDICATOR_COLUMNS order.
+    """
+    since = (now or datetime.utcnow()) - timedelta(minutes=minutes)
+    rows = session.execute(
+        select(Stock.ticker, MarketData.rsi, MarketData.macd, MarketData.macd_signal)
+        .join(MarketData, MarketData.stock_id == Stock.id)
+        .where(Stock.ticker.in_(tickers))
+        .where(MarketData.timestamp >= since)
+        .where(MarketData.macd.isnot(None))
+        .order_by(Stock.ticker, MarketData.timestamp)
+    ).all()
+    history: dict[str, list[tuple]] = {}
+    for ticker, *values in rows:
+        history.setdefault(ticker, []).append(tuple(values))
+    latest = {}
+    for ticker, bars in history.items():
+        previous = bars[-2] if len(bars) > 1 else (None,) * len(INDICATOR_COLUMNS)
+        latest[ticker] = [np.nan if v is None else v for v in bars[-1] + previous]
+    return latest
+
+
+class FeatureMatrix:
+    """Features of many tickers: values[i, j] is column j of tickers[i] (NaN when unknown)."""
+
+    __slots__ = ("tickers", "columns", "values")
+
+    def __init__(self, tickers: list[str], columns: tuple[str, ...], values: np.ndarray):
+        self.tickers = tickers
+        self.columns = columns
+        self.values = values
+
+    @classmethod
+    def from_bars(
+        cls,
+        snapshot: dict[str, BarStore],
+        columns: tuple[str, ...] = COLUMNS,
+        indicators: dict[str, list[float]] | None = None,
+        window: int = DEFAULT_WINDOW,
+    ) -> "FeatureMatrix":
+        """Build the matrix from each ticker's bars and (optionally) its latest indicators."""
+        unknown = set(columns) - set(COLUMNS)
+        if unknown:
+            raise KeyError(f"Unknown features {sorted(unknown)}")
+        tickers = list(snapshot)
+        values = np.full((len(tickers), len(columns)), np.nan)
+        order = INDICATOR_COLUMNS + PREVIOUS_INDICATOR_COLUMNS
+        bar_columns = tuple(column for column in columns if column not in order)
+        if bar_columns:
+            computed = bar_features([snapshot[ticker] for ticker in tickers], window)
+            for column in bar_columns:
+                values[:, columns.index(column)] = computed[column]
+        if indicators:
+            pairs = [(columns.index(c), order.index(c)) for c in columns if c in order]
+            targets, sources = [p[0] for p in pairs], [p[1] for p in pairs]
+            for i, ticker in enumerate(tickers):
+                row = indicators.get(ticker)
+                if row is not None:
+                    values[i, targets] = [row[j] for j in sources]
+        return cls(tickers, columns, values)
+
+    def row(self, i: int) -> dict[str, float]:
+        return dict(zip(self.columns, self.values[i].tolist()))
+
+    def __len__(self) -> int:
+        return len(self.tickers)
+
+
+class Candidate:
+    """A ticker a rule selected, with its confidence and the features it was judged on."""
+
+    __slots__ = ("ticker", "confidence", "features")
+
+    def __init__(self, ticker: str, confidence: float, features: dict[str, float]):
+        self.ticker = ticker
+        self.confidence = confidence
+        self.features = features
+
+    def __repr__(self):
+        return f"Candidate({self.ticker}, confidence={self.confidence:.3f})"
+
+
+class SignalScanner:
+    """Compiles a rule once and scans feature matrices with it, best candidates first."""
+
+    def __init__(self, rule: Rule = DEFAULT_RULE, window: int = DEFAULT_WINDOW):
+        self.rule = rule
+        self.window = window
+        # Only the features the rule reads are built, so an unused indicator costs nothing
+        self.columns = tuple(column for column in COLUMNS if column in rule.features())
+        self._evaluate = rule.compile({column: i for i, column in enumerate(self.columns)})
+        self.needs_indicators = any(
+            column in INDICATOR_COLUMNS + PREVIOUS_INDICATOR_COLUMNS for column in self.columns
+        )
+
+    def matrix(self, snapshot: dict[str, BarStore]) -> FeatureMatrix:
+        """The rule's features for every ticker in the snapshot (indicators from the DB)."""
+        indicators = None
+        if self.needs_indicators and snapshot:
+            session = SessionLocal()
+            try:
+                indicators = latest_indicators(session, list(snapshot))
+            finally:
+                session.close()
+        return FeatureMatrix.from_bars(snapshot, self.columns, indicators, self.window)
+
+    @timed("signal_scan")
+    def scan(self, matrix: FeatureMatrix) -> list[Candidate]:
+        """Tickers the rule selects, by descending confidence (ties in ticker order)."""
+        hit, confidence = self._evaluate(matrix.values)
+        selected = np.flatnonzero(hit)
+        ranked = selected[np.argsort(-confidence[selected], kind="stable")]
+        return [
+            Candidate(matrix.tickers[i], float(confidence[i]), matrix.row(i))
+            for i in ranked.tolist()
+        ]
+
+    def __repr__(self):
+        return f"SignalScanner({self.rule!r})"
+
+
+def run_benchmark(n_symbols: int = 5000, n_bars: int = 30, rounds: int = 5, seed: int = 0) -> dict:
+    """Time matrix builds and scans over synthetic bars (no database needed).
+
+    The rule reads every feature, indicators included, so this is the worst case per round.
+    """
+    rng = np.random.default_rng(seed)
+    base = np.datetime64("2024-01-02T14:30", "ns").astype(np.int64)
+    timestamps = base + np.arange(n_bars, dtype=np.int64) * 60_000_000_000
+    snapshot = {}
+    for i in range(n_symbols):
+        close = 5.0 * np.exp(np.cumsum(rng.normal(0, 0.01, n_bars)))
+        volume = rng.integers(1_000, 100_000, n_bars).astype(np.float64)
+        columns = {"adj_close": close, "close": close, "high": close, "low": close, "open": close}
+        columns["volume"] = volume
+        snapshot[f"SYM{i:05d}"] = BarStore(timestamps, columns, timestamps.copy())
+    indicators = {ticker: rng.normal(0, 1, 6).tolist() for ticker in snapshot}
+    for row in indicators.values():
+        row[0] = row[3] = 50 + 15 * row[0]
+
+    rule = (
+        DEFAULT_RULE
+        | (Crossover("macd", "macd_signal") & Band("rsi", 30, 70))
+        | (Threshold("volume_zscore", above=3.0) & ~Threshold("volatility", above=0.05))
+    )
+    scanner = SignalScanner(rule)
+    builds, scans = [], []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        matrix = FeatureMatrix.from_bars(snapshot, scanner.columns, indicators)
+        builds.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        candidates = scanner.scan(matrix)
+        scans.append(time.perf_counter() - start)
+    return {
+        "symbols": n_symbols,
+        "features": len(scanner.columns),
+        "build": min(builds),
+        "scan": min(scans),
+        "candidates": len(candidates),
+        "top": candidates[:3],
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time a universe scan on synthetic bars.")
+    parser.add_argument("--symbols", type=int, default=5000)
+    parser.add_argument("--bars", type=int, default=30)
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+
+    result = run_benchmark(args.symbols, args.bars, args.rounds)
+    print(
+        f"{result['symbols']} symbols x {result['features']} features: "
+        f"build {result['build'] * 1000:.1f}ms, scan {result['scan'] * 1000:.2f}ms, "
+        f"{result['candidates']} candidates, top {result['top']}"
+    )
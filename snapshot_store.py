@@ -0,0 +1,433 @@
+"""Quote snapshots every few seconds, stored narrow and aggregated into bars on read.
+
+Polling every 12 seconds instead of downloading 1-minute bars means five times as many rows,
+too many for the wide market_data upsert path. Snapshots go to market_snapshots instead:
+(stock_id, ts) -> price and cumulative session volume, clustered on that key. The poller only
+queues a round of quotes; a SnapshotWriter thread drains whatever has accumulated and writes
+it as a single multi-row insert in one transaction, so the write rate is bounded by commits,
+not by rows. Readers turn a time range of snapshots into OHLCV bars of any width:
+
+    python snapshot_store.py poll --interval 12 [--fake]
+    python snapshot_store.py bars AAPL --minutes 60 --freq 1min
+    python snapshot_store.py loadtest --tickers 75 --interval 12 --rounds 1950
+"""
+import argparse
+import os
+import queue
+import statistics
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+import numpy as np
+import pandas as pd
+from sqlalchemy import insert, select, text
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import SQLAlchemyError
+import metrics
+from bar_store import BarStore
+from db_models import MarketSnapshot
+from db_setup import SessionLocal
+from logger import get_logger
+from market_provider import FakeProvider, MarketDataProvider, YahooProvider
+from metrics import timed
+from stock_db import MSSQL_MAX_PARAMS, get_stock_id
+
+logger = get_logger(__name__)
+
+DEFAULT_INTERVAL = 12.0
+DEFAULT_BATCH_SIZE = 5000
+SNAPSHOT_COLUMNS = ["stock_id", "ts", "price", "volume"]
+
+
+def to_ns(value: datetime | str) -> int:
+    """Nanoseconds since the epoch; naive datetimes are taken as UTC."""
+    ts = pd.Timestamp(value)
+    if ts.tzinfo is not None:
+        ts = ts.tz_convert("UTC").tz_localize(None)
+    return ts.value
+
+
+class SnapshotWriter:
+    """Writes queued rounds of quotes to market_snapshots from a background thread.
+
+    Every write takes all rounds queued at that moment (up to batch_size rows), so a burst or
+    a slow commit turns into a bigger next batch instead of a growing backlog.
+    """
+
+    def __init__(self, batch_size: int = DEFAULT_BATCH_SIZE):
+        self.batch_size = batch_size
+        self.written = 0
+        self.batches = 0
+        self.dropped = 0
+        self._queue: queue.SimpleQueue = queue.SimpleQueue()
+        self._thread: threading.Thread | None = None
+
+    def start(self) -> "SnapshotWriter":
+        self._thread = threading.Thread(target=self._run, name="snapshot-writer", daemon=True)
+        self._thread.start()
+        return self
+
+    def put_round(self, ts: datetime, quotes: dict[str, tuple[float, float]]):
+        """Queue one round of provider.snapshot() quotes taken at ts."""
+        if quotes:
+            self._queue.put((to_ns(ts), quotes))
+
+    def flush(self, timeout: float | None = None) -> bool:
+        """Wait until everything queued so far is written."""
+        done = threading.Event()
+        self._queue.put(done)
+        return done.wait(timeout)
+
+    def close(self):
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        session = SessionLocal()
+        try:
+            while True:
+                item = self._queue.get()
+                rows, waiters, stop = [], [], False
+                while True:
+                    if item is None:
+                        stop = True
+                    elif isinstance(item, threading.Event):
+                        waiters.append(item)
+                    else:
+                        rows.extend(self._rows(session, *item))
+                    if stop or len(rows) >= self.batch_size:
+                        break
+                    try:
+                        item = self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+                if rows:
+                    self._write(session, rows)
+                for waiter in waiters:
+                    waiter.set()
+                if stop:
+                    return
+        finally:
+            session.close()
+
+    def _rows(self, session, ts: int, quotes: dict[str, tuple[float, float]]) -> list[dict]:
+        return [
+            {"stock_id": get_stock_id(session, ticker), "ts": ts, "price": price, "volume": volume}
+            for ticker, (price, volume) in quotes.items()
+        ]
+
+    @timed("snapshot_write")
+    def _write(self, session, rows: list[dict]):
+        try:
+            insert_snapshots(session, rows)
+            session.commit()
+            self.written += len(rows)
+            self.batches += 1
+        except SQLAlchemyError as e:
+            session.rollback()
+            self.dropped += len(rows)
+            logger.error(f"Dropped {len(rows)} snapshots: {e}")
+
+
+def _insert_mssql(session, rows: list[dict]):
+    rows_per_statement = MSSQL_MAX_PARAMS // len(SNAPSHOT_COLUMNS)
+    columns = ", ".join(SNAPSHOT_COLUMNS)
+    source_columns = ", ".join(f"source.{c}" for c in SNAPSHOT_COLUMNS)
+
+    for offset in range(0, len(rows), rows_per_statement):
+        chunk = rows[offset : offset + rows_per_statement]
+        params = {}
+        values = []
+        for i, row in enumerate(chunk):
+            placeholders = []
+            for column in SNAPSHOT_COLUMNS:
+                params[f"{column}_{i}"] = row[column]
+                placeholders.append(f":{column}_{i}")
+            values.append(f"({', '.join(placeholders)})")
+
+        session.execute(
+            text(
+                f"MERGE market_snapshots WITH (HOLDLOCK) AS target "
+                f"USING (VALUES {', '.join(values)}) AS source ({columns}) "
+                f"ON target.stock_id = source.stock_id AND target.ts = source.ts "
+                f"WHEN NOT MATCHED THEN INSERT ({columns}) VALUES ({source_columns});"
+            ),
+            params,
+        )
+
+
+def _insert_generic(session, rows: list[dict]):
+    """Fallback for other dialects: one lookup of the keys already stored, then a bulk insert."""
+    timestamps = [row["ts"] for row in rows]
+    existing = set(
+        session.query(MarketSnapshot.stock_id, MarketSnapshot.ts)
+        .filter(MarketSnapshot.stock_id.in_({row["stock_id"] for row in rows}))
+        .filter(MarketSnapshot.ts.between(min(timestamps), max(timestamps)))
+        .all()
+    )
+    new_rows = [row for row in rows if (row["stock_id"], row["ts"]) not in existing]
+    if new_rows:
+        session.execute(insert(MarketSnapshot), new_rows)
+
+
+def insert_snapshots(session, rows: list[dict]):
+    """Insert snapshots, skipping any whose (stock_id, ts) is already stored.
+
+    A retried round must not fail the whole batch, so duplicates are ignored on every
+    dialect, including within the batch itself.
+    """
+    unique = {}
+    for row in rows:
+        unique.setdefault((row["stock_id"], row["ts"]), row)
+    rows = list(unique.values())
+    if not rows:
+        return
+    dialect = session.get_bind().dialect.name
+    if dialect == "sqlite":
+        session.execute(sqlite_insert(MarketSnapshot).on_conflict_do_nothing(), rows)
+    elif dialect == "mssql":
+        _insert_mssql(session, rows)
+    else:
+        _insert_generic(session, rows)
+
+
+def aggregate(
+    ts: np.ndarray, price: np.ndarray, volume: np.ndarray, freq: str = "1min"
+) -> BarStore:
+    """OHLCV bars from one ticker's snapshots, sorted by ts.
+
+    Bar volume is the growth of the cumulative session volume within the bar; a drop means a
+    new session started, and then the new cumulative value counts as traded.
+    """
+    if not len(ts):
+        return BarStore()
+    step = pd.Timedelta(freq).value
+    buckets = ts - ts % step
+    starts = np.flatnonzero(np.r_[True, buckets[1:] != buckets[:-1]])
+    ends = np.r_[starts[1:], len(ts)] - 1
+    traded = np.diff(volume, prepend=volume[0])
+    reset = traded < 0
+    traded[reset] = volume[reset]
+    close = price[ends]
+    return BarStore(
+        buckets[starts],
+        {
+            "adj_close": close,
+            "close": close,
+            "high": np.maximum.reduceat(price, starts),
+            "low": np.minimum.reduceat(price, starts),
+            "open": price[starts],
+            "volume": np.add.reduceat(np.nan_to_num(traded), starts),
+        },
+    )
+
+
+@timed("snapshot_read")
+def read_snapshots(
+    tickers: list[str], start: datetime | str, end: datetime | str | None = None
+) -> dict[str, tuple[np.ndarray, np.ndarray, np.ndarray]]:
+    """(ts, price, volume) arrays per ticker for start <= ts < end, in one query."""
+    session = SessionLocal()
+    try:
+        ids = {}
+        for ticker in tickers:
+            stock_id = get_stock_id(session, ticker, create=False)
+            if stock_id is not None:
+                ids[stock_id] = ticker
+        if not ids:
+            return {}
+        statement = (
+            select(
+                MarketSnapshot.stock_id,
+                MarketSnapshot.ts,
+                MarketSnapshot.price,
+                MarketSnapshot.volume,
+            )
+            .where(MarketSnapshot.stock_id.in_(ids))
+            .where(MarketSnapshot.ts >= to_ns(start))
+            .order_by(MarketSnapshot.stock_id, MarketSnapshot.ts)
+        )
+        if end is not None:
+            statement = statement.where(MarketSnapshot.ts < to_ns(end))
+        rows = session.execute(statement).all()
+    finally:
+        session.close()
+
+    if not rows:
+        return {}
+    stock_ids, ts, price, volume = zip(*rows)
+    stock_ids = np.array(stock_ids, dtype=np.int64)
+    ts = np.array(ts, dtype=np.int64)
+    price = np.array(price, dtype=np.float64)
+    volume = np.array(volume, dtype=np.float64)
+    starts = np.flatnonzero(np.r_[True, stock_ids[1:] != stock_ids[:-1]])
+    ends = np.r_[starts[1:], len(ts)]
+    return {
+        ids[int(stock_ids[first])]: (ts[first:last], price[first:last], volume[first:last])
+        for first, last in zip(starts, ends)
+    }
+
+
+def snapshot_bars(
+    tickers: list[str],
+    start: datetime | str,
+    end: datetime | str | None = None,
+    freq: str = "1min",
+) -> dict[str, BarStore]:
+    """Bars of width freq built from the stored snapshots of each ticker."""
+    return {
+        ticker: aggregate(ts, price, volume, freq)
+        for ticker, (ts, price, volume) in read_snapshots(tickers, start, end).items()
+    }
+
+
+def poll(
+    tickers: list[str],
+    provider: MarketDataProvider | None = None,
+    writer: SnapshotWriter | None = None,
+    interval: float = DEFAULT_INTERVAL,
+    stop: threading.Event | None = None,
+):
+    """Snapshot every ticker each interval seconds until stop is set."""
+    provider = provider or YahooProvider()
+    stop = stop or threading.Event()
+    own_writer = writer is None
+    writer = writer or SnapshotWriter().start()
+    next_round = time.monotonic()
+    try:
+        while not stop.is_set():
+            taken_at = datetime.now(timezone.utc)
+            try:
+                writer.put_round(taken_at, provider.snapshot(tickers))
+            except Exception as e:
+                logger.error(f"Snapshot round failed: {e}")
+            next_round += interval
+            delay = next_round - time.monotonic()
+            if delay < 0:
+                logger.warning(f"Snapshot round took {interval - delay:.1f}s; skipping ahead.")
+                next_round = time.monotonic()
+                delay = 0
+            stop.wait(delay)
+    finally:
+        if own_writer:
+            writer.close()
+
+
+def run_load_test(
+    url: str,
+    n_tickers: int = 75,
+    interval: float = DEFAULT_INTERVAL,
+    rounds: int = 1950,
+    read_every: int = 25,
+    read_minutes: int = 60,
+) -> dict:
+    """Write `rounds` polling rounds of synthetic quotes as fast as possible.
+
+    The rounds are stamped `interval` seconds apart, so market time covered over wall time
+    is the headroom over polling in real time. Every read_every rounds the last read_minutes
+    of 1-minute bars are rebuilt for all tickers, as a monitor would.
+    """
+    from benchmark import use_database
+
+    use_database(url)
+    tickers = [f"SNAP{i:03d}" for i in range(n_tickers)]
+    provider = FakeProvider()
+    base = datetime(2024, 1, 2, 14, 30, tzinfo=timezone.utc)
+    quotes = [
+        provider.snapshot(tickers, at=base + timedelta(seconds=i * interval))
+        for i in range(rounds)
+    ]
+
+    writer = SnapshotWriter().start()
+    read_latencies = []
+    start = time.perf_counter()
+    for i, round_quotes in enumerate(quotes):
+        taken_at = base + timedelta(seconds=i * interval)
+        writer.put_round(taken_at, round_quotes)
+        if i and i % read_every == 0:
+            # Read what is stored, not whatever subset the writer has reached
+            writer.flush()
+            read_start = time.perf_counter()
+            snapshot_bars(tickers, taken_at - timedelta(minutes=read_minutes), taken_at)
+            read_latencies.append(time.perf_counter() - read_start)
+    writer.close()
+    elapsed = time.perf_counter() - start
+
+    write_histogram = metrics.histogram("snapshot_write")
+    required = n_tickers / interval
+    return {
+        "snapshots": writer.written,
+        "dropped": writer.dropped,
+        "batches": writer.batches,
+        "seconds": elapsed,
+        "snapshots_per_second": writer.written / elapsed if elapsed else 0.0,
+        "required_per_second": required,
+        "headroom": rounds * interval / elapsed if elapsed else float("inf"),
+        "write_p50_ms": write_histogram.quantile(0.5) * 1000,
+        "write_p99_ms": write_histogram.quantile(0.99) * 1000,
+        "read_p50_ms": statistics.median(read_latencies) * 1000 if read_latencies else 0.0,
+        "read_max_ms": max(read_latencies, default=0.0) * 1000,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Snapshot polling, storage and bars.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    poll_parser = commands.add_parser("poll", help="poll quotes until interrupted")
+    poll_parser.add_argument("--interval", type=float, default=DEFAULT_INTERVAL)
+    poll_parser.add_argument("--fake", action="store_true", help="use the offline FakeProvider")
+    metrics.add_arguments(poll_parser)
+
+    bars_parser = commands.add_parser("bars", help="print bars built from stored snapshots")
+    bars_parser.add_argument("ticker")
+    bars_parser.add_argument("--minutes", type=int, default=60)
+    bars_parser.add_argument("--freq", default="1min")
+
+    load_parser = commands.add_parser("loadtest", help="sustained write rate on a local file")
+    load_parser.add_argument("--url", default="sqlite:///snapshot_loadtest.db")
+    load_parser.add_argument("--tickers", type=int, default=75)
+    load_parser.add_argument("--interval", type=float, default=DEFAULT_INTERVAL)
+    load_parser.add_argument("--rounds", type=int, default=1950, help="1950 = one session")
+    load_parser.add_argument("--keep", action="store_true", help="keep the SQLite file afterwards")
+    args = parser.parse_args()
+
+    if args.command == "poll":
+        from data_updater import tickers
+
+        metrics.start_exporters(args)
+        try:
+            poll(tickers, FakeProvider() if args.fake else None, interval=args.interval)
+        except KeyboardInterrupt:
+            pass
+    elif args.command == "bars":
+        since = datetime.utcnow() - timedelta(minutes=args.minutes)
+        bars = snapshot_bars([args.ticker], since, freq=args.freq).get(args.ticker, BarStore())
+        print(bars.to_frame().to_string())
+    else:
+        sqlite_path = args.url[len("sqlite:///") :] if args.url.startswith("sqlite:///") else None
+        if sqlite_path and os.path.exists(sqlite_path):
+            parser.error(f"{sqlite_path} already exists")
+        try:
+            result = run_load_test(args.url, args.tickers, args.interval, args.rounds)
+        finally:
+            if sqlite_path and not args.keep:
+                for suffix in ("", "-wal", "-shm"):
+                    if os.path.exists(sqlite_path + suffix):
+                        os.remove(sqlite_path + suffix)
+
+        print(
+            f"\n{result['snapshots']} snapshots in {result['seconds']:.2f}s "
+            f"({result['snapshots_per_second']:.0f}/s, {result['batches']} batches), "
+            f"dropped: {result['dropped']}"
+        )
+        print(
+            f"needed {result['required_per_second']:.2f}/s for {args.tickers} tickers every "
+            f"{args.interval:g}s: headroom {result['headroom']:.0f}x"
+        )
+        print(
+            f"write p50 {result['write_p50_ms']:.2f}ms, p99 {result['write_p99_ms']:.2f}ms; "
+            f"bar read p50 {result['read_p50_ms']:.2f}ms, max {result['read_max_ms']:.2f}ms"
+        )
@@ -1,152 +1,312 @@
+import threading
 from datetime import datetime, date, timedelta
+import numpy as np
 import pandas as pd
-import yfinance as yf
-from logger import logger
+from sqlalchemy import insert, text
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import IntegrityError
+from logger import get_logger
+from metrics import timed
 from db_models import Stock, MarketData
 from db_setup import SessionLocal  
+from market_provider import MarketDataProvider, split_frame
+from market_data import MarketData as Bar
+from bar_store import BarStore, FIELDS
+from features import DEFAULT_LAGS, DEFAULT_WINDOW, Features, compute as compute_features
+from provider_cache import default_provider
+import late_bars
+
+logger = get_logger(__name__)
+
+# Columns refreshed when a bar that is already stored gets downloaded again
+UPSERT_COLUMNS = ["adj_close", "close", "high", "low", "open", "volume"]
+INSERT_COLUMNS = ["stock_id", "timestamp", "retrieved_at"] + UPSERT_COLUMNS
+# SQL Server allows at most 2100 parameters per statement
+MSSQL_MAX_PARAMS = 2000
+# Column order expected by BarStore.from_rows
+BAR_COLUMNS = [MarketData.timestamp, MarketData.retrieved_at] + [
+    getattr(MarketData, field) for field in FIELDS
+]
+
+# Process-local ticker -> stocks.id cache; ids never change once assigned
+_stock_ids: dict[str, int] = {}
+_stock_ids_lock = threading.Lock()
+
+
+def get_stock_id(session, ticker: str, create: bool = True) -> int | None:
+    """Return the stocks.id for a ticker, creating the row the first time it is seen."""
+    stock_id = _stock_ids.get(ticker)
+    if stock_id is not None:
+        return stock_id
+
+    with _stock_ids_lock:
+        if ticker in _stock_ids:
+            return _stock_ids[ticker]
+
+        db_stock = session.query(Stock).filter_by(ticker=ticker).first()
+        if not db_stock:
+            if not create:
+                return None
+            try:
+                db_stock = Stock(ticker=ticker)
+                session.add(db_stock)
+                session.commit()  # Commit to get the stock ID
+                logger.info(f"Added new stock: {ticker}")
+            except IntegrityError:
+                # Another process inserted the same ticker first
+                session.rollback()
+                db_stock = session.query(Stock).filter_by(ticker=ticker).one()
+
+        _stock_ids[ticker] = db_stock.id
+        return db_stock.id
+
+
+def _upsert_sqlite(session, rows: list[dict]):
+    stmt = sqlite_insert(MarketData)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[MarketData.stock_id, MarketData.timestamp],
+        set_={column: stmt.excluded[column] for column in UPSERT_COLUMNS},
+    )
+    session.execute(stmt, rows)
+
+
+def _upsert_mssql(session, rows: list[dict]):
+    rows_per_statement = MSSQL_MAX_PARAMS // len(INSERT_COLUMNS)
+    update_clause = ", ".join(f"target.{c} = source.{c}" for c in UPSERT_COLUMNS)
+    insert_columns = ", ".join(INSERT_COLUMNS)
+    source_columns = ", ".join(f"source.{c}" for c in INSERT_COLUMNS)
+
+    for offset in range(0, len(rows), rows_per_statement):
+        chunk = rows[offset : offset + rows_per_statement]
+        params = {}
+        values = []
+        for i, row in enumerate(chunk):
+            placeholders = []
+            for column in INSERT_COLUMNS:
+                params[f"{column}_{i}"] = row[column]
+                placeholders.append(f":{column}_{i}")
+            values.append(f"({', '.join(placeholders)})")
+
+        session.execute(
+            text(
+                f"MERGE market_data WITH (HOLDLOCK) AS target "
+                f"USING (VALUES {', '.join(values)}) AS source ({insert_columns}) "
+                f"ON target.stock_id = source.stock_id AND target.timestamp = source.timestamp "
+                f"WHEN MATCHED THEN UPDATE SET {update_clause} "
+                f"WHEN NOT MATCHED THEN INSERT ({insert_columns}) VALUES ({source_columns});"
+            ),
+            params,
+        )
+
+
+def _upsert_generic(session, rows: list[dict]):
+    """Fallback for other dialects: one lookup for the whole frame, then a bulk insert."""
+    stock_ids = {row["stock_id"] for row in rows}
+    timestamps = [row["timestamp"] for row in rows]
+    existing = set(
+        session.query(MarketData.stock_id, MarketData.timestamp)
+        .filter(MarketData.stock_id.in_(stock_ids))
+        .filter(MarketData.timestamp.in_(timestamps))
+        .all()
+    )
+    new_rows = [row for row in rows if (row["stock_id"], row["timestamp"]) not in existing]
+    if new_rows:
+        session.execute(insert(MarketData), new_rows)
+
+
+def upsert_market_data(session, rows: list[dict]):
+    """Insert bars, refreshing the OHLCV columns of bars that are already stored."""
+    if not rows:
+        return
+    dialect = session.get_bind().dialect.name
+    if dialect == "sqlite":
+        _upsert_sqlite(session, rows)
+    elif dialect == "mssql":
+        _upsert_mssql(session, rows)
+    else:
+        _upsert_generic(session, rows)
+
+@timed("db_read")
+def fetch_universe_snapshot(tickers: list[str], minutes: int = 5) -> dict[str, BarStore]:
+    """Fetch the last N minutes of bars for many tickers in a single query."""
+    session = SessionLocal()
+
+    try:
+        since = datetime.utcnow() - timedelta(minutes=minutes)
+        rows = session.query(Stock.ticker, *BAR_COLUMNS) \
+            .join(MarketData, MarketData.stock_id == Stock.id) \
+            .filter(Stock.ticker.in_(tickers)) \
+            .filter(MarketData.timestamp >= since) \
+            .order_by(Stock.ticker, MarketData.timestamp) \
+            .all()
+    except Exception as e:
+        logger.error(f"Error fetching universe snapshot from the database: {e}")
+        return {}
+    finally:
+        session.close()
+
+    snapshot: dict[str, list] = {}
+    for ticker, *bar in rows:
+        snapshot.setdefault(ticker, []).append(bar)
+    logger.info(f"Fetched {len(rows)} bars for {len(snapshot)}/{len(tickers)} tickers in one query.")
+    return {ticker: BarStore.from_rows(bars) for ticker, bars in snapshot.items()}
+
 
 class StockRaw:
-    def __init__(self, ticker: str):
+    def __init__(self, ticker: str, provider: MarketDataProvider | None = None):
         self.ticker: str = ticker
+        self._provider = provider
         self.raw_market_data: pd.DataFrame = pd.DataFrame()
-        self.market_data: dict[datetime, MarketData] = {}
+        self.market_data: BarStore = BarStore()
+        self._features: dict = {}
+
+    @property
+    def provider(self) -> MarketDataProvider:
+        # Resolved on the first download: stocks built from stored bars never open the cache
+        if self._provider is None:
+            self._provider = default_provider()
+        return self._provider
+
+    @classmethod
+    def from_frame(cls, ticker: str, frame: pd.DataFrame, provider: MarketDataProvider | None = None) -> "StockRaw":
+        """Build a StockRaw from a (possibly multi-ticker) frame that was already downloaded."""
+        stock = cls(ticker, provider)
+        stock.raw_market_data = split_frame(frame, ticker)
+        stock.structure_market_data()
+        return stock
+
+    @classmethod
+    def from_bars(cls, ticker: str, bars: BarStore) -> "StockRaw":
+        """Wrap bars that were already loaded (e.g. by fetch_universe_snapshot)."""
+        stock = cls(ticker)
+        stock.market_data = bars
+        return stock
 
     def obtain_market_data(self, start: datetime | date | str = datetime.now().date(), end: datetime | date | str = datetime.now()) -> None:
-        """Download stock data from Yahoo Finance and structure it."""
-        logger.debug(f"Begin downloading data for {self.ticker}")
-        fetched_data = yf.download(self.ticker, start=start, end=end, interval="1m")
+        """Download stock data from the market data provider and structure it."""
+        logger.debug("Begin downloading data for %s", self.ticker)
+        fetched_data = self.provider.download([self.ticker], start=start, end=end, interval="1m")
         self.raw_market_data = fetched_data
         logger.debug("Data downloaded")
         self.structure_market_data()
 
+    @timed("structure")
     def structure_market_data(self):
         """Process the downloaded market data and structure it."""
         logger.debug("Structuring market data")
 
         if isinstance(self.raw_market_data.columns, pd.MultiIndex):
-            self.raw_market_data = self.raw_market_data.xs(key=self.ticker, axis=1, level=1)
-            logger.debug(f"Extracted data for {self.ticker} from MultiIndex")
-
-        for timestamp, row in self.raw_market_data.iterrows():
-            try:
-                open_price = row["Open"]
-                high_price = row["High"]
-                low_price = row["Low"]
-                close_price = row["Close"]
-                volume = row["Volume"]
-                adj_close_price = row.get("Adj Close", close_price)
-                logger.debug(f"Row at {timestamp}: Open={open_price}, Close={close_price}, Volume={volume}")
-                if any(pd.isna([open_price, high_price, low_price, close_price, volume])):
-                    logger.warning(f"Missing data for {timestamp}")
-                    continue
-
-                # Store the data in the market_data dictionary
-                self.market_data[timestamp] = MarketData(
-                    timestamp=timestamp,
-                    adj_close=adj_close_price,
-                    close=close_price,
-                    high=high_price,
-                    low=low_price,
-                    open=open_price,
-                    volume=volume,
-                )
-
-            except KeyError as e:
-                logger.error(f"Missing column: {e}")
-            except Exception as e:
-                logger.error(f"Error structuring data: {e}")
-    
-    def save_to_db(self):
-        session = SessionLocal()  # Create a new session
+            self.raw_market_data = split_frame(self.raw_market_data, self.ticker)
+            logger.debug("Extracted data for %s from MultiIndex", self.ticker)
 
         try:
-            # Check if the stock already exists in the DB
-            db_stock = session.query(Stock).filter_by(ticker=self.ticker).first()
+            self.market_data = BarStore.from_frame(self.raw_market_data)
+        except KeyError as e:
+            logger.error(f"Missing column: {e}")
+            return
+        except Exception as e:
+            logger.error(f"Error structuring data: {e}")
+            return
+
+        dropped = len(self.raw_market_data) - len(self.market_data)
+        if dropped:
+            logger.warning("Skipped %d bars with missing data for %s", dropped, self.ticker)
+        logger.debug("Structured %d bars for %s", len(self.market_data), self.ticker)
+
+    def market_data_rows(self, stock_id: int) -> list[dict]:
+        """Return the structured bars as plain dicts ready for a bulk insert."""
+        bars = self.market_data
+        retrieved_at = datetime.utcnow()
+        timestamps = bars.index().to_pydatetime()
+        columns = [bars.column(field).tolist() for field in FIELDS]
+        return [
+            {"stock_id": stock_id, "timestamp": timestamp, "retrieved_at": retrieved_at}
+            | dict(zip(FIELDS, values))
+            for timestamp, *values in zip(timestamps, *columns)
+        ]
+
+    @timed("db_write")
+    def save_to_db(self, late: bool = False) -> bool:
+        """Upsert all structured bars for this ticker in a single statement.
+
+        late=True is for bars that may lie behind the indicator and rollup watermarks (gap
+        fills); they are marked for both jobs to reprocess. Returns False when the write
+        failed (the error is logged).
+        """
+        if not self.market_data:
+            logger.debug("No market data to save for %s", self.ticker)
+            return True
 
-            if not db_stock:
-                db_stock = Stock(ticker=self.ticker)
-                session.add(db_stock)
-                session.commit()  # Commit to get the stock ID
-                logger.info(f"Added new stock: {self.ticker}")
-
-            # Collect all MarketData entries and associate them with the stock
-            market_data_objects = []
-            for timestamp, md in self.market_data.items():
-                # Check if the data already exists for the stock and timestamp
-                existing_data = session.query(MarketData).filter_by(stock_id=db_stock.id, timestamp=md.timestamp).first()
-                if existing_data:
-                    logger.debug(f"Skipping duplicate data for {self.ticker} at {timestamp}")
-                    continue
-
-                db_md = MarketData(
-                    stock_id=db_stock.id,
-                    timestamp=md.timestamp,
-                    adj_close=md.adj_close,
-                    close=md.close,
-                    high=md.high,
-                    low=md.low,
-                    open=md.open,
-                    volume=md.volume,
-                    retrieved_at=datetime.utcnow()
-                )          
-                market_data_objects.append(db_md)
-
-            if market_data_objects:
-                session.add_all(market_data_objects)
+        session = SessionLocal()  # Create a new session
 
+        try:
+            stock_id = get_stock_id(session, self.ticker)
+            rows = self.market_data_rows(stock_id)
+            upsert_market_data(session, rows)
+            if late:
+                late_bars.mark(session, stock_id, rows[0]["timestamp"])
             session.commit()
-            logger.info(f"Saved market data for {self.ticker} to database.")
-            logger.debug(f"Preparing to insert MarketData for {timestamp}, volume={md.volume}")
+            logger.info("Saved %d market data rows for %s to database.", len(rows), self.ticker)
+            return True
 
         except Exception as e:
             logger.error(f"Failed to save {self.ticker} to DB: {e}")
             session.rollback() 
+            return False
         finally:
             session.close() 
 
 
+    @timed("db_read")
     def fetch_market_data_from_db(self):
         """Fetch the last 5 minutes of market data from the database."""
         session = SessionLocal()
 
         try:
-            db_stock = session.query(Stock).filter_by(ticker=self.ticker).first()
+            stock_id = get_stock_id(session, self.ticker, create=False)
 
-            if not db_stock:
-                logger.warning(f"Stock {self.ticker} not found in the database.")
+            if stock_id is None:
+                logger.warning("Stock %s not found in the database.", self.ticker)
                 return
 
             now = datetime.utcnow()
             five_minutes_ago = now - timedelta(minutes=5)
 
-            db_market_data = session.query(MarketData) \
-                .filter(MarketData.stock_id == db_stock.id) \
+            db_market_data = session.query(*BAR_COLUMNS) \
+                .filter(MarketData.stock_id == stock_id) \
                 .filter(MarketData.timestamp >= five_minutes_ago) \
-                .order_by(MarketData.timestamp.desc()) \
+                .order_by(MarketData.timestamp) \
                 .all()
 
-            self.market_data = {md.timestamp: md for md in db_market_data}
+            self.market_data = BarStore.from_rows(db_market_data)
 
-            logger.info(f"Successfully fetched {len(self.market_data)} market data points for {self.ticker} from the database.")
+            logger.info(
+                "Successfully fetched %d market data points for %s from the database.",
+                len(self.market_data), self.ticker,
+            )
         except Exception as e:
             logger.error(f"Error fetching data for {self.ticker} from the database: {e}")
         finally:
             session.close()
     
-    def get_last_two_snapshots(self) -> list[MarketData]:
+    def get_last_two_snapshots(self) -> list[Bar]:
         """Return the last two data points based on retrieved_at timestamps."""
         if len(self.market_data) < 2:
-            logger.debug(f"Not enough data points to get last two snapshots for {self.ticker}.")
+            logger.debug("Not enough data points to get last two snapshots for %s.", self.ticker)
             return []
 
-        sorted_data = sorted(self.market_data.values(), key=lambda x: x.retrieved_at)
-        return sorted_data[-2:]
+        bars = self.market_data
+        if bars.retrieved_at is None:
+            return [bars.bar(-2), bars.bar(-1)]
+        # Bars are stored in timestamp order, so a stable sort breaks retrieved_at ties by time
+        order = np.argsort(bars.retrieved_at, kind="stable")
+        return [bars.bar(order[-2]), bars.bar(order[-1])]
 
     def get_change_since_last_retrieved(self) -> dict | None:
         """Calculate price and volume change between last two retrievals."""
         snapshots = self.get_last_two_snapshots()
         if len(snapshots) < 2:
-            logger.debug(f"Not enough snapshots to calculate change for {self.ticker}.")
+            logger.debug("Not enough snapshots to calculate change for %s.", self.ticker)
             return None
 
         prev, curr = snapshots
@@ -154,7 +314,11 @@ class StockRaw:
         result = {
             "price_change": None,
             "volume_change": None,
-            "time_diff": (curr.retrieved_at - prev.retrieved_at)
+            "time_diff": (
+                curr.retrieved_at - prev.retrieved_at
+                if curr.retrieved_at is not None
+                else curr.timestamp - prev.timestamp
+            ),
         }
 
         try:
@@ -169,12 +333,21 @@ class StockRaw:
 
         return result
 
+    def features(
+        self, lags: tuple[int, ...] = DEFAULT_LAGS, window: int = DEFAULT_WINDOW
+    ) -> Features:
+        """Price/volume changes for all lags in one pass, reused until a new bar arrives."""
+        return compute_features(self.market_data, lags, window, self._features)
+
     def get_price(self, key="close") -> float:
         """Return the most recent price by key (e.g., 'close', 'open')."""
         if not self.market_data:
             return 0.0
-        latest = sorted(self.market_data.values(), key=lambda x: x.timestamp)[-1]
-        return getattr(latest, key.lower(), 0.0) or 0.0
+        try:
+            price = self.market_data.latest(key.lower())
+        except KeyError:
+            return 0.0
+        return 0.0 if np.isnan(price) else price
 
     def __repr__(self):
         return f"Stock({self.ticker})"
\ No newline at end of file
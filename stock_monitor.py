@@ -1,89 +1,140 @@
 import time
-import json
-import multiprocessing
-from logger import logger
+import numpy as np
+from logger import get_logger
 from wallet import VirtualWallet
-from stock_db import StockRaw  # Updated import: new class with DB integration
+from bar_store import BarStore
+from bar_cache import BarCache
+from stock_db import StockRaw, fetch_universe_snapshot
+from metrics import observe, timed
+from signal_scanner import SignalScanner
+from trading_rules import COOLDOWN_PERIOD
 
-def monitor_stock(ticker):
-    volume_threshold = 0.25
-    price_threshold = 0.01
-    cooldown_period = 360 
-
-    wallet = VirtualWallet(filename="wallet.json")
-    logger.debug(f"Initial wallet balance: {wallet.check_balance()}")
-
-    if ticker in wallet.sell_cooldowns:
-        last_sell_time = wallet.sell_cooldowns[ticker]
-        if time.time() - last_sell_time < cooldown_period:
-            remaining = cooldown_period - (time.time() - last_sell_time)
-            logger.info(f"Cooldown active for {ticker}. Try again in {remaining:.2f} seconds.")
-            return
-
-    stock = StockRaw(ticker)
-    stock.fetch_market_data_from_db()
-
-
-    if ticker in wallet.stocks:
-        snapshots = stock.get_last_two_snapshots()
-        if not snapshots or not snapshots[-1].close:
-            logger.warning(f"Not enough or invalid data to evaluate selling {ticker}.")
-            return
-
-        if wallet.sell_stock(stock):
-            logger.info(f"Sold {ticker} based on trailing stop loss.")
-            wallet.sell_cooldowns[ticker] = time.time()
-            wallet.save_wallet(wallet.filename)
-        else:
-            logger.info(f"Trailing stop loss not triggered for {ticker}.")
-        return
+logger = get_logger(__name__)
 
-    # If not owned, check for buy signal
-    logger.info(f"Monitoring stock: {ticker} for buying conditions.")
-    change = stock.get_change_since_last_retrieved()
-    if not change:
-        logger.info(f"Insufficient data to evaluate buying {ticker}.")
-        return
+SNAPSHOT_MINUTES = 5
+
+TICKERS = [
+    "ADTX", "BIVI", "IMUX", "AUR", "CAPT", "THTX", "BHAT", "BLUE", "SILO", "SANA",
+    "AEON", "IFBD", "PMNT", "RAPT", "BNGO", "ALZN", "SAGE", "ACRV", "RSLS", "TIVC",
+    "PSTX", "BJDX", "NDRA", "GOVX", "MBIO", "ATAI", "CELU", "PRFX", "TOVX", "ONCT",
+    "LGVN", "PHGE", "WINT", "HLVX", "BCTX", "BNOX", "EVAX", "BLRX", "IMRX", "CTOR",
+    "AILE", "AVTX", "AQB", "ICCT", "CYN", "KITT", "SLDP", "NLSP", "GCTK", "VINC",
+    "KPTI", "MITQ", "PTPI", "SURG", "PRPH", "CRKN", "MEGL", "BMRA", "ENSC", "CTXR",
+    "EKSO", "INVZ", "HOTH", "XAIR", "PHIO", "MYSZ", "LPSN", "MLGO", "LPTX", "OCEA",
+    "GV", "WTO", "APVO"
+]
+
+# Per-process reader of the updater's shared-memory bar cache (attached lazily)
+_bar_cache: BarCache | None = None
+
+
+def get_bar_cache() -> BarCache:
+    global _bar_cache
+    if _bar_cache is None:
+        _bar_cache = BarCache()
+    return _bar_cache
 
-    price_change = change.get("price_change")
-    volume_change = change.get("volume_change")
 
-    if (price_change is not None and abs(price_change) > price_threshold and
-        volume_change is not None and abs(volume_change) > volume_threshold):
-        
-        logger.info(f"Buy conditions met for {ticker} (Δprice={price_change}, Δvolume={volume_change}).")
-        if wallet.buy_stock(stock, minutes_ago=1):
-            wallet.save_wallet(wallet.filename)
+def _describe(features: dict[str, float]) -> str:
+    return ", ".join(f"{name}={value:.6g}" for name, value in features.items())
+
+
+def _check_sell(wallet: VirtualWallet, stock: StockRaw):
+    snapshots = stock.get_last_two_snapshots()
+    if not snapshots or not snapshots[-1].close:
+        logger.warning(f"Not enough or invalid data to evaluate selling {stock.ticker}.")
+        return
+
+    # sell_stock persists the sale and the cooldown itself
+    if wallet.sell_stock(stock):
+        logger.info("Sold %s based on trailing stop loss.", stock.ticker)
     else:
-        logger.info(f"Buy conditions NOT met for {ticker} (Δprice={price_change}, Δvolume={volume_change}).")
+        logger.info("Trailing stop loss not triggered for %s.", stock.ticker)
+
+
+def monitor_round(tickers: list[str], scanner: SignalScanner | None = None) -> float:
+    """Run one monitoring round over the whole universe; returns the round latency in seconds.
+
+    The wallet is loaded once. Bars come from the updater's shared-memory cache; tickers
+    it does not have (fresh) are fetched with a single DB query. The buy rule is evaluated
+    for all candidates in one vectorised scan; buys are made best candidate first.
+    """
+    start_time = time.perf_counter()
+    scanner = scanner or SignalScanner()
+    with timed("wallet_load"):
+        wallet = VirtualWallet(filename="wallet.json")
+    cache = get_bar_cache()
+    snapshot: dict[str, BarStore] = {}
+    cached: set[str] = set()
+    with timed("cache_read"):
+        for ticker in tickers:
+            bars = cache.read(ticker, SNAPSHOT_MINUTES)
+            if bars is not None:
+                snapshot[ticker] = bars
+                cached.add(ticker)
+    missing = [ticker for ticker in tickers if ticker not in cached]
+    if missing:
+        snapshot.update(fetch_universe_snapshot(missing, SNAPSHOT_MINUTES))
+    logger.debug("%d/%d tickers served from the shared bar cache.", len(cached), len(tickers))
+    now = time.time()
+
+    candidates: dict[str, BarStore] = {}
+    for ticker in tickers:
+        last_sell_time = wallet.sell_cooldowns.get(ticker)
+        if last_sell_time is not None and now - last_sell_time < COOLDOWN_PERIOD:
+            remaining = COOLDOWN_PERIOD - (now - last_sell_time)
+            logger.info("Cooldown active for %s. Try again in %.2f seconds.", ticker, remaining)
+            continue
+
+        bars = snapshot.get(ticker, BarStore())
+        if ticker in wallet.stocks:
+            _check_sell(wallet, StockRaw.from_bars(ticker, bars))
+            continue
+        candidates[ticker] = bars
+
+    with timed("decision"):
+        matrix = scanner.matrix(candidates)
+        selected = scanner.scan(matrix)
+
+    chosen = {candidate.ticker for candidate in selected}
+    for i, ticker in enumerate(matrix.tickers):
+        if ticker in chosen:
+            continue
+        features = matrix.row(i)
+        if all(np.isnan(value) for value in features.values()):
+            logger.info("Insufficient data to evaluate buying %s.", ticker)
+        else:
+            logger.info("Buy conditions NOT met for %s (%s).", ticker, _describe(features))
+    for candidate in selected:
+        logger.info(
+            "Buy conditions met for %s (confidence %.3f, %s).",
+            candidate.ticker, candidate.confidence, _describe(candidate.features),
+        )
+        stock = StockRaw.from_bars(candidate.ticker, candidates[candidate.ticker])
+        wallet.buy_stock(stock, minutes_ago=1)
+
+    logger.debug("Balance: %s", wallet.check_balance())
+    logger.debug("Portfolio: %s", wallet.check_portfolio())
+    wallet.close()
 
-    logger.debug(f"Balance: {wallet.check_balance()}")
-    logger.debug(f"Portfolio: {wallet.check_portfolio()}")
+    elapsed = time.perf_counter() - start_time
+    observe("monitor_round", elapsed)
+    logger.info(f"Monitoring round for {len(tickers)} tickers complete in {elapsed * 1000:.1f}ms.")
+    return elapsed
 
 
-def monitor_stocks_parallel():
-    tickers = [
-        "ADTX", "BIVI", "IMUX", "AUR", "CAPT", "THTX", "BHAT", "BLUE", "SILO", "SANA",
-        "AEON", "IFBD", "PMNT", "RAPT", "BNGO", "ALZN", "SAGE", "ACRV", "RSLS", "TIVC",
-        "PSTX", "BJDX", "NDRA", "GOVX", "MBIO", "ATAI", "CELU", "PRFX", "TOVX", "ONCT",
-        "LGVN", "PHGE", "WINT", "HLVX", "BCTX", "BNOX", "EVAX", "BLRX", "IMRX", "CTOR",
-        "AILE", "AVTX", "AQB", "ICCT", "CYN", "KITT", "SLDP", "NLSP", "GCTK", "VINC",
-        "KPTI", "MITQ", "PTPI", "SURG", "PRPH", "CRKN", "MEGL", "BMRA", "ENSC", "CTXR",
-        "EKSO", "INVZ", "HOTH", "XAIR", "PHIO", "MYSZ", "LPSN", "MLGO", "LPTX", "OCEA",
-        "GV", "WTO", "APVO"
-    ]
+def monitor_stock(ticker):
+    """Evaluate a single ticker (same rules as a full round)."""
+    monitor_round([ticker])
 
-    max_cores = int(multiprocessing.cpu_count() * 0.7)
-    chunk_size = len(tickers) // max_cores + 1
-    ticker_chunks = [tickers[i:i + chunk_size] for i in range(0, len(tickers), chunk_size)]
 
+def run_monitor_loop():
+    # One core is enough: the whole universe is scanned in a single vectorised pass
     while True:
-        with multiprocessing.Pool(processes=max_cores) as pool:
-            pool.map(monitor_stock, [ticker for chunk in ticker_chunks for ticker in chunk])
-
+        monitor_round(TICKERS)
         logger.info("Round complete. Restarting monitoring cycle after delay.")
         time.sleep(15)
 
 
 if __name__ == "__main__":
-    monitor_stocks_parallel()
+    run_monitor_loop()
@@ -1,33 +1,133 @@
-import pyodbc
+"""Connection-pool benchmark for the configured database engine.
+
+Runs a mix of bar upserts and recent-bar reads from many threads, the way the data updater
+and the monitor hit the database, and reports throughput, latency percentiles and errors.
+Defaults to a throwaway local SQLite file:
+
+    python stresstest.py --threads 100 --ops 50
+    python stresstest.py --url "mssql+pyodbc://..."    # any SQLAlchemy URL
+    python stresstest.py --no-wal                      # compare against the rollback journal
+"""
+import argparse
+import os
+import random
+import time
 from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta
+from sqlalchemy.orm import sessionmaker
+from db_models import Base, MarketData
+from db_setup import create_db_engine, load_db_config
+from stock_db import get_stock_id, upsert_market_data
+
+
+def _worker(Session, worker_id: int, ops: int, write_ratio: float) -> tuple[list[float], int]:
+    latencies = []
+    errors = 0
+    ticker = f"STRESS{worker_id % 75:02d}"
+    base = datetime(2024, 1, 2, 14, 30) + timedelta(days=worker_id)
+
+    for i in range(ops):
+        session = Session()
+        start = time.perf_counter()
+        try:
+            stock_id = get_stock_id(session, ticker)
+            if random.random() < write_ratio:
+                ts = base + timedelta(minutes=i)
+                row = {
+                    "stock_id": stock_id,
+                    "timestamp": ts,
+                    "retrieved_at": datetime.utcnow(),
+                    "adj_close": 5.0,
+                    "close": 5.0,
+                    "high": 5.1,
+                    "low": 4.9,
+                    "open": 5.0,
+                    "volume": 1000.0,
+                }
+                upsert_market_data(session, [row])
+                session.commit()
+            else:
+                session.query(MarketData.timestamp, MarketData.close).filter(
+                    MarketData.stock_id == stock_id
+                ).order_by(MarketData.timestamp.desc()).limit(5).all()
+            latencies.append(time.perf_counter() - start)
+        except Exception as e:
+            errors += 1
+            session.rollback()
+            print(f"Thread {worker_id}: Failed - {e}")
+        finally:
+            session.close()
+
+    return latencies, errors
+
+
+def run_pool_benchmark(
+    config: dict, threads: int = 100, ops: int = 50, write_ratio: float = 0.3
+) -> dict:
+    engine = create_db_engine(config)
+    Base.metadata.create_all(engine)
+    Session = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
-conn_str = (
-    "Driver={ODBC Driver 18 for SQL Server};"
-    "Server=DESKTOP-7Q8DA2Q\\SQLEXPRESS;"
-    "Database=stock_db;"
-    "Trusted_Connection=yes;"
-    "TrustServerCertificate=yes;"
-)
+    latencies = []
+    errors = 0
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        futures = [
+            executor.submit(_worker, Session, i, ops, write_ratio) for i in range(threads)
+        ]
+        for f in as_completed(futures):
+            worker_latencies, worker_errors = f.result()
+            latencies.extend(worker_latencies)
+            errors += worker_errors
+    elapsed = time.perf_counter() - start
+    engine.dispose()
 
-def test_db_connection(i):
+    latencies.sort()
+
+    def percentile(p: float) -> float:
+        if not latencies:
+            return float("nan")
+        return latencies[min(len(latencies) - 1, int(p * len(latencies)))] * 1000
+
+    return {
+        "operations": len(latencies),
+        "errors": errors,
+        "seconds": elapsed,
+        "ops_per_second": len(latencies) / elapsed if elapsed else 0.0,
+        "p50_ms": percentile(0.50),
+        "p95_ms": percentile(0.95),
+        "p99_ms": percentile(0.99),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the pooled database engine.")
+    parser.add_argument("--url", default="sqlite:///stresstest.db")
+    parser.add_argument("--threads", type=int, default=100)
+    parser.add_argument("--ops", type=int, default=50, help="operations per thread")
+    parser.add_argument("--write-ratio", type=float, default=0.3)
+    parser.add_argument("--no-wal", action="store_true", help="SQLite: keep the rollback journal")
+    parser.add_argument("--keep", action="store_true", help="keep the SQLite file afterwards")
+    args = parser.parse_args()
+
+    config = load_db_config()
+    config["url"] = args.url
+    config["sqlite_wal"] = not args.no_wal
+
+    sqlite_path = args.url[len("sqlite:///") :] if args.url.startswith("sqlite:///") else None
     try:
-        with pyodbc.connect(conn_str, timeout=5) as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT 1")
-            result = cursor.fetchone()
-            print(f"Thread {i}: Success")
-            return True
-    except Exception as e:
-        print(f"Thread {i}: Failed - {e}")
-        return False
-
-max_threads = 200  # You can adjust this to stress-test your SQL Server
-successes = 0
-
-with ThreadPoolExecutor(max_workers=max_threads) as executor:
-    futures = [executor.submit(test_db_connection, i) for i in range(max_threads)]
-    for f in as_completed(futures):
-        if f.result():
-            successes += 1
-
-print(f"\n Successful connections: {successes}/{max_threads}")
+        result = run_pool_benchmark(config, args.threads, args.ops, args.write_ratio)
+    finally:
+        if sqlite_path and not args.keep:
+            for suffix in ("", "-wal", "-shm"):
+                if os.path.exists(sqlite_path + suffix):
+                    os.remove(sqlite_path + suffix)
+
+    print(
+        f"\n{result['operations']} ops in {result['seconds']:.2f}s "
+        f"({result['ops_per_second']:.0f} ops/s), errors: {result['errors']}"
+    )
+    print(
+        f"latency p50 {result['p50_ms']:.2f}ms, p95 {result['p95_ms']:.2f}ms, "
+        f"p99 {result['p99_ms']:.2f}ms"
+    )
@@ -0,0 +1,187 @@
+"""Sweep the monitor and wallet parameters over historical bars on all cores.
+
+The bars are prepared once (backtest.ReplayData) and copied into a single shared-memory
+block. Pool workers map that block in their initializer and run every configuration they
+get against the same arrays, so nothing is reloaded or pickled per configuration.
+
+    python sweep.py --synthetic 75 --days 60 --random 500
+    python sweep.py --start 2024-01-01 --end 2025-01-01 --grid --out sweep_results.csv
+"""
+import argparse
+import itertools
+import multiprocessing
+import random
+import time
+from datetime import datetime
+import numpy as np
+import pandas as pd
+from multiprocessing import shared_memory
+from backtest import BacktestConfig, ReplayData, load_bars, load_npz, run_backtest, synthetic_bars
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+# 5 x 4 x 3 x 3 x 3 = 540 configurations
+DEFAULT_GRID = {
+    "price_threshold": [0.005, 0.01, 0.015, 0.02, 0.03],
+    "volume_threshold": [0.1, 0.25, 0.5, 1.0],
+    "cooldown": [0, 360, 1800],
+    "initial_stop": [0.95, 0.965, 0.98],
+    "trailing_stop": [0.95, 0.97, 0.985],
+}
+# (low, high) per parameter for random search
+RANDOM_SPACE = {
+    "price_threshold": (0.003, 0.05),
+    "volume_threshold": (0.05, 2.0),
+    "cooldown": (0, 3600),
+    "initial_stop": (0.9, 0.995),
+    "trailing_stop": (0.9, 0.995),
+}
+SUMMARY_COLUMNS = [
+    "total_return",
+    "max_drawdown",
+    "return_over_drawdown",
+    "trades",
+    "win_rate",
+    "avg_return",
+    "avg_bars_held",
+    "seconds",
+]
+# Metrics where a smaller value is the better configuration
+LOWER_IS_BETTER = {"max_drawdown", "avg_bars_held", "seconds"}
+
+
+def grid_configs(grid: dict[str, list] = DEFAULT_GRID) -> list[dict]:
+    names = list(grid)
+    return [dict(zip(names, values)) for values in itertools.product(*grid.values())]
+
+
+def random_configs(
+    count: int, space: dict[str, tuple] = RANDOM_SPACE, seed: int = 0
+) -> list[dict]:
+    rng = random.Random(seed)
+    return [
+        {name: round(rng.uniform(low, high), 4) for name, (low, high) in space.items()}
+        for _ in range(count)
+    ]
+
+
+class SharedReplay:
+    """Copy of a ReplayData in one shared-memory block; `spec` lets workers map it."""
+
+    def __init__(self, data: ReplayData):
+        arrays = dict(data.arrays, offsets=data.offsets, grid=data.grid)
+        size = sum(array.nbytes for array in arrays.values())
+        self.shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        layout = []
+        position = 0
+        for name, array in arrays.items():
+            target = np.ndarray(array.shape, array.dtype, buffer=self.shm.buf, offset=position)
+            target[:] = array
+            layout.append((name, position, array.dtype.str, array.shape))
+            position += array.nbytes
+        del target
+        self.spec = {"name": self.shm.name, "tickers": data.tickers, "layout": layout}
+
+    def close(self):
+        self.shm.close()
+        self.shm.unlink()
+
+
+def attach(spec: dict) -> tuple[shared_memory.SharedMemory, ReplayData]:
+    shm = shared_memory.SharedMemory(name=spec["name"])
+    arrays = {
+        name: np.ndarray(shape, np.dtype(dtype), buffer=shm.buf, offset=offset)
+        for name, offset, dtype, shape in spec["layout"]
+    }
+    offsets, grid = arrays.pop("offsets"), arrays.pop("grid")
+    return shm, ReplayData(spec["tickers"], offsets, arrays, grid)
+
+
+# Set in each worker by _init_worker; the shm handle keeps the mapping alive
+_worker_shm: shared_memory.SharedMemory | None = None
+_worker_data: ReplayData | None = None
+
+
+def _init_worker(spec: dict):
+    global _worker_shm, _worker_data
+    _worker_shm, _worker_data = attach(spec)
+
+
+def _run_config(params: dict) -> dict:
+    result = run_backtest(_worker_data, BacktestConfig(**params))
+    summary = result.summary()
+    drawdown = summary["max_drawdown"]
+    summary["return_over_drawdown"] = summary["total_return"] / drawdown if drawdown else np.nan
+    return params | {column: summary[column] for column in SUMMARY_COLUMNS}
+
+
+def run_sweep(
+    data: ReplayData,
+    configs: list[dict],
+    processes: int | None = None,
+    rank_by: str = "total_return",
+) -> pd.DataFrame:
+    """Run every configuration on a pool and return the results ranked best-first."""
+    processes = processes or multiprocessing.cpu_count()
+    shared = SharedReplay(data)
+    started = time.perf_counter()
+    rows = []
+    try:
+        with multiprocessing.Pool(
+            processes, initializer=_init_worker, initargs=(shared.spec,)
+        ) as pool:
+            for row in pool.imap_unordered(_run_config, configs):
+                rows.append(row)
+                if len(rows) % 50 == 0 or len(rows) == len(configs):
+                    elapsed = time.perf_counter() - started
+                    logger.info(
+                        f"Sweep: {len(rows)}/{len(configs)} configurations "
+                        f"({elapsed / len(rows):.2f}s each over {processes} processes)"
+                    )
+    finally:
+        shared.close()
+
+    table = pd.DataFrame(rows).sort_values(
+        rank_by, ascending=rank_by in LOWER_IS_BETTER, na_position="last"
+    )
+    table.insert(0, "rank", range(1, len(table) + 1))
+    return table.reset_index(drop=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Parameter sweep over historical bars.")
+    parser.add_argument("--start", type=datetime.fromisoformat)
+    parser.add_argument("--end", type=datetime.fromisoformat)
+    parser.add_argument("--tickers", nargs="*")
+    parser.add_argument("--npz", help="read bars from a columnar export instead of the DB")
+    parser.add_argument("--archive", metavar="ROOT", help="read bars from the Parquet archive")
+    parser.add_argument("--synthetic", type=int, metavar="TICKERS")
+    parser.add_argument("--days", type=int, default=252)
+    parser.add_argument("--grid", action="store_true", help="run DEFAULT_GRID (the default)")
+    parser.add_argument("--random", type=int, metavar="N", help="N random configurations instead")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--processes", type=int)
+    parser.add_argument("--rank-by", default="total_return", choices=SUMMARY_COLUMNS)
+    parser.add_argument("--out", default="sweep_results.csv")
+    args = parser.parse_args()
+
+    if args.synthetic:
+        bars = synthetic_bars(args.synthetic, args.days)
+    elif args.npz:
+        bars = load_npz(args.npz)
+    elif args.archive:
+        from archive import read_bars
+
+        bars = read_bars(args.archive, args.tickers, args.start, args.end)
+    else:
+        bars = load_bars(args.tickers, args.start, args.end)
+    data = ReplayData.from_bars(bars)
+    del bars
+
+    configs = random_configs(args.random, seed=args.seed) if args.random else grid_configs()
+    logger.info(f"Sweeping {len(configs)} configurations over {data.bars:,} bars.")
+    table = run_sweep(data, configs, args.processes, args.rank_by)
+    table.to_csv(args.out, index=False)
+    print(table.head(10).to_string(index=False))
+    print(f"\nFull ranking written to {args.out}")
@@ -0,0 +1,67 @@
+from datetime import datetime, timedelta
+import pytest
+from sqlalchemy import func
+from benchmark import use_database
+from db_models import MarketData, MarketDataRollup, Stock
+from db_setup import SessionLocal
+import rollups
+
+DAY = datetime(2024, 1, 2)
+OPEN = DAY + timedelta(hours=14)
+
+
+@pytest.fixture
+def session(tmp_path):
+    use_database(f"sqlite:///{tmp_path / 'rollups.db'}")
+    session = SessionLocal()
+    yield session
+    session.close()
+
+
+def _add_bars(session, stock_id: int, start: datetime, minutes: int):
+    session.add_all(
+        MarketData(
+            stock_id=stock_id,
+            timestamp=start + timedelta(minutes=minute),
+            open=10.0,
+            high=11.0,
+            low=9.0,
+            close=10.0,
+            adj_close=10.0,
+            volume=100.0,
+        )
+        for minute in range(minutes)
+    )
+    session.commit()
+
+
+def _bar_counts(session, stock_id: int) -> dict[str, int]:
+    rows = (
+        session.query(MarketDataRollup.resolution, func.sum(MarketDataRollup.bar_count))
+        .filter(MarketDataRollup.stock_id == stock_id)
+        .group_by(MarketDataRollup.resolution)
+    )
+    return dict(rows.all())
+
+
+def test_tail_arriving_after_another_stock_moved_on_is_rolled_up(session):
+    session.add_all([Stock(id=1, ticker="FAST"), Stock(id=2, ticker="SLOW")])
+    session.commit()
+    # SLOW is backed off: its bars stop at 14:10 while FAST's reach 15:30
+    _add_bars(session, 1, OPEN, 90)
+    _add_bars(session, 2, OPEN, 10)
+    rollups.update(session, now=OPEN + timedelta(minutes=90))
+
+    # SLOW's tail arrives as an ordinary tail download, behind FAST's watermarks
+    _add_bars(session, 2, OPEN + timedelta(minutes=10), 80)
+    # Pruning before the next rollup run must keep the bars no rollup covers yet
+    rollups.prune(keep_days=0, pause=0, now=DAY + timedelta(days=2))
+    assert session.query(func.count()).filter(MarketData.stock_id == 2).scalar() == 90
+
+    rollups.update(session, now=OPEN + timedelta(minutes=90))
+    assert _bar_counts(session, 1) == {"5m": 90, "1h": 90, "1d": 90}
+    assert _bar_counts(session, 2) == {"5m": 90, "1h": 90, "1d": 90}
+
+    # Once covered, both stocks' bars before their watermarks can go
+    rollups.prune(keep_days=0, pause=0, now=DAY + timedelta(days=2))
+    assert _bar_counts(session, 2) == {"5m": 90, "1h": 90, "1d": 90}
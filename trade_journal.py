@@ -0,0 +1,220 @@
+"""Append-only trade journal.
+
+Trades are written one JSON object per line to a .jsonl file, so recording a trade is a
+single O_APPEND write instead of rewriting the whole history. For the record that crosses
+each `index_bytes` boundary of the file the writer also appends "timestamp<TAB>offset" to a
+small .idx sidecar; readers bisect that sparse index to seek straight to a time range
+instead of parsing the file from the top. Keying the index on byte boundaries rather than
+a per-process counter keeps it evenly spaced when many short-lived monitor processes
+append to the same journal.
+
+    python trade_journal.py --convert trade_history.json     # one-time import
+    python trade_journal.py --start "2024-05-01" --end "2024-05-02"
+"""
+import argparse
+import bisect
+import json
+import os
+import time
+from logger import get_logger
+
+try:
+    import fcntl
+except ImportError:  # Windows: O_APPEND writes of one line are atomic enough for a single host
+    fcntl = None
+
+logger = get_logger(__name__)
+
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def _as_key(value) -> str | None:
+    # Journal timestamps are "%Y-%m-%d %H:%M:%S" strings, which sort chronologically
+    if value is None or isinstance(value, str):
+        return value
+    return value.strftime(TIMESTAMP_FORMAT)
+
+
+class TradeJournal:
+    """JSONL trade log with O(1) appends, batched fsync and a sparse time index."""
+
+    def __init__(
+        self,
+        path: str = "trade_history.jsonl",
+        index_bytes: int = 16 * 1024,
+        fsync_every: int = 32,
+        fsync_interval: float = 1.0,
+    ):
+        self.path = path
+        self.index_path = path + ".idx"
+        self.index_bytes = index_bytes
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval
+        self._fd = None
+        self._index_fd = None
+        self._pending = 0
+        self._last_sync = time.monotonic()
+
+    def exists(self) -> bool:
+        return os.path.exists(self.path)
+
+    def _open(self):
+        if self._fd is None:
+            flags = os.O_WRONLY | os.O_APPEND | os.O_CREAT | getattr(os, "O_BINARY", 0)
+            self._fd = os.open(self.path, flags, 0o644)
+            self._index_fd = os.open(self.index_path, flags, 0o644)
+
+    def append(self, entry: dict):
+        """Append one trade; durable after the next batched fsync (or flush())."""
+        self._open()
+        line = (json.dumps(entry, separators=(",", ":")) + "\n").encode("utf-8")
+        if fcntl is not None:
+            # Several monitor processes append to the same file; the lock keeps the offset
+            # we index consistent with where our line actually lands
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            offset = os.lseek(self._fd, 0, os.SEEK_END)
+            os.write(self._fd, line)
+            if (
+                offset == 0
+                or offset // self.index_bytes != (offset + len(line)) // self.index_bytes
+            ):
+                self._write_index(entry.get("timestamp"), offset)
+        finally:
+            if fcntl is not None:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+        self._pending += 1
+        now = time.monotonic()
+        if self._pending >= self.fsync_every or now - self._last_sync >= self.fsync_interval:
+            self.flush()
+
+    def _write_index(self, timestamp, offset: int):
+        key = _as_key(timestamp)
+        if key:
+            os.write(self._index_fd, f"{key}\t{offset}\n".encode("utf-8"))
+
+    def flush(self):
+        if self._fd is not None and self._pending:
+            os.fsync(self._fd)
+            os.fsync(self._index_fd)
+        self._pending = 0
+        self._last_sync = time.monotonic()
+
+    def close(self):
+        if self._fd is not None:
+            self.flush()
+            os.close(self._fd)
+            os.close(self._index_fd)
+            self._fd = self._index_fd = None
+
+    def _load_index(self) -> tuple[list[str], list[int]]:
+        keys, offsets = [], []
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    key, _, offset = line.rstrip("\n").partition("\t")
+                    if offset:
+                        keys.append(key)
+                        offsets.append(int(offset))
+        except FileNotFoundError:
+            pass
+        return keys, offsets
+
+    def _seek_offset(self, start: str | None) -> int:
+        if start is None:
+            return 0
+        keys, offsets = self._load_index()
+        # Last indexed record strictly before start; everything at or after start follows it
+        i = bisect.bisect_left(keys, start)
+        return offsets[i - 1] if i > 0 else 0
+
+    def iter_trades(self, start=None, end=None):
+        """Yield trades with start <= timestamp <= end, reading only from the nearest index point.
+
+        start/end are datetimes or "%Y-%m-%d %H:%M:%S" strings (prefixes such as a bare date
+        work for start). Trades are appended in time order, so reading stops past end.
+        """
+        start, end = _as_key(start), _as_key(end)
+        try:
+            f = open(self.path, "rb")
+        except FileNotFoundError:
+            return
+        with f:
+            f.seek(self._seek_offset(start))
+            for raw in f:
+                if not raw.endswith(b"\n"):
+                    break  # a writer is mid-append
+                try:
+                    entry = json.loads(raw)
+                except json.JSONDecodeError:
+                    logger.error(f"Skipping corrupt line in {self.path}")
+                    continue
+                timestamp = entry.get("timestamp", "")
+                if start is not None and timestamp < start:
+                    continue
+                if end is not None and timestamp > end and not timestamp.startswith(end):
+                    break
+                yield entry
+
+    def __iter__(self):
+        return self.iter_trades()
+
+    def tail(self, n: int = 10) -> list[dict]:
+        """The last n trades, reading backwards from the end of the file."""
+        if n <= 0:
+            return []
+        try:
+            f = open(self.path, "rb")
+        except FileNotFoundError:
+            return []
+        with f:
+            f.seek(0, os.SEEK_END)
+            position = f.tell()
+            data = b""
+            while position > 0 and data.count(b"\n") <= n:
+                step = min(64 * 1024, position)
+                position -= step
+                f.seek(position)
+                data = f.read(step) + data
+        lines = [line for line in data.split(b"\n") if line][-n:]
+        return [json.loads(line) for line in lines]
+
+
+def convert_json_history(json_path: str, journal: TradeJournal | str) -> int:
+    """One-time import of a legacy trade_history.json list; returns the number of trades."""
+    if isinstance(journal, str):
+        journal = TradeJournal(journal)
+    try:
+        with open(json_path, "r") as f:
+            content = f.read()
+        trades = json.loads(content) if content.strip() else []
+    except FileNotFoundError:
+        return 0
+    except json.JSONDecodeError:
+        logger.error(f"Error decoding JSON from {json_path}. Trade history not converted.")
+        return 0
+
+    trades.sort(key=lambda trade: trade.get("timestamp", ""))
+    journal._open()  # create the journal even when there is nothing to import
+    for trade in trades:
+        journal.append(trade)
+    journal.close()
+    logger.info(f"Converted {len(trades)} trades from {json_path} into {journal.path}.")
+    return len(trades)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inspect or import the trade journal.")
+    parser.add_argument("--journal", default="trade_history.jsonl")
+    parser.add_argument("--convert", metavar="JSON", help="import a legacy trade_history.json")
+    parser.add_argument("--start")
+    parser.add_argument("--end")
+    args = parser.parse_args()
+
+    journal = TradeJournal(args.journal)
+    if args.convert:
+        convert_json_history(args.convert, journal)
+    else:
+        for trade in journal.iter_trades(args.start, args.end):
+            print(json.dumps(trade))
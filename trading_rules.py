@@ -0,0 +1,13 @@
+"""Parameters of the trading rules, shared by the monitor, the wallet and the backtester."""
+
+# Buy when the price and the volume both moved more than this since the previous bar
+PRICE_THRESHOLD = 0.01
+VOLUME_THRESHOLD = 0.25
+# Seconds before a sold ticker may be bought again
+COOLDOWN_PERIOD = 360
+# A buy spends this fraction of the balance, and is skipped when that is MIN_SPEND or less
+SPEND_FRACTION = 0.15
+MIN_SPEND = 200
+# Stop loss set at buy time, and the trailing stop as a fraction of each newer close
+INITIAL_STOP = 0.965
+TRAILING_STOP = 0.97
@@ -1,34 +1,73 @@
 import json
-from logger import logger
+from logger import get_logger
+from metrics import timed
 from stock import Stock
+from features import Features
+from wallet_store import WalletStore
+from trade_journal import TradeJournal, convert_json_history
+from trading_rules import INITIAL_STOP, MIN_SPEND, SPEND_FRACTION, TRAILING_STOP
 import time
 from datetime import datetime
 
+logger = get_logger(__name__)
+
 
 class VirtualWallet:
-    def __init__(self, initial_balance: float = 10000.0, filename: str = "wallet.json", trade_filename: str = "trade_history.json"):
+    def __init__(self, initial_balance: float = 10000.0, filename: str = "wallet.json", trade_filename: str = "trade_history.json", store_path: str = "wallet.db", journal_path: str = "trade_history.jsonl"):
         self.balance: float = initial_balance
         self.stocks: dict[str, dict] = {}
         self.filename = "wallet.json"
-        self.trade_history = []  
-        self.trade_filename = trade_filename  
+        self.trade_filename = trade_filename  # legacy JSON history, only read to seed the journal
+        self._pending_trades: list[dict] = []
         self.sell_cooldowns: dict[str, float] = {}  # New dictionary for sell cooldowns
         self.trailing_stoploss: dict[str, float] = {}  # New dictionary to track trailing stop loss for each stock
+        # Balance, positions, stops and cooldowns live in a transactional SQLite store;
+        # wallet.json is only read once to seed a new store.
+        self.store = WalletStore(store_path, initial_balance)
+        if self.store.created:
+            self.store.import_json(filename)
         self.load_wallet(filename)
+        # Trades are appended to a journal instead of rewriting the whole history each time
+        self.journal = TradeJournal(journal_path)
         self.load_trade_history()
 
+    def _apply_state(self, state: dict):
+        self.balance = state["balance"]
+        self.stocks = state["stocks"]
+        self.sell_cooldowns = state["sell_cooldowns"]
+        self.trailing_stoploss = state["trailing_stoploss"]
+
     def buy_stock(self, stock: Stock, minutes_ago: int):
         """Simulate buying stock with 15% of the wallet balance."""
-        if len(stock.market_data) < minutes_ago + 1:
-            logger.warning(f"Not enough market data for {stock.ticker} to retrieve price {minutes_ago} minutes ago.")
+        features = stock.features((minutes_ago,))
+        if not features.has(minutes_ago):
+            logger.warning("Not enough market data for %s to retrieve price %d minutes ago.", stock.ticker, minutes_ago)
             return False
 
-        amount_to_spend = self.balance * 0.15
-        if amount_to_spend <= int(200):  
+        with timed("wallet_persist"), self.store.transaction() as conn:
+            # Re-read inside the write lock so concurrent monitors see each other's buys
+            self._apply_state(self.store.load(conn))
+            bought = self._buy_locked(conn, stock, features, minutes_ago)
+
+        if bought:
+            self.save_trade_history()
+        return bought
+
+    def _buy_locked(self, conn, stock: Stock, features: Features, minutes_ago: int) -> bool:
+        amount_to_spend = self.balance * SPEND_FRACTION
+        if amount_to_spend <= MIN_SPEND:
             return False
-        current_price = round(stock.get_price("close"), 4)
-        logger.info(f"current price is {current_price}")
-        logger.debug(f"Price for {stock.ticker} at {minutes_ago} minutes ago: {current_price}")
+        current_price = round(features.close, 4)
+        logger.info("current price is %s", current_price)
+        logger.debug(
+            "Price for %s at %d minutes ago: %s (change %s, volatility %.6f, volume z-score %.2f)",
+            stock.ticker,
+            minutes_ago,
+            current_price,
+            features.price_change(minutes_ago),
+            features.volatility,
+            features.volume_zscore,
+        )
 
         quantity = int(amount_to_spend // current_price)
 
@@ -43,10 +82,15 @@ class VirtualWallet:
                     self.stocks[stock.ticker] = {"quantity": quantity, "buy_price": current_price}
 
                 # Initialize or update trailing stop loss for this stock
-                self.trailing_stoploss[stock.ticker] = current_price * 0.965 # Set stop loss as 3% below current price
+                self.trailing_stoploss[stock.ticker] = current_price * INITIAL_STOP
+
+                position = self.stocks[stock.ticker]
+                self.store.set_balance(conn, self.balance)
+                self.store.set_position(conn, stock.ticker, position["quantity"], position["buy_price"])
+                self.store.set_stop(conn, stock.ticker, self.trailing_stoploss[stock.ticker])
 
                 # Log the purchase
-                logger.info(f"Bought {quantity} shares of {stock.ticker} at {current_price} per share.")
+                logger.info("Bought %d shares of %s at %s per share.", quantity, stock.ticker, current_price)
 
                 # Record the trade
                 trade_entry = {
@@ -57,21 +101,28 @@ class VirtualWallet:
                     "total_cost": total_cost,
                     "timestamp": datetime.now().strftime('%Y-%m-%d %H:%M:%S')
                 }
-                self.trade_history.append(trade_entry)
-                self.save_wallet("wallet.json")  # Ensure wallet is saved with updated stoploss
-                self.save_trade_history()
+                self._pending_trades.append(trade_entry)
                 return True
             else:
-                logger.warning(f"Not enough balance to buy {quantity} shares of {stock.ticker}.")
+                logger.warning("Not enough balance to buy %d shares of %s.", quantity, stock.ticker)
                 return False
         else:
-            logger.warning(f"Insufficient funds to buy at least one share of {stock.ticker}.")
+            logger.warning("Insufficient funds to buy at least one share of %s.", stock.ticker)
             return False
 
 
     def sell_stock(self, stock: Stock):
+        with timed("wallet_persist"), self.store.transaction() as conn:
+            self._apply_state(self.store.load(conn))
+            sold = self._sell_locked(conn, stock)
+
+        if sold:
+            self.save_trade_history()
+        return sold
+
+    def _sell_locked(self, conn, stock: Stock) -> bool:
         if stock.ticker not in self.stocks:
-            logger.warning(f"Stock {stock.ticker} not found in portfolio.")
+            logger.warning("Stock %s not found in portfolio.", stock.ticker)
             return False
 
         stock_data = self.stocks[stock.ticker]
@@ -81,11 +132,11 @@ class VirtualWallet:
         profit_loss_percentage = (current_price - buy_price) / buy_price
 
         # Calculate the new trailing stop loss
-        new_trailing_stop = current_price * 0.97
+        new_trailing_stop = current_price * TRAILING_STOP
         if new_trailing_stop > self.trailing_stoploss.get(stock.ticker, 0):
             self.trailing_stoploss[stock.ticker] = new_trailing_stop  # Update stop loss if the new one is higher
-            self.save_wallet("wallet.json")  # Ensure wallet is saved with updated trailing stop loss
-            logger.debug(f"Updated trailing stop loss for {stock.ticker} to {self.trailing_stoploss[stock.ticker]:.2f}")
+            self.store.set_stop(conn, stock.ticker, new_trailing_stop)
+            logger.debug("Updated trailing stop loss for %s to %.2f", stock.ticker, self.trailing_stoploss[stock.ticker])
 
         if current_price <= self.trailing_stoploss[stock.ticker]:
             # Execute the sale
@@ -93,7 +144,10 @@ class VirtualWallet:
             del self.stocks[stock.ticker]  # Remove stock from portfolio
             del self.trailing_stoploss[stock.ticker]  # Remove the trailing stop loss for the sold stock
             self.sell_cooldowns[stock.ticker] = time.time()  
-            logger.info(f"Sold {quantity} shares of {stock.ticker} at {current_price} for a loss of {profit_loss_percentage * 100:.2f}%.")
+            self.store.set_balance(conn, self.balance)
+            self.store.delete_position(conn, stock.ticker)
+            self.store.set_cooldown(conn, stock.ticker, self.sell_cooldowns[stock.ticker])
+            logger.info("Sold %d shares of %s at %s for a loss of %.2f%%.", quantity, stock.ticker, current_price, profit_loss_percentage * 100)
             
             # Record the trade
             trade_entry = {
@@ -104,16 +158,15 @@ class VirtualWallet:
                 "total_revenue": current_price * quantity,
                 "timestamp": datetime.now().strftime('%Y-%m-%d %H:%M:%S')
             }
-            self.trade_history.append(trade_entry)
-            self.save_wallet("wallet.json")  # Ensure wallet is saved with updated trailing stop loss
-            self.save_trade_history()
+            self._pending_trades.append(trade_entry)
             return True
 
         return False
 
 
-    def save_wallet(self, filename: str):
-        """Save the wallet data to a JSON file."""
+    @timed("wallet_persist")
+    def save_wallet(self, filename: str | None = None):
+        """Write the full in-memory wallet to the store (buys and sells already persist their rows)."""
         wallet_data = {
             "balance": self.balance,
             "stocks": self.stocks,
@@ -121,45 +174,40 @@ class VirtualWallet:
             "trailing_stoploss": self.trailing_stoploss  # This will now contain all stop losses for each stock
         }
         try:
-            with open(filename, "w") as f:
-                json.dump(wallet_data, f, indent=4)
-            logger.info(f"Wallet saved to {filename}.")
+            self.store.replace_all(wallet_data)
+            logger.info(f"Wallet saved to {self.store.path}.")
         except Exception as e:
             logger.error(f"Error saving wallet: {e}")
 
+    def export_json(self, filename: str):
+        """Dump the wallet to a JSON file, in the format wallet.json used to have."""
+        with open(filename, "w") as f:
+            json.dump(self.store.load(), f, indent=4)
 
-    def load_wallet(self, filename: str):
-        """Load the wallet data from a JSON file."""
+    def load_wallet(self, filename: str | None = None):
+        """Load the wallet data from the store."""
         try:
-            with open(filename, "r") as f:
-                wallet_data = json.load(f)
-
-            # Load the balance, stocks, and sell cooldowns with default values
-            self.balance = wallet_data.get("balance", 10000.0)
-            self.stocks = wallet_data.get("stocks", {})
-            self.sell_cooldowns = wallet_data.get("sell_cooldowns", {})
-
-            # Optionally, load any new fields (e.g., trailing stop losses) if added
-            self.trailing_stoploss = wallet_data.get("trailing_stoploss", {})
-
-            logger.info(f"Wallet loaded from {filename}.")
-        
-        except FileNotFoundError:
-            logger.warning(f"Wallet file {filename} not found. Starting with default balance.")
-        except json.JSONDecodeError:
-            logger.error(f"Error decoding JSON from {filename}. Wallet not loaded.")
+            self._apply_state(self.store.load())
+            logger.info(f"Wallet loaded from {self.store.path}.")
         except Exception as e:
             logger.error(f"Error loading wallet: {e}")
 
+    @timed("trade_journal")
     def save_trade_history(self):
-        """Save the trade history to a JSON file."""
+        """Append the trades recorded since the last save to the journal."""
         try:
-            with open(self.trade_filename, "w") as f:
-                json.dump(self.trade_history, f, indent=4)
-            logger.info(f"Trade history saved to {self.trade_filename}.")
+            for trade_entry in self._pending_trades:
+                self.journal.append(trade_entry)
+            self._pending_trades.clear()
+            logger.info(f"Trade history saved to {self.journal.path}.")
         except Exception as e:
             logger.error(f"Error saving trade history: {e}")
 
+    @property
+    def trade_history(self) -> list[dict]:
+        """All trades, read from the journal on demand (use journal.iter_trades to stream)."""
+        return list(self.journal.iter_trades())
+
     def check_balance(self):
         """Check current balance."""
         return self.balance
@@ -169,17 +217,20 @@ class VirtualWallet:
         return self.stocks
 
     def load_trade_history(self):
-        """Load the trade history from a JSON file."""
+        """Convert the legacy JSON trade history into the journal the first time it is opened.
+
+        Nothing is read into memory; the journal is streamed when trades are needed.
+        """
+        if self.journal.exists():
+            return
         try:
-            with open(self.trade_filename, "r") as f:
-                self.trade_history = json.load(f)
-            logger.info(f"Trade history loaded from {self.trade_filename}.")
-        except FileNotFoundError:
-            logger.warning(f"Trade history file {self.trade_filename} not found. Starting with empty history.")
-        except json.JSONDecodeError:
-            logger.error(f"Error decoding JSON from {self.trade_filename}. Trade history not loaded.")
+            convert_json_history(self.trade_filename, self.journal)
         except Exception as e:
-            logger.error(f"Error loading trade history: {e}")
+            logger.error(f"Error converting trade history: {e}")
+
+    def close(self):
+        self.journal.close()
+        self.store.close()
 
     def __repr__(self):
-        return f"VirtualWallet(balance={self.balance}, stocks={self.stocks}, trade_history={self.trade_history}, sell_cooldowns={self.sell_cooldowns})"
+        return f"VirtualWallet(balance={self.balance}, stocks={self.stocks}, trade_journal={self.journal.path}, sell_cooldowns={self.sell_cooldowns})"
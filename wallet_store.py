@@ -0,0 +1,141 @@
+import json
+import os
+import sqlite3
+from contextlib import contextmanager
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS account (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    balance REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS positions (
+    ticker TEXT PRIMARY KEY,
+    quantity INTEGER NOT NULL,
+    buy_price REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS trailing_stops (
+    ticker TEXT PRIMARY KEY,
+    stop REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS sell_cooldowns (
+    ticker TEXT PRIMARY KEY,
+    sold_at REAL NOT NULL
+);
+"""
+
+
+class WalletStore:
+    """Wallet state in a local SQLite file with row-level updates.
+
+    Every change runs inside BEGIN IMMEDIATE, which takes SQLite's write lock, so monitor
+    processes sharing the file serialise their read-modify-write cycles instead of
+    overwriting each other. WAL keeps readers from blocking on a writer.
+    """
+
+    def __init__(
+        self, path: str = "wallet.db", initial_balance: float = 10000.0, timeout: float = 10.0
+    ):
+        self.path = path
+        created = not os.path.exists(path)
+        # Autocommit mode: transactions are opened explicitly in transaction()
+        self.conn = sqlite3.connect(path, timeout=timeout, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode = WAL")
+        self.conn.execute("PRAGMA synchronous = NORMAL")
+        self.conn.executescript(SCHEMA)
+        self.conn.execute(
+            "INSERT OR IGNORE INTO account (id, balance) VALUES (1, ?)", (initial_balance,)
+        )
+        self.created = created
+
+    @contextmanager
+    def transaction(self):
+        """Hold the write lock for a read-modify-write cycle; rolls back on error."""
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield self.conn
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+        else:
+            self.conn.execute("COMMIT")
+
+    def load(self, conn: sqlite3.Connection | None = None) -> dict:
+        conn = conn or self.conn
+        return {
+            "balance": conn.execute("SELECT balance FROM account WHERE id = 1").fetchone()[0],
+            "stocks": {
+                ticker: {"quantity": quantity, "buy_price": buy_price}
+                for ticker, quantity, buy_price in conn.execute(
+                    "SELECT ticker, quantity, buy_price FROM positions"
+                )
+            },
+            "trailing_stoploss": dict(conn.execute("SELECT ticker, stop FROM trailing_stops")),
+            "sell_cooldowns": dict(conn.execute("SELECT ticker, sold_at FROM sell_cooldowns")),
+        }
+
+    @staticmethod
+    def set_balance(conn: sqlite3.Connection, balance: float):
+        conn.execute("UPDATE account SET balance = ? WHERE id = 1", (balance,))
+
+    @staticmethod
+    def set_position(conn: sqlite3.Connection, ticker: str, quantity: int, buy_price: float):
+        conn.execute(
+            "INSERT INTO positions (ticker, quantity, buy_price) VALUES (?, ?, ?) "
+            "ON CONFLICT(ticker) DO UPDATE SET quantity = excluded.quantity, "
+            "buy_price = excluded.buy_price",
+            (ticker, quantity, buy_price),
+        )
+
+    @staticmethod
+    def delete_position(conn: sqlite3.Connection, ticker: str):
+        conn.execute("DELETE FROM positions WHERE ticker = ?", (ticker,))
+        conn.execute("DELETE FROM trailing_stops WHERE ticker = ?", (ticker,))
+
+    @staticmethod
+    def set_stop(conn: sqlite3.Connection, ticker: str, stop: float):
+        conn.execute(
+            "INSERT INTO trailing_stops (ticker, stop) VALUES (?, ?) "
+            "ON CONFLICT(ticker) DO UPDATE SET stop = excluded.stop",
+            (ticker, stop),
+        )
+
+    @staticmethod
+    def set_cooldown(conn: sqlite3.Connection, ticker: str, sold_at: float):
+        conn.execute(
+            "INSERT INTO sell_cooldowns (ticker, sold_at) VALUES (?, ?) "
+            "ON CONFLICT(ticker) DO UPDATE SET sold_at = excluded.sold_at",
+            (ticker, sold_at),
+        )
+
+    def replace_all(self, state: dict):
+        """Overwrite the whole wallet (used for imports and explicit full saves)."""
+        with self.transaction() as conn:
+            self.set_balance(conn, state.get("balance", 10000.0))
+            for table in ("positions", "trailing_stops", "sell_cooldowns"):
+                conn.execute(f"DELETE FROM {table}")
+            for ticker, position in state.get("stocks", {}).items():
+                self.set_position(conn, ticker, position["quantity"], position["buy_price"])
+            for ticker, stop in state.get("trailing_stoploss", {}).items():
+                self.set_stop(conn, ticker, stop)
+            for ticker, sold_at in state.get("sell_cooldowns", {}).items():
+                self.set_cooldown(conn, ticker, sold_at)
+
+    def import_json(self, filename: str) -> bool:
+        """One-time import of a legacy wallet.json into the store."""
+        try:
+            with open(filename, "r") as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return False
+        except json.JSONDecodeError:
+            logger.error(f"Error decoding JSON from {filename}. Wallet not imported.")
+            return False
+        self.replace_all(state)
+        logger.info(f"Imported wallet from {filename} into {self.path}.")
+        return True
+
+    def close(self):
+        self.conn.close()